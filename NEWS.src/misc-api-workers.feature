@@ -0,0 +1 @@
+The new "apiWorkers" server option answers read-only API calls such as getJobs from a pool of pre-forked processes instead of forking for each call.
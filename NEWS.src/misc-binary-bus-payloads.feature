@@ -0,0 +1 @@
+Message bus sessions now negotiate a marshal payload encoding, compressed above 8KB, instead of always using XML-RPC
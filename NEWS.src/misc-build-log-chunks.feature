@@ -0,0 +1 @@
+Build logs are now fetched from the server in bounded, compressed chunks, and the new getTroveBuildLogChunk API can wait for new log output instead of being polled
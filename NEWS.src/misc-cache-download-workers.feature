@@ -0,0 +1 @@
+The new "cacheDownloadWorkers" option downloads the changesets needed for a chroot several at a time when useCache is set, and the chroot log reports how many were downloaded and how fast.
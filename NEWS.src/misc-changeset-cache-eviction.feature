@@ -0,0 +1 @@
+The changeset cache used when "useCache" is set now keeps an index of its entries, removes the least recently used ones past the new "changesetCacheSize" option, and counts hits, misses and bytes saved; the new "cache-stats" and "prune-cache" server and node commands report on and prune it.
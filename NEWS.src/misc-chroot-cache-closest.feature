@@ -0,0 +1 @@
+When no cached chroot matches exactly, rMake now restores the closest cached chroot and installs only the troves that differ (chrootCacheClosestMatch)
@@ -0,0 +1 @@
+Chroot cache archives can now be compressed with zstd or pigz, or kept as an uncompressed tree ("chrootCacheCompression"), and are written in the background from a reflinked copy of the chroot so builds no longer wait for them ("chrootCacheBackground").
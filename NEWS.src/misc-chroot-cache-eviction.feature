@@ -0,0 +1 @@
+The chroot cache now keeps an index of its contents, can be limited in size with "chrootCacheSize" (least recently used chroots are removed first), and can be listed with "rmake list chrootcache".
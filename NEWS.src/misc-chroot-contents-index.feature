@@ -0,0 +1 @@
+Picking an old chroot to reuse now ranks chroots from a saved index of their contents instead of opening every chroot's conary database
@@ -0,0 +1 @@
+Build logs are now compressed in independently readable blocks when their job finishes, and "rmake-server compress-logs" compresses existing logs
@@ -0,0 +1 @@
+The job database now has covering indexes for state logs, job states and active chroots, and state logs can be paged by log id with the new getJobLogsSince and getTroveLogsSince calls.
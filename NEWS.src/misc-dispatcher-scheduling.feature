@@ -0,0 +1 @@
+The dispatcher caches which nodes can build each set of flavors and assigns a whole queue of commands in one pass using per-flavor node heaps
@@ -0,0 +1 @@
+Large message bus messages are written without copying the unsent remainder after each partial send, and read straight into a preallocated buffer
@@ -0,0 +1 @@
+The message bus now polls its sessions with epoll and disconnects sessions that let more than 10000 messages queue up unread
@@ -0,0 +1 @@
+The message bus routes messages to subscribers through an index on channel and attribute instead of checking every subscription on the channel
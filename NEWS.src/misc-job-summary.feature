@@ -0,0 +1 @@
+Added a getJobSummary call that returns trove counts by state and per-trove name, state, start and finish times without sending trove objects; "rmake query --info" uses it.
@@ -0,0 +1 @@
+Recipe load results are now cached between jobs and reused while the source trove, flavor, resolveTroves and loaded superclasses are unchanged; see the new "useLoadCache" option.
@@ -0,0 +1 @@
+The new "loadWorkers" server option loads the recipes for a job in several processes at once.
@@ -0,0 +1 @@
+Subscriber events are now delivered by a long-lived process that caches subscriber lookups, delivers to each subscriber in its own thread with a timeout, and logs delivery latency
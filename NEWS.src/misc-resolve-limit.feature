@@ -0,0 +1 @@
+The number of troves resolving at once now grows with the number of free build slots instead of being capped at 10, and the new "resolveBatchSize" server option allows several troves to be resolved in a single process.
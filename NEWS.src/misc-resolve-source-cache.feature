@@ -0,0 +1 @@
+Workers now keep the contents of resolveTroves loaded between resolves instead of fetching them again for every trove. The number of configurations kept is set by the new "resolveSourceCacheSize" option.
@@ -0,0 +1 @@
+The resolver cache now stores results in an indexed database with a size limit ("resolverCacheSize"), caches results that depend on troves built earlier in the job, and reports hit and miss counts through the new getResolverCacheStats server call.
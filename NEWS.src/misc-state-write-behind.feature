@@ -0,0 +1 @@
+Builds now batch job and trove state changes into fewer database transactions, controlled by the new stateWriteDelay and stateWriteBatch server options.
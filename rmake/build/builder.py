@@ -23,7 +23,6 @@ import random
 import signal
 import sys
 import os
-import time
 import traceback
 
 from conary import conaryclient
@@ -34,6 +33,7 @@ from conary.lib import util
 from rmake import failure
 from rmake.build import buildtrove
 from rmake.build import dephandler
+from rmake.db import logstore
 from rmake.lib import logfile
 from rmake.lib import logger
 from rmake.lib import repocache
@@ -71,6 +71,10 @@ class Builder(object):
         build.
         @type buildCfg: rmake.build.buildcfg.BuildConfiguration instance.
     """
+    # maximum number of seconds to wait for the worker when there's
+    # nothing else to do.
+    idleTimeout = 1
+
     def __init__(self, serverCfg, job, jobContext=None, db=None):
         self.serverCfg = serverCfg
         self.buildCfg = job.getMainConfig()
@@ -130,11 +134,24 @@ class Builder(object):
     def info(self, state, message):
         self.logger.info(message)
 
+    def _flushStateWrites(self):
+        if self.db is None or not self.db.isWriteBehindEnabled():
+            return
+        self.db.flushStateWrites()
+        stats = self.db.getStateWriteStats()
+        if stats['commits']:
+            self.logger.info('Database state writes: %s writes (%s coalesced)'
+                             ' in %s commits, %.3fs total, %.3fs max' % (
+                                stats['writes'], stats['coalesced'],
+                                stats['commits'], stats['commitTime'],
+                                stats['maxCommitTime']))
+
     def _signalHandler(self, sigNum, frame):
         try:
             signal.signal(sigNum, signal.SIG_DFL)
             self.worker.stopAllCommands()
             self.job.jobFailed('Received signal %s' % sigNum)
+            self._flushStateWrites()
             os.kill(os.getpid(), sigNum)
         finally:
             os._exit(1)
@@ -150,10 +167,14 @@ class Builder(object):
                                               # such as conary output, is
                                               # directed to a file.
                 self.build()
+                self._flushStateWrites()
+                if self.serverCfg.compressBuildLogs:
+                    self.compressBuildLogs()
                 os._exit(0)
             except Exception, err:
                 self.logger.error(traceback.format_exc())
                 self.job.exceptionOccurred(err, traceback.format_exc())
+                self._flushStateWrites()
                 self.logFile.restoreOutput()
                 try:
                     self.worker.stopAllCommands()
@@ -167,6 +188,22 @@ class Builder(object):
         finally:
             os._exit(1)
 
+    def compressBuildLogs(self):
+        """
+            Compress the logs of all troves in this job that are kept in
+            the log store.  Called once the job is finished, so nothing is
+            still writing to them.
+        """
+        logDir = self.serverCfg.getDbContentsPath() + '/logs/'
+        for trove in self.job.iterTroves():
+            if not trove.logPath or not trove.logPath.startswith(logDir):
+                continue
+            try:
+                logstore.compressLog(trove.logPath)
+            except (IOError, OSError), err:
+                self.logger.warning('Could not compress build log %s: %s',
+                                    trove.logPath, err)
+
     def initializeBuild(self):
         def _isSolitaryTrove(trv):
             return (trv.isRedirectRecipe() or trv.isFilesetRecipe())
@@ -238,6 +275,7 @@ class Builder(object):
                 self.logger, regularTroves, specialTroves, logDir,
                 dumbMode=self.buildCfg.isolateTroves,
                 resolverCachePath=resolverCachePath,
+                resolverCacheSize=self.serverCfg.resolverCacheSize * 1048576,
                 )
         if not self._checkBuildSanity(buildTroves):
             return False
@@ -253,8 +291,20 @@ class Builder(object):
 
         self.job.jobBuilding('Building troves')
         if self.dh.moreToDo():
+            # wake up from handleRequestIfReady as soon as a command exits
+            self.worker._watchChildren()
+            idle = False
             while self.dh.moreToDo():
-                self.worker.handleRequestIfReady()
+                # Only wait for the worker when the last pass found nothing
+                # to do.  Command output or a command exiting ends the wait
+                # immediately, the timeout is just a safety net.
+                if idle:
+                    self.worker.handleRequestIfReady(self.idleTimeout)
+                else:
+                    self.worker.handleRequestIfReady(0)
+                if self.db is not None:
+                    self.db.checkStateWrites()
+                idle = False
                 if self.worker._checkForResults():
                     self.resolveIfReady()
                 elif self.dh.hasBuildableTroves():
@@ -264,7 +314,7 @@ class Builder(object):
                 elif self.dh.hasSpecialTroves():
                     self.actOnTrove(self.dh.popSpecialTrove())
                 elif not self.resolveIfReady():
-                    time.sleep(0.1)
+                    idle = True
             if self.dh.jobPassed():
                 self.job.jobPassed("build job finished successfully")
                 return True
@@ -305,14 +355,34 @@ class Builder(object):
                                bootstrapReqs=bootstrapReqs)
 
     def resolveIfReady(self):
-        resolveJob = self.dh.getNextResolveJob()
-        if resolveJob:
+        # keep enough troves resolving to fill the slots that are free.
+        self.dh.setResolveLimit(self.dh.getResolvingCount()
+                                + self.worker.getOpenSlotCount())
+        resolveJobs = self.dh.getNextResolveJobs(
+                                        self.serverCfg.resolveBatchSize)
+        if not resolveJobs:
+            return False
+        # only troves that share a configuration can be resolved together
+        batches = []
+        batchesByConfig = {}
+        for resolveJob in resolveJobs:
             resolveJob.getTrove().troveQueued('Ready for dep resolution')
             resolveJob.getTrove().disown()
             logData = self.startTroveLogger(resolveJob.getTrove())
-            self.worker.resolve(resolveJob, self.eventHandler, logData)
-            return True
-        return False
+            key = id(resolveJob.getConfig())
+            if key not in batchesByConfig:
+                batchesByConfig[key] = ([], [])
+                batches.append(batchesByConfig[key])
+            batchesByConfig[key][0].append(resolveJob)
+            batchesByConfig[key][1].append(logData)
+        for batchJobs, logDataList in batches:
+            if len(batchJobs) == 1:
+                self.worker.resolve(batchJobs[0], self.eventHandler,
+                                    logDataList[0])
+            else:
+                self.worker.resolveTroves(batchJobs, self.eventHandler,
+                                          logDataList)
+        return True
 
     def _matchTrovesToJobContext(self, buildTroves, jobContext):
         trovesByNVF = {}
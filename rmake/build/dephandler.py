@@ -19,13 +19,16 @@
 Dependency Handler and DependencyState classes
 """
 
-import errno
 import itertools
+import marshal
 import os
 import sys
+import time
 import traceback
-import xmlrpclib
+import zlib
 
+from conary import dbstore
+from conary.dbstore.sqlerrors import DatabaseLocked
 from conary.deps import deps
 from conary.lib import digestlib
 from conary.lib import graph
@@ -45,6 +48,9 @@ FAILURE_REASON_FAILED = 0
 FAILURE_REASON_BUILDREQ = 1
 FAILURE_REASON_DEP = 2
 
+# minimum number of troves that may be resolving at once.
+DEFAULT_RESOLVE_LIMIT = 10
+
 class ResolveJob(object):
     def __init__(self, trove, buildCfg, builtTroves=None, crossTroves=None,
                  inCycle=False):
@@ -75,9 +81,6 @@ class ResolveJob(object):
         return self.crossTroves
 
     def getJobHash(self):
-        # Disqualify anything other than a simple, isolated build.
-        if self.inCycle or self.builtTroves or self.crossTroves:
-            return None
         # Hash all the inputs to the resolver so that the result can be cached.
         inputs = [
                 '\0'.join(sorted(self.trove.getBuildRequirements())),
@@ -86,6 +89,18 @@ class ResolveJob(object):
                 '\1'.join('\0'.join(sorted(str(y) for y in x))
                     for x in self.buildCfg.resolveTroveTups),
                 ]
+        if self.inCycle or self.builtTroves or self.crossTroves:
+            # The result may include troves built earlier in this job, so
+            # it is only valid for exactly the same set of built troves.
+            inputs.extend([
+                str(self.inCycle),
+                '\0'.join(sorted('%s=%s[%s]' % (x[0], x[1].freeze(),
+                                                x[2].freeze())
+                                 for x in self.builtTroves)),
+                '\0'.join(sorted('%s=%s[%s]' % (x[0], x[1].freeze(),
+                                                x[2].freeze())
+                                 for x in self.crossTroves)),
+                ])
         return digestlib.sha1('\2'.join(inputs)).hexdigest()
 
     def __freeze__(self):
@@ -107,10 +122,131 @@ class ResolveJob(object):
 register(ResolveJob)
 
 class DependencyGraph(graph.DirectedGraph):
+    """
+        Directed graph that can keep an index of the leaf strongly connected
+        components up to date as nodes and edges are added and removed.
+
+        The index is built the first time getLeafCycles() is called.  After
+        that, the common mutations (adding a node, adding an edge that
+        doesn't create a cycle, removing a node or the edges of a node
+        that isn't part of a cycle) update it in place.  Anything that
+        could merge or split a cycle drops the index so that it is
+        recomputed on the next call.
+    """
+    _compOf = None
+    _parents = None
+    _leaves = None
+    generation = 0
+
     # FIXME: remove with next release of conary
     def __contains__(self, trove):
         return trove in self.data.hashedData
 
+    def _resetLeafIndex(self):
+        self._compOf = self._parents = self._leaves = None
+
+    def _indexNode(self, item):
+        if item not in self._compOf:
+            comp = frozenset([item])
+            self._compOf[item] = comp
+            self._parents[item] = set()
+            self._leaves.add(comp)
+
+    def _isLeafComponent(self, comp):
+        for node in comp:
+            for child in self.iterChildren(node):
+                if child not in comp:
+                    return False
+        return True
+
+    def _reaches(self, fromItem, toItem):
+        seen = set([fromItem])
+        stack = [fromItem]
+        while stack:
+            node = stack.pop()
+            if node == toItem:
+                return True
+            for child in self.iterChildren(node):
+                if child not in seen:
+                    seen.add(child)
+                    stack.append(child)
+        return False
+
+    def addNode(self, item):
+        rv = graph.DirectedGraph.addNode(self, item)
+        if self._compOf is not None:
+            self._indexNode(item)
+            self.generation += 1
+        return rv
+
+    def addEdge(self, fromItem, toItem, value=1):
+        graph.DirectedGraph.addEdge(self, fromItem, toItem, value)
+        self.generation += 1
+        if self._compOf is None:
+            return
+        self._indexNode(fromItem)
+        self._indexNode(toItem)
+        self._parents[toItem].add(fromItem)
+        fromComp = self._compOf[fromItem]
+        if fromComp is self._compOf[toItem]:
+            return
+        if self._reaches(toItem, fromItem):
+            # this edge closes a cycle, components need to be merged.
+            self._resetLeafIndex()
+        else:
+            self._leaves.discard(fromComp)
+
+    def delete(self, item):
+        if self._compOf is None or len(self._compOf[item]) > 1:
+            # removing a node from a cycle may split it.
+            self._resetLeafIndex()
+            graph.DirectedGraph.delete(self, item)
+            self.generation += 1
+            return
+        children = list(self.iterChildren(item))
+        graph.DirectedGraph.delete(self, item)
+        self.generation += 1
+        self._leaves.discard(self._compOf.pop(item))
+        for child in children:
+            self._parents[child].discard(item)
+        for parent in self._parents.pop(item):
+            parentComp = self._compOf[parent]
+            if self._isLeafComponent(parentComp):
+                self._leaves.add(parentComp)
+
+    def deleteEdges(self, item):
+        if self._compOf is None or len(self._compOf[item]) > 1:
+            self._resetLeafIndex()
+            graph.DirectedGraph.deleteEdges(self, item)
+            self.generation += 1
+            return
+        children = list(self.iterChildren(item))
+        graph.DirectedGraph.deleteEdges(self, item)
+        self.generation += 1
+        for child in children:
+            self._parents[child].discard(item)
+        self._leaves.add(self._compOf[item])
+
+    def getLeafCycles(self):
+        """
+            Returns the strongly connected components of this graph that
+            have no edges leading out of them, as a list of frozensets.
+        """
+        if self._compOf is None:
+            self._compOf = {}
+            self._parents = {}
+            for comp in self.getStronglyConnectedComponents():
+                comp = frozenset(comp)
+                for node in comp:
+                    self._compOf[node] = comp
+                    self._parents[node] = set()
+            for node in self._compOf:
+                for child in self.iterChildren(node):
+                    self._parents[child].add(node)
+            self._leaves = set(x for x in set(self._compOf.itervalues())
+                               if self._isLeafComponent(x))
+        return list(self._leaves)
+
     def generateDotFile(self, out, filterFn=None):
         def formatNode(node):
             name, version, flavor, context = node.getNameVersionFlavor(True)
@@ -434,6 +570,9 @@ class DependencyBasedBuildState(AbstractBuildState):
     def getDependencyGraph(self):
         return self.depGraph
 
+    def getLeafCycles(self):
+        return self.depGraph.getLeafCycles()
+
     def getTrovesByPackage(self, pkg):
         return self.trovesByPackage.get(pkg, [])
 
@@ -445,7 +584,8 @@ class DependencyHandler(object):
         Updates what troves are buildable based on dependency information.
     """
     def __init__(self, statusLog, logger, buildTroves, specialTroves,
-            logDir=None, dumbMode=False, resolverCachePath=None):
+            logDir=None, dumbMode=False, resolverCachePath=None,
+            resolverCacheSize=0):
         self.depState = DependencyBasedBuildState(buildTroves, specialTroves,
                                                   logger)
         self.logger = logger
@@ -455,7 +595,10 @@ class DependencyHandler(object):
         self.inactiveSpecial = list(specialTroves)
         self.graphCount = 0
         self._resolving = {}
+        self._resolveLimit = DEFAULT_RESOLVE_LIMIT
         self.priorities = []
+        self._prioritiesChanged = 0
+        self._sortedLeafCycles = None
         self._delayed = {}
         self._cycleChecked = {}
         self._seenCycles = []
@@ -464,7 +607,8 @@ class DependencyHandler(object):
         self._prebuiltBinaries = set()
         self._hasPrimaryTroves = self.depState.hasPrimaryTroves
         if resolverCachePath:
-            self._resolverCache = ResolverCache(resolverCachePath)
+            self._resolverCache = ResolverCache(resolverCachePath,
+                                                resolverCacheSize)
         else:
             self._resolverCache = None
 
@@ -729,6 +873,7 @@ class DependencyHandler(object):
 
     def prioritize(self, trv):
         self.priorities.append(trv)
+        self._prioritiesChanged += 1
 
     def getPriority(self, trv):
         if trv in self.priorities:
@@ -775,21 +920,16 @@ class DependencyHandler(object):
         depGraph = self.depState.depGraph
         if depGraph.isEmpty():
             return None
-        if len(self._resolving) >= 10:
+        if len(self._resolving) >= self._resolveLimit:
             return None
 
-        compGraph = self.depState.depGraph.getStronglyConnectedGraph()
-        leafCycles = compGraph.getLeaves()
         if self._allowFastResolution:
             result = self._attemptFastResolve(breakCycles=breakCycles,
-                                              nodeLists=leafCycles)
+                                      nodeLists=self.depState.getLeafCycles())
             if result or self._allowFastResolution:
                 return result
 
-        leafCycles = [ (min(self.getPriority(x) for x in leafCycle), 
-                       sorted(leafCycle, key=self.getPriority))
-                        for leafCycle in leafCycles ]
-        leafCycles = [ x[1] for x in sorted(leafCycles) ]
+        leafCycles = self._getSortedLeafCycles()
         newCycles = [ x for x in leafCycles if (len(x) > 1
                                              and x not in self._seenCycles
                                              and self._filterTroves(x) == x) ]
@@ -832,6 +972,44 @@ class DependencyHandler(object):
             trv.troveMissingDependencies(missingDeps)
         self._delayed = {}
 
+    def _getSortedLeafCycles(self):
+        """
+            Returns the leaf cycles of the dependency graph, each sorted by
+            priority, in priority order.  The sorted list is kept until
+            either the graph or the priorities change.
+        """
+        key = (self.depState.depGraph.generation, self._prioritiesChanged)
+        if self._sortedLeafCycles and self._sortedLeafCycles[0] == key:
+            return self._sortedLeafCycles[1]
+        leafCycles = [ (min(self.getPriority(x) for x in leafCycle),
+                       sorted(leafCycle, key=self.getPriority))
+                        for leafCycle in self.depState.getLeafCycles() ]
+        leafCycles = [ x[1] for x in sorted(leafCycles) ]
+        self._sortedLeafCycles = (key, leafCycles)
+        return leafCycles
+
+    def getNextResolveJobs(self, limit=1, breakCycles=True):
+        """
+            Gets up to limit resolve jobs that can be run at the same time.
+        """
+        resolveJobs = []
+        while len(resolveJobs) < limit:
+            resolveJob = self.getNextResolveJob(breakCycles=breakCycles)
+            if not resolveJob:
+                break
+            resolveJobs.append(resolveJob)
+        return resolveJobs
+
+    def getResolvingCount(self):
+        return len(self._resolving)
+
+    def setResolveLimit(self, limit):
+        """
+            Sets the number of troves that may be resolving at once.  The
+            limit never goes below DEFAULT_RESOLVE_LIMIT.
+        """
+        self._resolveLimit = max(limit, DEFAULT_RESOLVE_LIMIT)
+
     def _getResolveJobFromCycle(self, depGraph, cycleTroves):
         def _cycleNodeOrder(node):
             """ 
@@ -935,6 +1113,7 @@ class DependencyHandler(object):
 
         if trv in self.priorities:
             self.priorities.remove(trv)
+            self._prioritiesChanged += 1
         if results.success:
             if self._resolverCache:
                 self._resolverCache.put(results)
@@ -1123,29 +1302,141 @@ class DependencyHandler(object):
 
 
 class ResolverCache(object):
+    """
+        Stores successful resolve results keyed by the hash of the resolve
+        job that produced them.
+
+        Results are kept as compressed marshal data in a sqlite database
+        together with the time each one was last used.  When the total size
+        of the stored results grows past maxSize bytes, the least recently
+        used results are removed.  The database also counts cache hits and
+        misses; see getStats().
+
+        Results, hits and misses are recorded through a second connection
+        that waits at most updateTimeout milliseconds for the database, as
+        they are recorded while resolving.
+    """
+    updateTimeout = 1000
 
-    def __init__(self, path):
+    def __init__(self, path, maxSize=0):
         self.path = path
+        self.maxSize = maxSize
+        self.db = None
+        self.updateDb = None
+
+    def _getDbPath(self):
+        return os.path.join(self.path, 'cache.db')
+
+    def _getDb(self):
+        if self.db is None:
+            util.mkdirChain(self.path)
+            self.db = dbstore.connect(self._getDbPath(),
+                                      driver='sqlite', timeout=30000)
+            cu = self.db.cursor()
+            cu.execute("""CREATE TABLE IF NOT EXISTS ResolveResults (
+                            hash        TEXT PRIMARY KEY,
+                            data        BLOB NOT NULL,
+                            size        INTEGER NOT NULL,
+                            accessed    INTEGER NOT NULL)""")
+            cu.execute("""CREATE INDEX IF NOT EXISTS ResolveResultsAccessedIdx
+                            ON ResolveResults(accessed)""")
+            cu.execute("""CREATE TABLE IF NOT EXISTS ResolveCacheStats (
+                            name        TEXT PRIMARY KEY,
+                            value       INTEGER NOT NULL)""")
+            for name in ('hits', 'misses'):
+                cu.execute("""INSERT OR IGNORE INTO ResolveCacheStats
+                              (name, value) VALUES (?, 0)""", name)
+            self.db.commit()
+        return self.db
+
+    def _getUpdateDb(self):
+        if self.updateDb is None:
+            # create the tables first
+            self._getDb()
+            self.updateDb = dbstore.connect(self._getDbPath(),
+                                            driver='sqlite',
+                                            timeout=self.updateTimeout)
+        return self.updateDb
+
+    def _count(self, cu, name):
+        cu.execute("UPDATE ResolveCacheStats SET value = value + 1"
+                   " WHERE name = ?", name)
 
     def get(self, hash):
         if not hash:
             return None
-        path = os.path.join(self.path, hash)
+        cu = self._getDb().cursor()
+        cu.execute("SELECT data FROM ResolveResults WHERE hash = ?", hash)
+        row = cu.fetchone()
+        db = self._getUpdateDb()
+        cu = db.cursor()
         try:
-            fobj = open(path)
-        except IOError, err:
-            if err.args[0] == errno.ENOENT:
-                return None
-            raise
-        result = xmlrpclib.loads(fobj.read())[0][0]
-        fobj.close()
+            if row is None:
+                self._count(cu, 'misses')
+            else:
+                cu.execute("UPDATE ResolveResults SET accessed = ?"
+                           " WHERE hash = ?", int(time.time()), hash)
+                self._count(cu, 'hits')
+            db.commit()
+        except DatabaseLocked:
+            # bookkeeping only, not worth waiting for.
+            db.rollback()
+        if row is None:
+            return None
+        result = marshal.loads(zlib.decompress(str(row[0])))
         return thaw('ResolveResult', result)
 
     def put(self, result):
         if not result.jobHash:
             return
-        path = os.path.join(self.path, result.jobHash)
-        result = freeze('ResolveResult', result)
-        fobj = util.AtomicFile(path, chmod=0644)
-        fobj.write(xmlrpclib.dumps((result,)))
-        fobj.commit()
+        data = zlib.compress(marshal.dumps(freeze('ResolveResult', result)))
+        db = self._getUpdateDb()
+        cu = db.cursor()
+        try:
+            cu.execute("""INSERT OR REPLACE INTO ResolveResults
+                          (hash, data, size, accessed) VALUES (?, ?, ?, ?)""",
+                       result.jobHash, cu.binary(data), len(data),
+                       int(time.time()))
+            if self.maxSize:
+                self._evict(cu, result.jobHash)
+            db.commit()
+        except DatabaseLocked:
+            db.rollback()
+
+    def _evict(self, cu, keepHash):
+        cu.execute("SELECT SUM(size) FROM ResolveResults")
+        total = cu.fetchone()[0] or 0
+        if total <= self.maxSize:
+            return
+        cu.execute("SELECT hash, size FROM ResolveResults"
+                   " ORDER BY accessed")
+        stale = []
+        for hash, size in cu.fetchall():
+            if total <= self.maxSize:
+                break
+            if hash == keepHash:
+                continue
+            stale.append(hash)
+            total -= size
+        for hash in stale:
+            cu.execute("DELETE FROM ResolveResults WHERE hash = ?", hash)
+
+    def getStats(self):
+        """
+            Returns a dict with the number of cache hits and misses, the
+            number of stored results and their total size in bytes.
+        """
+        if not os.path.exists(self._getDbPath()):
+            # nothing has been resolved yet
+            return dict(hits=0, misses=0, entries=0, size=0)
+        try:
+            cu = self._getDb().cursor()
+            cu.execute("SELECT name, value FROM ResolveCacheStats")
+            stats = dict(cu.fetchall())
+            cu.execute("SELECT COUNT(*), SUM(size) FROM ResolveResults")
+            entries, size = cu.fetchone()
+        except DatabaseLocked:
+            raise errors.RmakeError('resolver cache at %s is locked'
+                                    % self.path)
+        stats.update(entries=entries, size=size or 0)
+        return stats
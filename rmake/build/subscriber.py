@@ -69,14 +69,26 @@ class _JobDbLogger(_InternalSubscriber):
         'TROVE_LOG_UPDATED'      : 'troveLogUpdated',
     }
 
+    # events that clients act on once they see them, so their state must
+    # be in the database before they are passed on.
+    flushEvents = set(['JOB_STATE_UPDATED', 'JOB_TROVES_SET', 'JOB_COMMITTED',
+                       'TROVE_BUILT', 'TROVE_FAILED'])
+
     def __init__(self, db):
         self.db = db
         _InternalSubscriber.__init__(self)
 
     def _receiveEvents(self, apiVersion, eventList):
-        self.db.commitAfter(
-            _InternalSubscriber._receiveEvents, self,
-            apiVersion, eventList)
+        if not self.db.isWriteBehindEnabled():
+            self.db.commitAfter(
+                _InternalSubscriber._receiveEvents, self,
+                apiVersion, eventList)
+            return
+        _InternalSubscriber._receiveEvents(self, apiVersion, eventList)
+        for event, data in eventList:
+            if event[0] in self.flushEvents:
+                self.db.flushStateWrites()
+                break
 
     def trovePreparingChroot(self, trove, host, path):
         self.db.trovePreparingChroot(trove)
@@ -735,7 +735,8 @@ class ListCommand(rMakeCommand):
     List information about the given rmake server.
 
     Types Available:
-        list [ch]roots - lists chroots on this rmake server"""
+        list [ch]roots - lists chroots on this rmake server
+        list chrootcache - lists cached chroots on this rmake server"""
     commands = ['list']
     paramHelp = "<type>"
     help = 'List various information about this rmake server'
@@ -762,6 +763,9 @@ class ListCommand(rMakeCommand):
         allChroots = not argSet.pop('active', False)
         query.listChroots(client, cfg, allChroots=allChroots)
     listRoots = listChroots
+
+    def listChrootcache(self, client, cfg, argSet):
+        query.listChrootCache(client, cfg)
 register(ListCommand)
 
 class ChrootCommand(rMakeCommand):
@@ -24,6 +24,9 @@ import time
 from rmake.build import buildjob, buildtrove
 from rmake.subscribers import xmlrpc
 
+# most build log to fetch per poll, so a long log doesn't stall the monitor
+LOG_CHUNK_SIZE = 64 * 1024
+
 def _getUri(client):
     if not isinstance(client.uri, str) or client.uri.startswith('unix://'):
         fd, tmpPath = tempfile.mkstemp()
@@ -139,14 +142,18 @@ class JobLogDisplay(_AbstractDisplay):
         for (jobId, troveTuple), (mark, tail) in self.buildingTroves.items():
             if not tail:
                 continue
-            try:
-                moreData, data, mark = self.client.getTroveBuildLog(jobId,
-                                                                    troveTuple,
-                                                                    mark)
-            except:
-                moreData = True
-                data = ''
-            self.out.write(data)
+            # read chunk by chunk until the end of the log, so that the
+            # tail of a log is not lost when the trove stops building.
+            while True:
+                try:
+                    moreData, data, mark = self.client.getTroveBuildLog(jobId,
+                                    troveTuple, mark, maxSize=LOG_CHUNK_SIZE)
+                except:
+                    moreData = True
+                    data = ''
+                self.out.write(data)
+                if len(data) < LOG_CHUNK_SIZE:
+                    break
             if not moreData:
                 del self.buildingTroves[jobId, troveTuple]
             else:
@@ -191,13 +198,13 @@ class JobLogDisplay(_AbstractDisplay):
         self._msg('[%d] - %s - %s' % (jobId, troveTuple[0], msg))
 
     def _primeOutput(self, jobId):
-        logMark = 0
+        logId = 0
         while True:
-            newLogs = self.client.getJobLogs(jobId, logMark)
+            newLogs = self.client.getJobLogsSince(jobId, logId)
             if not newLogs:
                 break
-            logMark += len(newLogs)
-            for (timeStamp, message, args) in newLogs:
+            logId = newLogs[-1][0]
+            for (_, timeStamp, message, args) in newLogs:
                 print '[%s] [%s] - %s' % (timeStamp, jobId, message)
 
         BUILDING = buildtrove.TROVE_STATE_BUILDING
@@ -62,7 +62,9 @@ class DisplayConfig(object):
         self.showTracebacks = showTracebacks
         self.showConfig = showConfig
 
-        self.needTroves = displayTroves or displayJobDetail or showBuildLogs
+        # job details only need trove counts, which come from the much
+        # cheaper job summary.
+        self.needTroves = displayTroves or showBuildLogs
 
     def getClient(self):
         return self.client
@@ -97,7 +99,8 @@ def getJobsToDisplay(dcfg, client, jobId=None, troveSpecs=None,
         jobList = client.client.getJobs(jobIds,
                                         withTroves=dcfg.needTroves)
     else:
-        jobList = [ client.client.getJob(jobId, withConfigs = withConfigs) ]
+        jobList = [ client.client.getJob(jobId, withTroves=dcfg.needTroves,
+                                         withConfigs=withConfigs) ]
 
     newJobList = []
     if troveSpecs:
@@ -230,13 +233,20 @@ def displayOneJob(dcfg, job, troveTupList, out=sys.stdout):
 def displayJobDetail(dcfg, job, out=sys.stdout):
     def write(txt=''):
         return out.write(txt + '\n')
-    total   = len(list(job.iterTroves()))
-    unbuilt  = len(list(job.iterUnbuiltTroves()))
-    preparing = len(list(job.iterPreparingTroves()))
-    building = len(list(job.iterBuildingTroves()))
-    waiting = len(list(job.iterWaitingTroves()))
-    built    = len(list(job.iterBuiltTroves()))
-    failed   = len(list(job.iterFailedTroves()))
+    counts = getTroveCounts(dcfg, job)
+    def count(*states):
+        return sum(counts.get(x, 0) for x in states)
+    unbuilt  = count(buildtrove.TROVE_STATE_INIT,
+                     buildtrove.TROVE_STATE_BUILDABLE,
+                     buildtrove.TROVE_STATE_WAITING,
+                     buildtrove.TROVE_STATE_RESOLVING,
+                     buildtrove.TROVE_STATE_PREPARING)
+    preparing = count(buildtrove.TROVE_STATE_PREPARING)
+    building = count(buildtrove.TROVE_STATE_BUILDING)
+    waiting = count(buildtrove.TROVE_STATE_WAITING)
+    built    = count(buildtrove.TROVE_STATE_BUILT)
+    failed   = count(buildtrove.TROVE_STATE_FAILED,
+                     buildtrove.TROVE_STATE_UNBUILDABLE)
 
     write('%-4s   State:    %-20s' % (job.jobId, job.getStateName()))
     write('       Status:   %-20s' % job.status)
@@ -253,6 +263,18 @@ def displayJobDetail(dcfg, job, out=sys.stdout):
     write('       Built:    %-20s Failed:   %s' % (built, failed))
     write()
 
+def getTroveCounts(dcfg, job):
+    """
+        Return the number of troves in each state for job, from its troves
+        if they were retrieved and from the job summary otherwise.
+    """
+    if dcfg.needTroves:
+        counts = {}
+        for trove in job.iterTroves():
+            counts[trove.state] = counts.get(trove.state, 0) + 1
+        return counts
+    return dcfg.getClient().client.getJobSummary(job.jobId)['troveCounts']
+
 def printTroves(dcfg, job, troveTupList, out=sys.stdout):
     if troveTupList or dcfg.displayTroveDetail:
         if troveTupList is None:
@@ -338,15 +360,15 @@ def printOneTrove(dcfg, job, trove, indent='       ', out=sys.stdout):
     displayTroveDetail(dcfg, job, trove, indent, out)
     if dcfg.showLogs:
         client = dcfg.getClient()
-        mark = 0
+        logId = 0
         while True:
-            logs = client.client.getTroveLogs(job.jobId,
+            logs = client.client.getTroveLogsSince(job.jobId,
                                               trove.getNameVersionFlavor(True),
-                                              mark)
+                                              logId)
             if not logs:
                 break
-            mark += len(logs)
-            for (timeStamp, message, args) in logs:
+            logId = logs[-1][0]
+            for (_, timeStamp, message, args) in logs:
                 out.write('[%s] %s\n' % (timeStamp, message))
 
     if dcfg.showBuildLogs:
@@ -442,3 +464,22 @@ def displayChroot(chroot):
         jobInfo = '[Unknown]'
 
     print '   %-18s %s' % (name, jobInfo)
+
+def listChrootCache(client, cfg):
+    entries = client.client.listChrootCache()
+    if not entries:
+        print 'No cached chroots'
+        return
+    print '%-40s %10s %-20s %-20s %5s' % ('Fingerprint', 'Size (MB)',
+                                          'Created', 'Last Used', 'Hits')
+    for fingerprint, size, created, lastUsed, hits in entries:
+        print '%-40s %10.1f %-20s %-20s %5d' % (fingerprint,
+                size / 1048576.0,
+                time.strftime('%x %X', time.localtime(created)),
+                time.strftime('%x %X', time.localtime(lastUsed)),
+                hits)
+    totalSize = sum(x[1] for x in entries)
+    totalHits = sum(x[4] for x in entries)
+    print
+    print '%d cached chroots, %.1f MB, %d restores' % (len(entries),
+                                            totalSize / 1048576.0, totalHits)
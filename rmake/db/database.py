@@ -17,6 +17,7 @@
 
 import itertools
 import os
+import time
 
 from conary.lib.sha1helper import md5FromString
 from conary import dbstore
@@ -106,6 +107,11 @@ class Database(DBInterface):
         self.subscriberStore = subscriber.SubscriberData(self)
         self.nodeStore = nodestore.NodeStore(self)
 
+        self._writeBehind = None
+        self._resetStateWrites()
+        self._writeStats = dict(commits=0, writes=0, coalesced=0,
+                                commitTime=0.0, maxCommitTime=0.0)
+
     def loadSchema(self, migrate=True):
         if migrate:
             return schema.SchemaManager(self.db).loadAndMigrate()
@@ -116,6 +122,122 @@ class Database(DBInterface):
         return dbstore.connect(self.dbpath, driver=self.driver, timeout=120000,
                                lockJournal=True)
 
+    def reopen(self):
+        # pending writes belong to the parent process, which will
+        # flush them itself.
+        self._writeBehind = None
+        self._resetStateWrites()
+        DBInterface.reopen(self)
+
+    def close(self):
+        self._writeBehind = None
+        self._resetStateWrites()
+        DBInterface.close(self)
+
+    # --- write-behind journal for job and trove state
+
+    def enableWriteBehind(self, maxDelay=0.2, maxWrites=100):
+        """
+            Queue job and trove state writes instead of committing each
+            one.  Queued writes are committed in a single transaction once
+            C{maxWrites} are pending or the oldest has waited C{maxDelay}
+            seconds, and whenever L{flushStateWrites} is called.  Repeated
+            updates of a job or trove that is already queued are
+            coalesced into one write of its latest state.
+
+            Readers in other processes may see state up to C{maxDelay}
+            seconds old, so callers must flush before handing off state
+            that others depend on.
+        """
+        self._writeBehind = (maxDelay, maxWrites)
+
+    def isWriteBehindEnabled(self):
+        return bool(self._writeBehind)
+
+    def _resetStateWrites(self):
+        self._pendingWrites = []
+        self._pendingKeys = {}
+        self._firstPending = None
+
+    def _queueWrite(self, key, fn, *args):
+        if not self._writeBehind:
+            fn(*args)
+            return
+        if key is not None:
+            idx = self._pendingKeys.get(key, None)
+            if idx is not None:
+                # the journaled write stores whatever state the object has
+                # when it is flushed, so keep the newest object.
+                self._pendingWrites[idx] = (fn, args)
+                self._writeStats['coalesced'] += 1
+                return
+            self._pendingKeys[key] = len(self._pendingWrites)
+        if not self._pendingWrites:
+            self._firstPending = time.time()
+        self._pendingWrites.append((fn, args))
+
+    def _queueJobWrite(self, job):
+        self._queueWrite(('job', job.jobId), self.jobStore.updateJob, job)
+
+    def _queueTroveWrite(self, trove):
+        key = ('trove', trove.jobId, trove.getNameVersionFlavor(True))
+        self._queueWrite(key, self.jobStore.updateTrove, trove)
+
+    def _commitStateWrites(self):
+        if not self._writeBehind:
+            self.commit()
+            return
+        maxDelay, maxWrites = self._writeBehind
+        if (len(self._pendingWrites) >= maxWrites
+            or time.time() - self._firstPending >= maxDelay):
+            self.flushStateWrites()
+
+    def checkStateWrites(self):
+        """
+            Commits queued state writes if they have waited long enough.
+            Meant to be called periodically from a main loop.
+        """
+        if self._pendingWrites:
+            self._commitStateWrites()
+
+    def flushStateWrites(self):
+        """
+            Commits all queued job and trove state writes in one
+            transaction.
+        """
+        if not self._pendingWrites:
+            return
+        pending = self._pendingWrites
+        self._resetStateWrites()
+        if self._holdCommits:
+            # part of a larger transaction, which will be committed by
+            # whoever is holding it.
+            self._runWrites(pending)
+            return
+        start = time.time()
+        self.commitAfter(self._runWrites, pending)
+        elapsed = time.time() - start
+        stats = self._writeStats
+        stats['commits'] += 1
+        stats['writes'] += len(pending)
+        stats['commitTime'] += elapsed
+        stats['maxCommitTime'] = max(stats['maxCommitTime'], elapsed)
+
+    def _runWrites(self, pending):
+        for fn, args in pending:
+            fn(*args)
+
+    def getStateWriteStats(self):
+        """
+            Returns a dict with the number of journal commits, the number
+            of writes they contained, the number of writes that were
+            coalesced away, the total and maximum commit time in seconds
+            and the number of writes still pending.
+        """
+        stats = dict(self._writeStats)
+        stats['pending'] = len(self._pendingWrites)
+        return stats
+
     def subscribeToJob(self, job):
         """ 
             Watches updates to this job object and will record them
@@ -155,6 +277,9 @@ class Database(DBInterface):
         except KeyError, err:
             raise errors.JobNotFound(err.args[0])
 
+    def getJobSummary(self, jobId):
+        return self.jobStore.getJobSummary(jobId)
+
     def getTrove(self, jobId, name, version, flavor, context=''):
         try:
             return self.jobStore.getTrove(jobId, name, version, flavor, context)
@@ -264,7 +389,7 @@ class Database(DBInterface):
         return self.jobStore.isJobBuilding()
 
     def hasTroveBuildLog(self, trove):
-        if ((trove.logPath and os.path.exists(trove.logPath)) 
+        if ((trove.logPath and logstore.logExists(trove.logPath))
              or self.logStore.hasTroveLog(trove)):
             return True
         return False
@@ -272,7 +397,7 @@ class Database(DBInterface):
     def openTroveBuildLog(self, trove):
         if trove.logPath:
             try:
-                return open(trove.logPath, 'r')
+                return logstore.openLog(trove.logPath)
             except (IOError, OSError), err:
                 raise errors.RmakeError('Could not open log for %s=%s[%s] from %s: %s' % (trove.getNameVersionFlavor() + (trove.jobId, err)))
         else:
@@ -283,46 +408,50 @@ class Database(DBInterface):
                                       (trove.jobId,)))
 
     def updateJobStatus(self, job):
-        self.jobStore.updateJobLog(job, job.status)
-        self.jobStore.updateJob(job)
-        self.commit()
+        self._queueWrite(None, self.jobStore.updateJobLog, job, job.status)
+        self._queueJobWrite(job)
+        self._commitStateWrites()
 
     def updateJobLog(self, job, message):
-        self.jobStore.updateJobLog(job, message)
-        self.jobStore.updateJob(job)
-        self.commit()
+        self._queueWrite(None, self.jobStore.updateJobLog, job, message)
+        self._queueJobWrite(job)
+        self._commitStateWrites()
 
     def updateTroveLog(self, trove, message):
-        self.jobStore.updateTroveLog(trove, message)
-        self.jobStore.updateTrove(trove)
-        self.commit()
+        self._queueWrite(None, self.jobStore.updateTroveLog, trove, message)
+        self._queueTroveWrite(trove)
+        self._commitStateWrites()
 
     def updateTrove(self, trove):
-        self.jobStore.updateTrove(trove)
-        self.commit()
+        self._queueTroveWrite(trove)
+        self._commitStateWrites()
 
     def setBuildTroves(self, job):
+        # replaces all the troves, so anything queued for them must be
+        # written first.
+        self.flushStateWrites()
         self.jobStore.setBuildTroves(job)
         self.commit()
 
     def trovePreparingChroot(self, trove):
-        self.jobStore.updateTrove(trove)
-        self.nodeStore.setChrootActive(trove, True)
-        self.commit()
+        self._queueTroveWrite(trove)
+        self._queueWrite(None, self.nodeStore.setChrootActive, trove, True)
+        self._commitStateWrites()
 
     def troveResolving(self, trove):
-        self.jobStore.updateTrove(trove)
-        self.commit()
+        self._queueTroveWrite(trove)
+        self._commitStateWrites()
 
     def troveBuilding(self, trove):
-        self.jobStore.updateTrove(trove)
-        self.nodeStore.setChrootActive(trove, True)
-        self.commit()
+        self._queueTroveWrite(trove)
+        self._queueWrite(None, self.nodeStore.setChrootActive, trove, True)
+        self._commitStateWrites()
 
     def troveBuilt(self, trove):
-        self.jobStore.updateTrove(trove)
-        self.jobStore.setBinaryTroves(trove, trove.getBinaryTroves())
-        self.commit()
+        self._queueTroveWrite(trove)
+        self._queueWrite(None, self.jobStore.setBinaryTroves, trove,
+                         trove.getBinaryTroves())
+        self._commitStateWrites()
 
     def jobCommitted(self, job,  troveMap):
         for trove in job.iterTroves():
@@ -331,18 +460,20 @@ class Database(DBInterface):
                 binaries = [ x for x in committedTups
                              if not x[0].endswith(':source') ]
                 if binaries:
-                    self.jobStore.setBinaryTroves(trove, binaries)
-        self.commit()
+                    self._queueWrite(None, self.jobStore.setBinaryTroves,
+                                     trove, binaries)
+        self._commitStateWrites()
 
     def troveFailed(self, trove):
-        self.jobStore.updateTrove(trove)
-        self.commit()
+        self._queueTroveWrite(trove)
+        self._commitStateWrites()
 
     def updateTroveStatus(self, trove):
-        self.jobStore.updateTrove(trove)
+        self._queueTroveWrite(trove)
         if trove.isFinished():
-            self.nodeStore.setChrootActive(trove, False)
-        self.commit()
+            self._queueWrite(None, self.nodeStore.setChrootActive, trove,
+                             False)
+        self._commitStateWrites()
 
     # return all the log messages since last mark
     def getJobLogs(self, jobId, mark = 0):
@@ -351,19 +482,56 @@ class Database(DBInterface):
     def getTroveLogs(self, jobId, troveTuple, mark = 0):
         return self.jobStore.getTroveLogs(jobId, troveTuple, mark=mark)
 
-    def getTroveBuildLog(self, jobId, troveTuple, mark):
+    def getJobLogsSince(self, jobId, logId=0):
+        return self.jobStore.getJobLogsSince(jobId, logId)
+
+    def getTroveLogsSince(self, jobId, troveTuple, logId=0):
+        return self.jobStore.getTroveLogsSince(jobId, troveTuple, logId)
+
+    def getTroveBuildLog(self, jobId, troveTuple, mark, maxSize=None,
+                         timeout=0):
+        """
+            Return (moreData, data, newMark) for the build log of a trove,
+            starting at C{mark} (or C{-mark} bytes from the end if negative).
+            moreData is True if the trove is still building or the log
+            was not read to the end.
+
+            At most C{maxSize} bytes are returned if given.  If the trove
+            is still building and there is no data past C{mark}, wait up
+            to C{timeout} seconds for more to be written.
+        """
         jobId = self.convertToJobId(jobId)
         trove = self.getTrove(jobId, *troveTuple)
-        if not self.hasTroveBuildLog(trove):
-            return not trove.isFinished(), '', 0
+        deadline = time.time() + timeout
+        while not self.hasTroveBuildLog(trove):
+            if trove.isFinished() or time.time() >= deadline:
+                return not trove.isFinished(), '', 0
+            time.sleep(.1)
+            trove = self.getTrove(jobId, *troveTuple)
         f = self.openTroveBuildLog(trove)
+        f.seek(0, 2)
+        end = f.tell()
         if mark < 0:
+            mark = max(end + mark, 0)
+        lastCheck = time.time()
+        while end <= mark and not trove.isFinished():
+            now = time.time()
+            if now >= deadline:
+                break
+            if now - lastCheck >= 1:
+                trove = self.getTrove(jobId, *troveTuple)
+                lastCheck = now
+            time.sleep(.1)
             f.seek(0, 2)
             end = f.tell()
-            f.seek(max(end + mark, 0))
+        f.seek(mark)
+        if maxSize:
+            data = f.read(maxSize)
         else:
-            f.seek(mark)
-        return not trove.isFinished(), f.read(), f.tell()
+            data = f.read()
+        # a finished trove still has more to give if we stopped at maxSize
+        moreData = not trove.isFinished() or f.tell() < end
+        return moreData, data, f.tell()
 
     def addNode(self, name, host, slots, buildFlavors, chrootPaths):
         self.nodeStore.addNode(name, host, slots, buildFlavors)
@@ -205,6 +205,33 @@ class JobStore(object):
 
         return [jobsById[jobId] for jobId in jobIdList]
 
+    def getJobSummary(self, jobId):
+        """
+            Return a compact summary of the troves in a job, read straight
+            from BuildTroves without building any BuildTrove objects.
+
+            The summary is a dict with C{troveCounts}, a list of
+            (state, count) pairs, and the C{names}, C{contexts},
+            C{states}, C{starts} and C{finishes} of the troves as parallel
+            lists.
+        """
+        cu = self.db.cursor()
+        cu.execute("""SELECT state, COUNT(*) FROM BuildTroves
+                      WHERE jobId=? GROUP BY state""", jobId)
+        troveCounts = [ tuple(x) for x in cu ]
+        cu.execute("""SELECT troveName, context, state, start, finish
+                      FROM BuildTroves WHERE jobId=?
+                      ORDER BY troveName, context""", jobId)
+        names, contexts, states, starts, finishes = [], [], [], [], []
+        for name, context, state, start, finish in cu:
+            names.append(name)
+            contexts.append(context)
+            states.append(state)
+            starts.append(float(start))
+            finishes.append(float(finish))
+        return dict(troveCounts=troveCounts, names=names, contexts=contexts,
+                    states=states, starts=starts, finishes=finishes)
+
     def getConfig(self, jobId, context):
         cu = self.db.cursor()
         cu.execute("""SELECT  key, value
@@ -336,13 +363,8 @@ class JobStore(object):
 
     # return all the log messages since last mark
     def getTroveLogs(self, jobId, troveTuple, mark = 0):
-        if len(troveTuple) == 3:
-            (name, version, flavor) = troveTuple
-            context = ''
-        else:
-            (name, version, flavor, context) = troveTuple
         cu = self.db.cursor()
-        troveId = self._getTroveId(cu, jobId, name, version, flavor, context)
+        troveId = self._getLogTroveId(cu, jobId, troveTuple)
         ret = []
         cu.execute("""
         SELECT changed, message, args FROM StateLogs
@@ -350,6 +372,39 @@ class JobStore(object):
         """, (jobId, troveId, 100, mark))
         return cu.fetchall()
 
+    def getJobLogsSince(self, jobId, logId=0, limit=100):
+        """
+            Return up to C{limit} job log messages with an id greater
+            than C{logId}, as (logId, changed, message, args) tuples.
+            Unlike getJobLogs, the cost does not grow with the number of
+            messages already read.
+        """
+        cu = self.db.cursor()
+        cu.execute("""
+        SELECT logId, changed, message, args FROM StateLogs
+        WHERE jobId = ? AND troveId IS NULL AND logId > ?
+        ORDER BY logId LIMIT ?
+        """, (jobId, logId, limit))
+        return cu.fetchall()
+
+    def getTroveLogsSince(self, jobId, troveTuple, logId=0, limit=100):
+        cu = self.db.cursor()
+        troveId = self._getLogTroveId(cu, jobId, troveTuple)
+        cu.execute("""
+        SELECT logId, changed, message, args FROM StateLogs
+        WHERE jobId = ? AND troveId = ? AND logId > ?
+        ORDER BY logId LIMIT ?
+        """, (jobId, troveId, logId, limit))
+        return cu.fetchall()
+
+    def _getLogTroveId(self, cu, jobId, troveTuple):
+        if len(troveTuple) == 3:
+            (name, version, flavor) = troveTuple
+            context = ''
+        else:
+            (name, version, flavor, context) = troveTuple
+        return self._getTroveId(cu, jobId, name, version, flavor, context)
+
     def getJobConfig(self, jobId):
         cu = self.db.cursor()
         d = {}
@@ -476,22 +531,27 @@ class JobStore(object):
                   recipeType=trove.recipeType,
                   buildType=trove.buildType,
                   chrootId=chrootId)
+        troveId = self._getTroveId(cu, trove.jobId,
+                                   *trove.getNameVersionFlavor(True))
         fieldList = '=?, '.join(kw) + '=?'
         valueList = kw.values()
-        valueList += (trove.jobId, trove.getName(),
-                      trove.getVersion().freeze(),
-                      trove.getFlavor().freeze(),
-                      trove.getContext())
+        valueList.append(troveId)
 
         cu.execute("""UPDATE BuildTroves
                       SET %s
-                      WHERE jobId=? AND troveName=? AND version=? 
-                            AND flavor=? AND context=?
+                      WHERE troveId=?
                    """ % fieldList, valueList)
-        troveId = self._getTroveId(cu, trove.jobId,
-                                   *trove.getNameVersionFlavor(True))
         className, settings = freeze('TroveSettings', trove.settings)
         settings['_class'] = [className]
+        # settings rarely change after the trove is added, so only
+        # rewrite them when they have.
+        newRows = sorted((key, idx, value)
+                         for key, values in settings.iteritems()
+                         for idx, value in enumerate(values))
+        cu.execute('SELECT key, ord, value FROM TroveSettings'
+                   ' WHERE troveId=?', troveId)
+        if sorted(tuple(x) for x in cu) == newRows:
+            return
         cu.execute('DELETE FROM TroveSettings WHERE troveId=?', troveId)
         for key, values in settings.iteritems():
             for idx, value in enumerate(values):
@@ -15,14 +15,168 @@
 #
 
 
+"""
+Storage for trove build logs.
+
+Logs are written uncompressed while their trove builds.  Once finished,
+they can be compressed with compressLog(), which splits the log into
+blocks that are compressed independently and writes an index of where
+each block starts.  CompressedLogFile uses the index to seek to any
+offset, including from the end, and only decompresses the blocks that
+are read.
+
+Compressed log layout::
+
+    MAGIC
+    zlib block 0 ... zlib block N
+    marshalled index: [(offset, compressedOffset, compressedSize), ...]
+    trailer: struct '!QQ' (index offset, uncompressed size)
+"""
+
+import bisect
+import errno
+import marshal
+import os
+import struct
+import tempfile
+import zlib
+
 from conary.lib import sha1helper
 from conary.lib import util
 from conary.repository import datastore
 
+COMPRESSED_SUFFIX = '.blk'
+MAGIC = 'RMAKELOG1\n'
+BLOCK_SIZE = 256 * 1024
+TRAILER = '!QQ'
+TRAILER_SIZE = struct.calcsize(TRAILER)
+
+
+def compressLog(path, blockSize=BLOCK_SIZE):
+    """
+        Replace the uncompressed log at C{path} with a compressed one at
+        C{path + COMPRESSED_SUFFIX}.  Returns the (uncompressed, compressed)
+        sizes, or None if there was no uncompressed log.
+    """
+    try:
+        inF = open(path, 'rb')
+    except IOError, err:
+        if err.errno != errno.ENOENT:
+            raise
+        return None
+    fd, tmpPath = tempfile.mkstemp(dir=os.path.dirname(path),
+                                   prefix='.compress-')
+    try:
+        outF = os.fdopen(fd, 'wb')
+        outF.write(MAGIC)
+        index = []
+        offset = 0
+        while True:
+            data = inF.read(blockSize)
+            if not data:
+                break
+            compressed = zlib.compress(data, 6)
+            index.append((offset, outF.tell(), len(compressed)))
+            outF.write(compressed)
+            offset += len(data)
+        indexOffset = outF.tell()
+        outF.write(marshal.dumps(index))
+        outF.write(struct.pack(TRAILER, indexOffset, offset))
+        compressedSize = outF.tell()
+        outF.close()
+        os.chmod(tmpPath, os.stat(path).st_mode & 0777)
+        os.rename(tmpPath, path + COMPRESSED_SUFFIX)
+    except:
+        util.removeIfExists(tmpPath)
+        raise
+    inF.close()
+    os.unlink(path)
+    return offset, compressedSize
+
+
+def openLog(path):
+    """
+        Open the log at C{path}, whether or not it has been compressed.
+    """
+    try:
+        return open(path, 'r')
+    except IOError, err:
+        if (err.errno != errno.ENOENT
+            or not os.path.exists(path + COMPRESSED_SUFFIX)):
+            raise
+    return CompressedLogFile(path + COMPRESSED_SUFFIX)
+
+
+def logExists(path):
+    return (os.path.exists(path)
+            or os.path.exists(path + COMPRESSED_SUFFIX))
+
+
+class CompressedLogFile(object):
+    """
+        Read-only file object for a log written by compressLog().
+    """
+    def __init__(self, path):
+        self.name = path
+        self.f = open(path, 'rb')
+        if self.f.read(len(MAGIC)) != MAGIC:
+            self.f.close()
+            raise IOError('%s is not a compressed log' % path)
+        self.f.seek(-TRAILER_SIZE, 2)
+        trailerOffset = self.f.tell()
+        indexOffset, self.size = struct.unpack(TRAILER,
+                                               self.f.read(TRAILER_SIZE))
+        self.f.seek(indexOffset)
+        self.index = marshal.loads(self.f.read(trailerOffset - indexOffset))
+        self.offsets = [ x[0] for x in self.index ]
+        self.pos = 0
+        self._block = None
+        self._blockData = None
+
+    def close(self):
+        self.f.close()
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=0):
+        if whence == 1:
+            offset += self.pos
+        elif whence == 2:
+            offset += self.size
+        if offset < 0:
+            raise IOError(errno.EINVAL, 'Invalid argument')
+        self.pos = offset
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = self.size
+        else:
+            end = min(self.pos + size, self.size)
+        chunks = []
+        while self.pos < end:
+            blockIdx = bisect.bisect_right(self.offsets, self.pos) - 1
+            data = self._getBlock(blockIdx)
+            start = self.pos - self.offsets[blockIdx]
+            chunk = data[start:start + end - self.pos]
+            chunks.append(chunk)
+            self.pos += len(chunk)
+        return ''.join(chunks)
+
+    def _getBlock(self, blockIdx):
+        if blockIdx != self._block:
+            offset, compressedOffset, compressedSize = self.index[blockIdx]
+            self.f.seek(compressedOffset)
+            self._blockData = zlib.decompress(self.f.read(compressedSize))
+            self._block = blockIdx
+        return self._blockData
+
+
 class DeletableDataStore(datastore.DataStore):
     def deleteFile(self, hash):
         path = self.hashToPath(hash)
         util.removeIfExists(path)
+        util.removeIfExists(path + COMPRESSED_SUFFIX)
 
 class LogStore(object):
     def __init__(self, path):
@@ -47,12 +201,25 @@ class LogStore(object):
         trove.logPath = ''
 
     def hasTroveLog(self, trove):
-        hash = self.hashTrove(trove)
-        return self.store.hasFile(hash)
+        return logExists(self.getTrovePath(trove))
 
     def openTroveLog(self, trove):
-        hash = self.hashTrove(trove)
-        return self.store.openFile(hash)
+        return openLog(self.getTrovePath(trove))
+
+    def compressTroveLog(self, trove):
+        return compressLog(self.getTrovePath(trove))
+
+    def iterUncompressedLogs(self):
+        """
+            Yield the paths of all logs in the store that have not been
+            compressed yet.
+        """
+        for dirPath, dirNames, fileNames in os.walk(self.store.top):
+            for fileName in fileNames:
+                if (fileName.startswith('.')
+                    or fileName.endswith(COMPRESSED_SUFFIX)):
+                    continue
+                yield os.path.join(dirPath, fileName)
 
     def deleteLogs(self, troveInfoList):
         hashes = [ self.hashTroveInfo(*x) for x in troveInfoList ]
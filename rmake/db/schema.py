@@ -22,7 +22,7 @@ SQL schema for the persistent DB store for rmake
 from rmake import errors
 
 
-SCHEMA_VERSION = 12
+SCHEMA_VERSION = 13
 
 def createJobs(db):
     cu = db.cursor()
@@ -43,6 +43,8 @@ def createJobs(db):
         )""" % db.keywords)
         db.tables["Jobs"] = []
         commit = True
+    if db.createIndex("Jobs", "JobsStateIdx", "state", unique = False):
+        commit = True
     return commit
 
 def createJobConfig(db):
@@ -237,7 +239,10 @@ def createStateLogs(db):
         )""" % db.keywords)
         db.tables["StateLogs"] = []
         commit = True
-    if db.createIndex("StateLogs", "StateLogsJobTroveId", "jobId,troveId"):
+    # logId is included so that reading the logs after a given message
+    # is a single index range scan.
+    if db.createIndex("StateLogs", "StateLogsJobTroveLogIdx",
+                      "jobId,troveId,logId"):
         commit = True
 
     return commit
@@ -274,6 +279,10 @@ def createChroots(db):
         commit = True
     if db.createIndex("Chroots", "ChrootdsIdx", "troveId"):
         commit = True
+    # covers the active chroot lookups made when counting free slots
+    if db.createIndex("Chroots", "ChrootsActiveIdx",
+                      "active,nodeName,troveId"):
+        commit = True
 
     return commit
 
@@ -531,6 +540,15 @@ class Migrator(AbstractMigrator):
             cu.execute("UPDATE StateLogs SET troveId = NULL WHERE troveId = 0")
         return 12
 
+    def migrateFrom12(self):
+        # the log index now includes logId, replacing the old one
+        if 'StateLogsJobTroveId' in self.db.tables['StateLogs']:
+            self.db.dropIndex('StateLogs', 'StateLogsJobTroveId')
+        createJobs(self.db)
+        createStateLogs(self.db)
+        createChroots(self.db)
+        return 13
+
 class PluginSchemaManager(AbstractSchemaManager):
     """
         Not used at the moment but here's a way to add plugin-specific tables
@@ -38,7 +38,9 @@ from apiutils that describe how to convert its parameters.
 Server methods also will be passed in callData that includes the
 calling version of the method.
 """
+import collections
 import itertools
+import os
 import select
 import socket
 import sys
@@ -52,6 +54,7 @@ from rmake import constants, errors
 
 from rmake.lib import apiutils
 from rmake.lib import localrpc
+from rmake.lib import pipereader
 from rmake.lib import rpclib
 from rmake.lib import rpcproxy
 from rmake.lib import server
@@ -124,11 +127,18 @@ class ApiServer(server.Server):
     _apiMinorVersion = constants.apiMinorVersion
 
     _debug = False
-    def __init__(self, logger=None, forkByDefault = False):
+    def __init__(self, logger=None, forkByDefault = False, poolSize=0):
+        """
+            @param poolSize: number of pre-forked processes that answer
+            methods marked api_readonly.  If 0, those methods fork (or not)
+            like any other.
+        """
         if logger is None:
             logger = BaseRPCLogger('server')
         server.Server.__init__(self, logger)
         self._forkByDefault = forkByDefault
+        self._poolSize = poolSize
+        self._pool = None
         self._methods = {}
         self._addMethods(self)
 
@@ -173,6 +183,49 @@ class ApiServer(server.Server):
             return method.forking
         return self._forkByDefault
 
+    def _shouldMethodUsePool(self, method):
+        return self._pool is not None and getattr(method, 'readOnly', False)
+
+    def _startPool(self):
+        self._pool = ApiWorkerPool(self, self._poolSize)
+        self._pool.start()
+
+    def _serveApiWorker(self, reader, writer):
+        """
+            Main loop of a pooled worker process: answer calls sent by the
+            server over reader until it is closed.
+        """
+        while reader.fd is not None:
+            request = reader.handleReadIfReady(sleep=None)
+            if request is None:
+                continue
+            try:
+                response = self._callPooledMethod(*request)
+            except Exception, err:
+                response = (False, _freezeException(err))
+            writer.send(rpclib.serializeResponse(response))
+            writer.flush()
+
+    def _callPooledMethod(self, methodName, auth, callData, args):
+        method = self._getMethod(methodName)
+        # the caller was authorized by the server process; only a
+        # description of them is passed on.
+        callData = CallData(auth, callData, self._logger, method, None,
+                            debug=self._debug)
+        args = _thawParams(method, args, callData.getMethodVersion())
+        return callData.callFunction(method, callData, *args)
+
+    def _pidDied(self, pid, status, name=None):
+        server.Server._pidDied(self, pid, status, name)
+        if self._pool is not None:
+            self._pool.workerDied(pid)
+
+    def _close(self):
+        if self._pool is not None:
+            self._pool.close()
+            self._pool = None
+        server.Server._close(self)
+
     def _dispatch2(self, methodName, auth, responseHandler, args):
         """Dispatches call to methodName, unfreezing data in args, checking
            method version as well.
@@ -186,6 +239,7 @@ class ApiServer(server.Server):
         callData = CallData(auth, args[0], self._logger, method,
                             responseHandler, debug=self._debug,
                             authMethod=self._authCheck)
+        rawArgs = args
         args = args[1:]
         apiMajorVersion = callData.getApiMajorVersion()
         apiMinorVersion = callData.getApiMinorVersion()
@@ -205,7 +259,13 @@ class ApiServer(server.Server):
 
         timestr = time.strftime('%x %X')
         self._logger.logRPCCall(callData, methodName, args)
-        if self._shouldMethodFork(method):
+        if self._shouldMethodUsePool(method):
+            self._authCheck(callData, method, callData, *args)
+            self._pool.submit(responseHandler,
+                              (methodName, str(auth), rawArgs[0],
+                               list(rawArgs[1:])))
+            responseHandler.sendResponse(rpclib.DelayedResponse())
+        elif self._shouldMethodFork(method):
             responseHandler.forkResponseFn(lambda: self._fork(methodName),
                                            callData.callFunction, method,
                                            callData, *args)
@@ -233,12 +293,14 @@ class XMLApiServer(ApiServer):
     # the console before returning them across the wire
 
     def __init__(self, uri=None, logger=None, forkByDefault=False, 
-                 sslCertificate=None, caCertificate=None, localOnly=False):
+                 sslCertificate=None, caCertificate=None, localOnly=False,
+                 poolSize=0):
         """ @param serverObj: The XMLRPCServer that will serve data to 
             the _dispatch method.  If None, caller is responsible for 
             giving information to be dispatched.
         """
-        ApiServer.__init__(self, logger, forkByDefault=forkByDefault)
+        ApiServer.__init__(self, logger, forkByDefault=forkByDefault,
+                           poolSize=poolSize)
         self.uri = uri
         if uri:
             if isinstance(uri, str):
@@ -290,12 +352,168 @@ class XMLApiServer(ApiServer):
             self.server.server_close()
 
     def handleRequestIfReady(self, sleepTime=0.1):
+        if self._poolSize and self._pool is None:
+            self._startPool()
+        readers = [self.server]
+        writers = []
+        if self._pool is not None:
+            readers.extend(self._pool.getReaders())
+            writers = self._pool.getWriters()
         try:
-            ready, _, _ = select.select([self.server], [], [], sleepTime)
+            ready, writable, _ = select.select(readers, writers, [], sleepTime)
         except select.error, err:
-            ready = None
-        if ready:
-            self.server.handle_request()
+            ready = writable = None
+        for writer in writable or []:
+            self._pool.handleWrite(writer)
+        if not ready:
+            return
+        for reader in ready:
+            if reader is self.server:
+                self.server.handle_request()
+            elif self._pool is not None:
+                self._pool.handleRead(reader)
+
+
+class _PoolWorker(object):
+    def __init__(self, pid, writer, reader):
+        self.pid = pid
+        self.writer = writer
+        self.reader = reader
+        self.responseHandler = None
+
+    def close(self):
+        self.writer.close()
+        self.reader.close()
+
+
+class ApiWorkerPool(object):
+    """
+        Pre-forked processes that answer read-only API calls, so that
+        those calls don't each need a new process.
+
+        Each worker is forked through the server's _fork, so it sets up its
+        own resources (such as a database connection) once and keeps them.
+        The server sends each call to an idle worker over a pipe and writes
+        the response the worker serialized back to the client as its
+        connection becomes writable.  Calls wait in order while every
+        worker is busy.  Workers that die are
+        replaced, and the call they were answering gets an error.
+    """
+
+    def __init__(self, server, size):
+        self.server = server
+        self.size = size
+        self._workers = {}
+        self._idle = []
+        self._queue = collections.deque()
+        self._writers = []
+
+    def start(self):
+        while len(self._workers) < self.size:
+            self._startWorker()
+
+    def _startWorker(self):
+        requestReader, requestWriter = pipereader.makeMarshalPipes()
+        inF, outF = pipereader.makePipes()
+        responseReader = pipereader.PipeReader(inF)
+        responseWriter = pipereader.PipeWriter(outF)
+        pid = self.server._fork('api worker')
+        if not pid:
+            try:
+                try:
+                    requestWriter.close()
+                    responseReader.close()
+                    for worker in self._workers.values():
+                        worker.close()
+                    self.server._serveApiWorker(requestReader, responseWriter)
+                    os._exit(0)
+                except:
+                    self.server.error('Error in api worker: %s',
+                                      traceback.format_exc())
+            finally:
+                os._exit(1)
+        requestReader.close()
+        responseWriter.close()
+        worker = _PoolWorker(pid, requestWriter, responseReader)
+        self._workers[pid] = worker
+        self._idle.append(worker)
+
+    def getReaders(self):
+        return [ x.reader for x in self._workers.itervalues()
+                 if x.reader.fd is not None ]
+
+    def getWriters(self):
+        return list(self._writers)
+
+    def handleWrite(self, writer):
+        if writer.write():
+            self._writers.remove(writer)
+
+    def _sendResponse(self, responseHandler, responseString):
+        writer = rpclib.ResponseWriter(responseHandler, responseString)
+        if not writer.write():
+            self._writers.append(writer)
+
+    def submit(self, responseHandler, request):
+        self._queue.append((responseHandler, request))
+        self._dispatch()
+
+    def _dispatch(self):
+        while self._queue and self._idle:
+            worker = self._idle.pop()
+            worker.responseHandler, request = self._queue.popleft()
+            worker.writer.send(request)
+            worker.writer.flush()
+
+    def handleRead(self, reader):
+        worker = [ x for x in self._workers.itervalues()
+                   if x.reader is reader ][0]
+        response = None
+        # read as much of the response as is ready rather than one pipe
+        # buffer per pass through the server loop.
+        while reader.fd is not None:
+            response = reader.handle_read()
+            if response is not None:
+                break
+            try:
+                if not select.select([reader], [], [], 0)[0]:
+                    break
+            except (IOError, select.error):
+                break
+        if response is None:
+            if reader.fd is None:
+                # the worker exited
+                self.server._collectChild(worker.pid)
+            return
+        responseHandler = worker.responseHandler
+        worker.responseHandler = None
+        self._idle.append(worker)
+        self._sendResponse(responseHandler, response)
+        self._dispatch()
+
+    def workerDied(self, pid):
+        worker = self._workers.pop(pid, None)
+        if worker is None:
+            return
+        if worker in self._idle:
+            self._idle.remove(worker)
+        worker.close()
+        if worker.responseHandler is not None:
+            err = ApiError('API worker process %s died' % pid)
+            self._sendResponse(worker.responseHandler,
+                    rpclib.serializeResponse((False, _freezeException(err))))
+        if not self.server._halt:
+            self._startWorker()
+            self._dispatch()
+
+    def close(self):
+        """
+            Close the pipes to every worker, without stopping them.
+        """
+        for worker in self._workers.values():
+            worker.close()
+        self._workers.clear()
+        self._idle = []
 
 # ---- helper functions
 
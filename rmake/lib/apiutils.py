@@ -154,6 +154,14 @@ def api_forking(func):
     func.forking = True
     return func
 
+def api_readonly(func):
+    """
+        Marks a method that only reads server state, so that it can be
+        answered by a pooled worker process.
+    """
+    func.readOnly = True
+    return func
+
 # --- generic methods to freeze/thaw based on type
 
 def freeze(apitype, item):
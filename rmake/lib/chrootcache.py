@@ -20,19 +20,26 @@ Cache of chroots.
 """
 
 import errno
+import fcntl
 import os
 import subprocess
 import tempfile
+import time
 
+from conary import dbstore
 from conary.lib import sha1helper, util
+
+from rmake import errors
+from rmake.lib import procutil
 sha1ToString = sha1helper.sha1ToString
+sha1FromString = sha1helper.sha1FromString
 
 class ChrootCacheInterface(object):
     """
     ChrootCacheInterface defines the standard interface for a chroot
     cache.  It should never be instantiated.
     """
-    def store(self, chrootFingerprint, root):
+    def store(self, chrootFingerprint, root, troves=None):
         """
         Store the chroot currently located at C{root} in the
         filesystem using the given chroot fingerprint.
@@ -42,10 +49,29 @@ class ChrootCacheInterface(object):
         @type chrootFingerprint: str of length 20
         @param root: The location of the chroot in the filesystem
         @type root: str
+        @param troves: Optional list of strings naming the troves
+        installed in the chroot, used by findClosestChroot()
+        @type troves: list of str
         @return: None
         """
         raise NotImplementedError
 
+    def storeInBackground(self, chrootFingerprint, root, troves=None):
+        """
+        Store the chroot currently located at C{root} without waiting
+        for the store to finish.  The caller may go on modifying
+        C{root} once this returns.  By default this just calls store().
+
+        @param chrootFingerprint: The fingerprint (a SHA1 sum) to use
+        when storing the chroot
+        @type chrootFingerprint: str of length 20
+        @param root: The location of the chroot in the filesystem
+        @type root: str
+        @param troves: See store()
+        @return: None
+        """
+        self.store(chrootFingerprint, root, troves)
+
     def restore(self, chrootFingerprint, root):
         """
         Return the cached chroot with the given chroot fingerprint to
@@ -80,50 +106,506 @@ class ChrootCacheInterface(object):
         """
         raise NotImplementedError
 
+    def listCachedChroots(self):
+        """
+        Return information about every chroot in the cache.
+
+        @return: list of (fingerprint, size, created, lastUsed, hits)
+        tuples, where fingerprint is the hex string form of the
+        fingerprint, size is in bytes and created and lastUsed are
+        timestamps.
+        """
+        raise NotImplementedError
+
+    def findClosestChroot(self, troves, exactPrefixes=()):
+        """
+        Find the cached chroot that needs the fewest changes to become
+        a chroot containing exactly C{troves}.
+
+        @param troves: Strings naming the troves wanted, in the same
+        form as passed to store()
+        @type troves: list of str
+        @param exactPrefixes: Prefixes of trove strings for troves that
+        would not be removed from a restored chroot.  Chroots with such
+        troves that are not in C{troves} are not considered.
+        @type exactPrefixes: tuple of str
+        @return: The fingerprint of the closest chroot, or None if no
+        cached chroot is close enough to be worth starting from.
+        """
+        return None
+
+
+class TarArchive(object):
+    """
+    Stores chroots as tar archives compressed by an external program.
+    """
+    suffix = '.tar.gz'
+    compressCommand = 'gzip -1 -'
+    decompressCommand = 'zcat'
+    isTree = False
+
+    def isAvailable(self):
+        return bool(util.checkPath(self.compressCommand.split()[0]))
+
+    def store(self, root, path):
+        out = open(path, 'w')
+        try:
+            _runPipeline(['tar', 'cSpf', '-', '-C', root, '.'],
+                         self.compressCommand.split(), stdout=out)
+        finally:
+            out.close()
+
+    def restore(self, path, root):
+        _runPipeline(self.decompressCommand.split() + [path],
+                     ['tar', 'xSpf', '-', '-C', root])
+
+
+class PigzArchive(TarArchive):
+    """
+    Gzip compressed tar archive, compressed using all available CPUs.
+    """
+    compressCommand = 'pigz -1 -'
+    decompressCommand = 'pigz -dc'
+
+
+class ZstdArchive(TarArchive):
+    """
+    Zstandard compressed tar archive, compressed using all available CPUs.
+    """
+    suffix = '.tar.zst'
+    compressCommand = 'zstd -T0 -1 -q -'
+    decompressCommand = 'zstd -dcq'
+
+
+class HardlinkTree(object):
+    """
+    Stores chroots uncompressed as a directory tree.  Storing and restoring
+    both copy the tree, using reflinks where the filesystem supports them,
+    so that the cache never shares inodes with a chroot that may still be
+    changed in place.
+    """
+    suffix = '.tree'
+    isTree = True
+
+    def isAvailable(self):
+        return True
+
+    def store(self, root, path):
+        _runCommand(['cp', '-a', '--reflink=auto', root + '/.', path])
+
+    def restore(self, path, root):
+        _runCommand(['cp', '-a', '--reflink=auto', path + '/.', root])
+
+
+def _startCommand(args, **kw):
+    try:
+        return subprocess.Popen(args, **kw)
+    except OSError, err:
+        raise ChrootCacheError('could not run %s: %s' % (args[0],
+                                                        err.strerror))
+
+
+def _checkStatus(args, status):
+    if status:
+        raise ChrootCacheError('%s failed with exit status %d'
+                               % (' '.join(args), status))
+
+
+def _runCommand(args):
+    """
+    Run C{args}, raising ChrootCacheError unless it succeeds.
+    """
+    _checkStatus(args, _startCommand(args).wait())
+
+
+def _runPipeline(first, second, stdout=None):
+    """
+    Run C{first} piped into C{second}, raising ChrootCacheError unless both
+    succeed.  The exit status of a shell pipeline is that of its last
+    command, which would hide a failing tar or compressor.
+    """
+    firstProc = _startCommand(first, stdout=subprocess.PIPE)
+    try:
+        secondProc = _startCommand(second, stdin=firstProc.stdout,
+                                   stdout=stdout)
+    except ChrootCacheError:
+        firstProc.stdout.close()
+        firstProc.wait()
+        raise
+    # only the second command may read the first one's output, so that the
+    # first gets SIGPIPE if the second exits early
+    firstProc.stdout.close()
+    secondStatus = secondProc.wait()
+    _checkStatus(first, firstProc.wait())
+    _checkStatus(second, secondStatus)
+
+
+# Compression methods that can be used by LocalChrootCache.  When 'auto'
+# is requested, the first of autoMethods that is installed is used.
+compressionMethods = {
+    'gzip'      : TarArchive,
+    'pigz'      : PigzArchive,
+    'zstd'      : ZstdArchive,
+    'hardlink'  : HardlinkTree,
+    }
+autoMethods = ['zstd', 'pigz', 'gzip']
+_suffixes = set(x.suffix for x in compressionMethods.values())
+
 
 class LocalChrootCache(ChrootCacheInterface):
     """
     The LocalChrootCache class implements a chroot cache that uses the
     local file system to store tar archive of chroots.
+
+    An index in the cache directory records the size, creation time, time
+    of last use and number of restores of each cached chroot.  When the
+    cache grows past C{sizeLimit} bytes, the chroots that were least
+    recently stored or restored are removed.
     """
-    def __init__(self, cacheDir):
+    def __init__(self, cacheDir, compression='gzip', sizeLimit=0):
         """
         Instanciate a LocalChrootCache object
         @param cacheDir: The base directory for the chroot cache files
         @type cacheDir: str
+        @param compression: The name of the method used to store chroots,
+        one of the keys of C{compressionMethods}, or 'auto' to pick the
+        fastest one that is installed.
+        @type compression: str
+        @param sizeLimit: The maximum total size of the cached chroots, in
+        bytes, or 0 for no limit.
+        @type sizeLimit: int
         """
         self.cacheDir = cacheDir
+        self.sizeLimit = sizeLimit
+        self.db = None
+        if compression == 'auto':
+            for compression in autoMethods:
+                method = compressionMethods[compression]()
+                if method.isAvailable():
+                    break
+        else:
+            method = compressionMethods[compression]()
+        self.method = method
 
-    def store(self, chrootFingerprint, root):
+    def store(self, chrootFingerprint, root, troves=None):
         path = self._fingerPrintToPath(chrootFingerprint)
         prefix = sha1ToString(chrootFingerprint) + '.'
         util.mkdirChain(self.cacheDir)
-        fd, fn = tempfile.mkstemp('.tar.gz', prefix, self.cacheDir)
-        os.close(fd)
+        if self.method.isTree:
+            fn = tempfile.mkdtemp(self.method.suffix, prefix, self.cacheDir)
+        else:
+            fd, fn = tempfile.mkstemp(self.method.suffix, prefix,
+                                      self.cacheDir)
+            os.close(fd)
         try:
-            subprocess.call('tar cSpf - -C %s . | gzip -1 - > %s' %(root, fn),
-                            shell=True)
-            os.rename(fn, path)
+            self.method.store(root, fn)
+            self._commit(chrootFingerprint, fn, troves)
         finally:
-            util.removeIfExists(fn)
+            self._removePath(fn)
 
-    def restore(self, chrootFingerprint, root):
-        path = self._fingerPrintToPath(chrootFingerprint)
-        subprocess.call('zcat %s | tar xSpf - -C %s' %(path, root),
-                        shell=True)
+    def storeInBackground(self, chrootFingerprint, root, troves=None):
+        """
+        Take a reflinked copy of C{root} inside the cache directory, then
+        store the chroot from that copy in a background process.  The copy
+        shares no inodes with C{root}, so the build may change anything in
+        it, such as the conary database, while the store runs.
 
-    def remove(self, chrootFingerprint):
-        path = self._fingerPrintToPath(chrootFingerprint)
+        If the copy cannot be made, for instance because the filesystem
+        does not support reflinks or the cache is on a different
+        filesystem from the chroot, the chroot is stored before returning
+        instead.
+        """
+        prefix = sha1ToString(chrootFingerprint) + '.'
+        util.mkdirChain(self.cacheDir)
+        snapshot = tempfile.mkdtemp('.snapshot', prefix, self.cacheDir)
+        if subprocess.call(['cp', '-a', '--reflink=always', root + '/.',
+                            snapshot], stderr=open(os.devnull, 'w')):
+            self._removePath(snapshot)
+            self.store(chrootFingerprint, root, troves)
+            return
+
+        def store():
+            # the index connection must not be shared with the parent
+            self.db = None
+            try:
+                self.store(chrootFingerprint, snapshot, troves)
+            finally:
+                self._removePath(snapshot)
+        # the store runs in a session of its own, so that stopping the
+        # build does not stop it.
+        procutil.runInBackground(store,
+                                 os.path.join(self.cacheDir, 'store.log'))
+
+    def restore(self, chrootFingerprint, root):
+        name = sha1ToString(chrootFingerprint)
+        path = self._nameToPath(name)
+        # hold a shared lock on the chroot while copying it, so that it is
+        # not pruned from under us.
         try:
-            os.unlink(path)
+            fd = os.open(path, os.O_RDONLY)
         except OSError, err:
             if err.errno != errno.ENOENT:
                 raise
+            fd = None
+        try:
+            if fd is not None:
+                fcntl.flock(fd, fcntl.LOCK_SH)
+            if not os.path.exists(path):
+                raise ChrootCacheError('chroot %s is not in the cache' % name)
+            self.method.restore(path, root)
+        finally:
+            if fd is not None:
+                os.close(fd)
+        self._recordUse(name)
+
+    def remove(self, chrootFingerprint):
+        self._removeEntry(sha1ToString(chrootFingerprint), wait=True)
 
     def hasChroot(self, chrootFingerprint):
         path = self._fingerPrintToPath(chrootFingerprint)
+        if self.method.isTree:
+            return os.path.isdir(path)
         return os.path.isfile(path)
 
+    def listCachedChroots(self):
+        """
+        Return information about every chroot in the cache, least
+        recently used first.  Chroots missing from the index, such as
+        those stored before it existed, are listed from the files alone;
+        the cache itself is not changed.
+
+        @return: list of (fingerprint, size, created, lastUsed, hits)
+        tuples, where fingerprint is the hex string form of the
+        fingerprint, size is in bytes and created and lastUsed are
+        timestamps.
+        """
+        indexed = {}
+        if os.path.exists(self._getIndexPath()):
+            cu = self._getDb().cursor()
+            cu.execute("""SELECT fingerprint, size, created, lastUsed, hits
+                          FROM CachedChroots""")
+            for row in cu.fetchall():
+                indexed[row[0]] = tuple(row)
+        chroots = []
+        for name, path in self._listStored().iteritems():
+            if name in indexed:
+                chroots.append(indexed[name])
+            else:
+                mtime = int(os.stat(path).st_mtime)
+                chroots.append((name, self._getSize(path), mtime, mtime, 0))
+        chroots.sort(key=lambda x: (x[3], x[0]))
+        return chroots
+
+    def findClosestChroot(self, troves, exactPrefixes=()):
+        """
+        Returns the fingerprint of the cached chroot that has the most of
+        C{troves} installed, less the number of unwanted troves it has.
+        Only chroots that have at least half of C{troves} are considered,
+        and none with unwanted troves starting with C{exactPrefixes}.
+        """
+        troves = set(troves)
+        if not troves or not os.path.exists(self._getIndexPath()):
+            return None
+        cu = self._getDb().cursor()
+        cu.execute("""SELECT fingerprint, troves FROM CachedChroots
+                      WHERE troves IS NOT NULL""")
+        best = None
+        bestScore = None
+        for fingerprint, cachedTroves in cu.fetchall():
+            cachedTroves = set(cachedTroves.split('\n'))
+            shared = len(troves & cachedTroves)
+            if shared * 2 < len(troves):
+                continue
+            if [ x for x in cachedTroves - troves
+                 if x.startswith(exactPrefixes) ]:
+                continue
+            score = shared - len(cachedTroves - troves)
+            if bestScore is None or score > bestScore:
+                best, bestScore = fingerprint, score
+        if best is None:
+            return None
+        best = sha1FromString(best)
+        if not self.hasChroot(best):
+            return None
+        return best
+
+    def prune(self, keep=None):
+        """
+        Remove the least recently used chroots until the cache is
+        within its size limit.
+
+        @param keep: Fingerprint, as a hex string, of a chroot that must
+        not be removed.
+        """
+        if not self.sizeLimit:
+            return
+        self._syncIndex()
+        cu = self._getDb().cursor()
+        cu.execute("SELECT SUM(size) FROM CachedChroots")
+        total = cu.fetchone()[0] or 0
+        cu.execute("""SELECT fingerprint, size FROM CachedChroots
+                      ORDER BY lastUsed""")
+        for fingerprint, size in cu.fetchall():
+            if total <= self.sizeLimit:
+                break
+            if fingerprint == keep:
+                continue
+            # chroots that are being restored are left for next time
+            if self._removeEntry(fingerprint):
+                total -= size
+
     def _fingerPrintToPath(self, chrootFingerprint):
-        tar = sha1ToString(chrootFingerprint) + '.tar.gz'
-        return os.path.join(self.cacheDir, tar)
+        return self._nameToPath(sha1ToString(chrootFingerprint))
+
+    def _nameToPath(self, name):
+        return os.path.join(self.cacheDir, name + self.method.suffix)
+
+    def _listStored(self):
+        """
+        Returns a dict of name to path for every chroot in the cache
+        directory, whichever of the C{compressionMethods} stored it.
+        """
+        stored = {}
+        if not os.path.isdir(self.cacheDir):
+            return stored
+        for fileName in os.listdir(self.cacheDir):
+            for suffix in _suffixes:
+                name = fileName[:-len(suffix)]
+                if not fileName.endswith(suffix) or len(name) != 40:
+                    continue
+                if name not in stored or suffix == self.method.suffix:
+                    stored[name] = os.path.join(self.cacheDir, fileName)
+        return stored
+
+    def _commit(self, chrootFingerprint, tempPath, troves=None):
+        name = sha1ToString(chrootFingerprint)
+        path = self._nameToPath(name)
+        try:
+            os.rename(tempPath, path)
+        except OSError, err:
+            # a directory can't be renamed over another one.  If the chroot
+            # has been stored in the meantime there is nothing left to do.
+            if err.errno not in (errno.EEXIST, errno.ENOTEMPTY):
+                raise
+        if os.path.exists(path):
+            self._addEntry(name, path, troves=troves)
+            self.prune(keep=name)
+
+    def _removePath(self, path):
+        if os.path.isdir(path) and not os.path.islink(path):
+            util.rmtree(path, ignore_errors=True)
+        else:
+            util.removeIfExists(path)
+
+    def _getSize(self, path):
+        if not os.path.isdir(path):
+            return os.stat(path).st_size
+        # count files that are hard linked within the tree only once
+        seen = set()
+        size = 0
+        for dirPath, dirNames, fileNames in os.walk(path):
+            for name in fileNames:
+                st = os.lstat(os.path.join(dirPath, name))
+                if st.st_ino not in seen:
+                    seen.add(st.st_ino)
+                    size += st.st_size
+        return size
+
+    def _getDb(self):
+        if self.db is None:
+            util.mkdirChain(self.cacheDir)
+            self.db = dbstore.connect(self._getIndexPath(),
+                                      driver='sqlite', timeout=30000)
+            cu = self.db.cursor()
+            cu.execute("""CREATE TABLE IF NOT EXISTS CachedChroots (
+                            fingerprint TEXT PRIMARY KEY,
+                            size        INTEGER NOT NULL,
+                            created     INTEGER NOT NULL,
+                            lastUsed    INTEGER NOT NULL,
+                            hits        INTEGER NOT NULL DEFAULT 0,
+                            troves      TEXT)""")
+            cu.execute("PRAGMA table_info(CachedChroots)")
+            if 'troves' not in [ x[1] for x in cu.fetchall() ]:
+                # index created before trove lists were recorded
+                cu.execute("ALTER TABLE CachedChroots ADD COLUMN troves TEXT")
+            self.db.commit()
+        return self.db
+
+    def _getIndexPath(self):
+        return os.path.join(self.cacheDir, 'index.db')
+
+    def _addEntry(self, name, path, created=None, troves=None):
+        if created is None:
+            created = int(time.time())
+        if troves is not None:
+            troves = '\n'.join(sorted(troves))
+        db = self._getDb()
+        cu = db.cursor()
+        cu.execute("""INSERT OR REPLACE INTO CachedChroots
+                      (fingerprint, size, created, lastUsed, hits, troves)
+                      VALUES (?, ?, ?, ?, 0, ?)""",
+                   name, self._getSize(path), created, created, troves)
+        db.commit()
+
+    def _recordUse(self, name):
+        db = self._getDb()
+        cu = db.cursor()
+        cu.execute("""UPDATE CachedChroots SET lastUsed = ?, hits = hits + 1
+                      WHERE fingerprint = ?""", int(time.time()), name)
+        db.commit()
+
+    def _removeEntry(self, name, wait=False):
+        """
+        Remove the chroot C{name}, in whatever form it was stored, and its
+        index entry.  A chroot that is being restored is left alone and
+        False returned, unless C{wait} is set, in which case the restore
+        is waited for.
+        """
+        flags = fcntl.LOCK_EX
+        if not wait:
+            flags |= fcntl.LOCK_NB
+        for suffix in _suffixes:
+            path = os.path.join(self.cacheDir, name + suffix)
+            try:
+                fd = os.open(path, os.O_RDONLY)
+            except OSError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+                continue
+            try:
+                try:
+                    fcntl.flock(fd, flags)
+                except IOError, err:
+                    if err.errno != errno.EWOULDBLOCK:
+                        raise
+                    return False
+                self._removePath(path)
+            finally:
+                os.close(fd)
+        if self.db is not None or os.path.exists(self._getIndexPath()):
+            db = self._getDb()
+            db.cursor().execute(
+                    "DELETE FROM CachedChroots WHERE fingerprint = ?", name)
+            db.commit()
+        return True
+
+    def _syncIndex(self):
+        """
+        Add chroots that were stored without being indexed, and drop
+        entries for chroots that are no longer there.
+        """
+        cu = self._getDb().cursor()
+        cu.execute("SELECT fingerprint FROM CachedChroots")
+        indexed = set(x[0] for x in cu.fetchall())
+        stored = self._listStored()
+        for name, path in stored.iteritems():
+            if name not in indexed:
+                self._addEntry(name, path, int(os.stat(path).st_mtime))
+        for name in indexed.difference(stored):
+            self._removeEntry(name)
+
+
+class ChrootCacheError(errors.RmakeError):
+    """
+    Raised when a chroot could not be stored in or restored from the cache.
+    """
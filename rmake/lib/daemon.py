@@ -30,6 +30,7 @@ from conary.lib import options, util
 
 from rmake.lib import logfile
 from rmake.lib import logger
+from rmake.lib import repocache
 
 (NO_PARAM,  ONE_PARAM)  = (options.NO_PARAM, options.ONE_PARAM)
 (OPT_PARAM, MULT_PARAM) = (options.OPT_PARAM, options.MULT_PARAM)
@@ -101,6 +102,46 @@ class StartCommand(DaemonCommand):
         return daemon.start(fork=not argSet.pop('no-daemon', False))
 _register(StartCommand)
 
+# changeset cache commands, for daemons whose configuration has
+# getCacheDir and changesetCacheSize
+
+class CacheStatsCommand(DaemonCommand):
+    commands = ['cache-stats']
+
+    help = 'Show the size and hit rate of the changeset cache'
+
+    def runCommand(self, daemon, cfg, argSet, args):
+        cache = repocache.RepositoryCache(cfg.getCacheDir(),
+                sizeLimit=cfg.changesetCacheSize * 1048576)
+        cache.syncIndex()
+        stats = cache.getStats()
+        lookups = stats['hits'] + stats['misses']
+        print "Entries:     %d" % stats['entries']
+        if cache.sizeLimit:
+            print "Size:        %d bytes (limit %d)" % (stats['size'],
+                                                       cache.sizeLimit)
+        else:
+            print "Size:        %d bytes (no limit)" % stats['size']
+        print "Hits:        %d (%.1f%%)" % (stats['hits'],
+                stats['hits'] * 100.0 / max(lookups, 1))
+        print "Misses:      %d" % stats['misses']
+        print "Bytes saved: %d" % stats['bytesSaved']
+        print "Evicted:     %d" % stats['evicted']
+
+class PruneCacheCommand(DaemonCommand):
+    commands = ['prune-cache']
+
+    help = 'Remove least recently used changesets past changesetCacheSize'
+
+    def runCommand(self, daemon, cfg, argSet, args):
+        if not cfg.changesetCacheSize:
+            print "changesetCacheSize is not set"
+            return 1
+        cache = repocache.RepositoryCache(cfg.getCacheDir(),
+                sizeLimit=cfg.changesetCacheSize * 1048576)
+        count, size = cache.prune()
+        print "Removed %d entries, %d bytes" % (count, size)
+
 class Daemon(options.MainHandler):
     '''This class contains basic daemon functions, useful for creating your own
        daemon.
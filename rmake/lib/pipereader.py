@@ -18,6 +18,7 @@
 """
 Simple class for reading marshalled data through a pipe.
 """
+import errno
 import fcntl
 import marshal
 import os
@@ -136,11 +137,16 @@ class PipeWriter(object):
     def send(self, text):
         length = len(text)
         length = struct.pack(LENGTH_STRUCT, length)
-        self.buf.extend((length + text))
+        self.buf.append(length + text)
 
     def handle_write(self):
         if self.buf:
-            rc = os.write(self.fd, self.buf[0])
+            try:
+                rc = os.write(self.fd, self.buf[0])
+            except OSError, err:
+                if err.errno != errno.EAGAIN:
+                    raise
+                return
             if rc < len(self.buf[0]):
                 self.buf[0] = self.buf[0][rc:]
             else:
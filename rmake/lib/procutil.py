@@ -16,8 +16,14 @@
 #
 
 
+import errno
 import os
+import select
+import signal
 import socket
+import traceback
+
+from rmake.lib import pipereader
 
 
 def getUptime():
@@ -72,6 +78,114 @@ def getMemInfo():
     return (freeMemory, totalMemory), (freeSwap, totalSwap)
 
 
+def detachFds(logPath=None):
+    """
+    Close every file descriptor past stderr and send stdin to /dev/null
+    and stdout and stderr to logPath, or /dev/null.  For background
+    processes forked from a build, so that they do not hold open the
+    pipes and logs of the process that started them.
+    """
+    null = os.open('/dev/null', os.O_RDWR)
+    out = null
+    if logPath:
+        out = os.open(logPath, os.O_WRONLY | os.O_CREAT | os.O_APPEND, 0644)
+    os.dup2(null, 0)
+    os.dup2(out, 1)
+    os.dup2(out, 2)
+    try:
+        fds = [ int(x) for x in os.listdir('/proc/self/fd') ]
+    except OSError:
+        fds = range(3, 256)
+    for fd in fds:
+        if fd < 3:
+            continue
+        try:
+            os.close(fd)
+        except OSError:
+            pass
+
+def runInBackground(fn, logPath=None):
+    """
+    Call C{fn()} in a detached process and return as soon as it is
+    started.  The process is in a session of its own, so that stopping
+    the caller's process group does not stop it, and its file
+    descriptors are closed as by L{detachFds}, with its output going to
+    C{logPath}.  C{fn} must do its own cleaning up.
+    """
+    pid = os.fork()
+    if pid:
+        # the child exits as soon as the background process is started.
+        os.waitpid(pid, 0)
+        return
+    try:
+        try:
+            os.setsid()
+            if os.fork():
+                os._exit(0)
+            detachFds(logPath)
+            fn()
+        except:
+            traceback.print_exc()
+    finally:
+        os._exit(0)
+
+def forkWorkers(workers, work, exited=None):
+    """
+    Fork C{workers} processes, the C{n}th of which iterates over
+    C{work(n)} and sends each item back over a pipe, so the items must
+    be marshallable.  Yields C{(n, item)} as the items come back.  When
+    process C{n} exits, C{exited(n, status)} is called with its wait
+    status, if given.  Processes still running when the caller stops
+    iterating are killed.
+    """
+    children = {}
+    try:
+        for n in range(workers):
+            reader, writer = pipereader.makeMarshalPipes()
+            pid = os.fork()
+            if not pid:
+                try:
+                    try:
+                        reader.close()
+                        for otherReader in children:
+                            otherReader.close()
+                        for item in work(n):
+                            writer.send(item)
+                            writer.flush()
+                        writer.close()
+                        os._exit(0)
+                    except:
+                        traceback.print_exc()
+                finally:
+                    os._exit(1)
+            writer.close()
+            children[reader] = (n, pid)
+
+        while children:
+            try:
+                ready = select.select(children.keys(), [], [], 1.0)[0]
+            except select.error, err:
+                if err.args[0] != errno.EINTR:
+                    raise
+                continue
+            for reader in ready:
+                data = reader.handle_read()
+                if data is not None:
+                    yield children[reader][0], data
+                if reader.fd is None:
+                    n, pid = children.pop(reader)
+                    status = os.waitpid(pid, 0)[1]
+                    if exited is not None:
+                        exited(n, status)
+    finally:
+        for reader, (n, pid) in children.items():
+            reader.close()
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except OSError:
+                pass
+            os.waitpid(pid, 0)
+
 def getNetName():
     """
     Find a hostname or IP suitable for representing ourselves to clients.
@@ -17,16 +17,21 @@
 
 import copy
 import itertools
+import marshal
 import os
 import tempfile
 import traceback
+import zlib
 
 #conary
 from conary.build import cook,loadrecipe,lookaside,recipe,use
 from conary.build import errors as builderrors
 from conary import conarycfg
 from conary import conaryclient
+from conary import dbstore
+from conary.dbstore.sqlerrors import DatabaseLocked
 from conary.deps import deps
+from conary.lib import digestlib
 from conary.lib import log,util
 from conary.deps.deps import Flavor
 from conary.repository import trovesource
@@ -36,7 +41,9 @@ from rmake import compat
 from rmake import errors
 from rmake import failure
 from rmake.lib import flavorutil
+from rmake.lib import procutil
 from rmake.lib import repocache
+from rmake.lib.apiutils import freeze, thaw
 from rmake.build import buildtrove
 
 
@@ -253,77 +260,209 @@ def _getLoadedSpecs(loader, recipeObj):
             toParse.append((newDict, getattr(recipeClass, '_loadedSpecs', {})))
     return finalDict
 
+def _loadSourceTrove(job, repos, buildFlavor, buildTrove, trove,
+                     loadInstalledSource=None, installLabelPath=None,
+                     internalHostName=None):
+    """
+    Load the recipe for one build trove.  Returns a
+    C{(result, failure)} pair, one of which is C{None}.
+    """
+    n,v,f = buildTrove.getNameVersionFlavor()
+    if v.getHost() == internalHostName:
+        buildLabel = v.branch().parentBranch().label()
+    else:
+        buildLabel = v.trailingLabel()
+    try:
+        (loader, recipeObj, relevantFlavor) = loadRecipe(repos,
+                             n, v, f,
+                             trove,
+                             buildFlavor,
+                             loadInstalledSource=loadInstalledSource,
+                             installLabelPath=installLabelPath,
+                             buildLabel=buildLabel,
+                             cfg=job.getTroveConfig(buildTrove))
+        result = buildtrove.LoadTroveResult()
+        result.flavor = relevantFlavor
+        result.recipeType = buildtrove.getRecipeType(recipeObj)
+        result.loadedSpecsList = [ _getLoadedSpecs(loader, recipeObj) ]
+        if hasattr(loader, 'getLoadedTroves'):
+            result.loadedTroves = loader.getLoadedTroves()
+        else:
+            result.loadedTroves = recipeObj.getLoadedTroves()
+        result.packages = set(getattr(recipeObj,
+            'packages', [recipeObj.name]))
+        if 'delayedRequires' in recipeObj.__dict__:
+            result.delayedRequirements = recipeObj.delayedRequires
+        result.buildRequirements = set(
+            getattr(recipeObj, 'buildRequires', []))
+        result.crossRequirements = set(
+            getattr(recipeObj, 'crossRequires', []))
+        return result, None
+    except Exception, err:
+        if isinstance(err, errors.RmakeError):
+            # we assume our internal errors have enough info
+            # to determine what the bug is.
+            fail = failure.LoadFailed(str(err))
+        else:
+            fail = failure.LoadFailed(str(err), traceback.format_exc())
+        return None, fail
+
+def _loadInWorkers(loadOne, troveList, troves, workers, setUp=None):
+    """
+    Call C{loadOne(buildTrove, trove)} for each trove in C{troveList}
+    across C{workers} forked processes, each taking every C{workers}th
+    trove.  Yields C{(idx, result, failure)} in C{troveList} order as
+    results come back.
+
+    The processes are forked after the recipes are downloaded, so each
+    one starts with them in hand.  If C{setUp} is given, each process
+    calls it before loading anything, to open what it must not share
+    with the parent, such as repository connections.
+    """
+    def work(shard):
+        if setUp is not None:
+            setUp()
+        for idx in range(shard, len(troveList), workers):
+            result, fail = loadOne(troveList[idx], troves[idx])
+            if result is not None:
+                result = freeze('LoadTroveResult', result)
+            if fail is not None:
+                fail = freeze('FailureReason', fail)
+            yield idx, result, fail
+
+    shards = dict((x, set(range(x, len(troveList), workers)))
+                  for x in range(workers))
+    pending = {}
+
+    def exited(shard, status):
+        if os.WIFSIGNALED(status):
+            reason = ('Recipe loader process killed with signal %s'
+                      % os.WTERMSIG(status))
+        else:
+            reason = ('Recipe loader process exited with status %s'
+                      % os.WEXITSTATUS(status))
+        for idx in shards.pop(shard):
+            pending[idx] = (None, failure.LoadFailed(reason))
+
+    nextIdx = 0
+    for shard, (idx, result, fail) in procutil.forkWorkers(workers, work,
+                                                           exited):
+        if result is not None:
+            result = thaw('LoadTroveResult', result)
+        if fail is not None:
+            fail = thaw('FailureReason', fail)
+        pending[idx] = (result, fail)
+        shards[shard].discard(idx)
+        while nextIdx in pending:
+            result, fail = pending.pop(nextIdx)
+            yield nextIdx, result, fail
+            nextIdx += 1
+    # failures of processes that exited after their last result
+    while nextIdx in pending:
+        result, fail = pending.pop(nextIdx)
+        yield nextIdx, result, fail
+        nextIdx += 1
+
 def loadSourceTroves(job, repos, buildFlavor, troveList,
                      loadInstalledSource=None, installLabelPath=None,
                      groupRecipeSource=None, internalHostName=None, 
-                     total=0, count=0):
+                     total=0, count=0, workers=1, loadCache=None,
+                     buildTroveTups=None, openSources=None):
     """
     Load the source troves associated with a set of build troves
     C{troveList}. Returns a mapping of C{(name, version, flavor,
     context)} to L{LoadTroveResult<rmake.build.buildtrove.LoadTroveResult>}
     indicating information loaded from the source such as packages
     and build requirements.
+
+    If C{workers} is more than 1, recipes are loaded in that many
+    processes at once.  Progress is still logged in C{troveList} order.
+    If C{loadCache} is given, results stored there are used instead of
+    loading the recipe, and new results are added to it.
+    C{buildTroveTups} are the troves in C{loadInstalledSource} that come
+    from the job itself rather than a repository, if any.
+    If C{openSources} is given, each of the processes calls it to get
+    its own C{(repos, loadInstalledSource)} instead of sharing the
+    repository connections of this one.
     """
     if not total:
         total = len(troveList)
-    job.log('Downloading %s recipes...' % len(troveList))
     troveList = list(sorted(troveList, key=lambda x: x.getName()))
-    troves = getRecipes(repos, [x.getNameVersionFlavor() for x in troveList])
+    if loadCache is not None:
+        hashes = [ getLoadHash(job.getTroveConfig(x), x, buildFlavor,
+                               installLabelPath, internalHostName,
+                               buildTroveTups)
+                   for x in troveList ]
+        cached = loadCache.getResults(hashes)
+    else:
+        hashes = [ None ] * len(troveList)
+        cached = {}
+    toLoad = [ x[0] for x in itertools.izip(troveList, hashes)
+               if x[1] not in cached ]
+    if cached:
+        job.log('Using %s cached recipe load results' % len(cached))
+    job.log('Downloading %s recipes...' % len(toLoad))
+    if toLoad:
+        troves = getRecipes(repos, [x.getNameVersionFlavor() for x in toLoad])
+    else:
+        troves = []
     resultSet = {}
+    sources = [repos, loadInstalledSource]
 
-    for idx, (buildTrove, trove) in enumerate(itertools.izip(troveList, troves)):
-        n,v,f = buildTrove.getNameVersionFlavor()
-        job.log('Loading %s out of %s: %s' % (count + idx + 1, total, n))
-        relevantFlavor = None
-        if v.getHost() == internalHostName:
-            buildLabel = v.branch().parentBranch().label()
+    def loadOne(buildTrove, trove):
+        return _loadSourceTrove(job, sources[0], buildFlavor, buildTrove,
+                                trove, loadInstalledSource=sources[1],
+                                installLabelPath=installLabelPath,
+                                internalHostName=internalHostName)
+
+    if openSources is not None:
+        def setUp():
+            sources[:] = openSources()
+    else:
+        setUp = None
+
+    workers = min(workers, len(toLoad))
+    if workers > 1:
+        loaded = _loadInWorkers(loadOne, toLoad, troves, workers, setUp)
+    else:
+        loaded = ((idx,) + loadOne(toLoad[idx], troves[idx])
+                  for idx in range(len(toLoad)))
+    for idx, (buildTrove, hash) in enumerate(itertools.izip(troveList,
+                                                            hashes)):
+        job.log('Loading %s out of %s: %s' % (count + idx + 1, total,
+                                              buildTrove.getName()))
+        if hash in cached:
+            result, fail = cached[hash], None
         else:
-            buildLabel = v.trailingLabel()
-        try:
-            (loader, recipeObj, relevantFlavor) = loadRecipe(repos,
-                                 n, v, f,
-                                 trove,
-                                 buildFlavor,
-                                 loadInstalledSource=loadInstalledSource,
-                                 installLabelPath=installLabelPath,
-                                 buildLabel=buildLabel,
-                                 cfg=job.getTroveConfig(buildTrove))
-            result = buildtrove.LoadTroveResult()
-            result.flavor = relevantFlavor
-            result.recipeType = buildtrove.getRecipeType(recipeObj)
-            result.loadedSpecsList = [ _getLoadedSpecs(loader, recipeObj) ]
-            if hasattr(loader, 'getLoadedTroves'):
-                result.loadedTroves = loader.getLoadedTroves()
-            else:
-                result.loadedTroves = recipeObj.getLoadedTroves()
-            result.packages = set(getattr(recipeObj,
-                'packages', [recipeObj.name]))
-            if 'delayedRequires' in recipeObj.__dict__:
-                result.delayedRequirements = recipeObj.delayedRequires
-            result.buildRequirements = set(
-                getattr(recipeObj, 'buildRequires', []))
-            result.crossRequirements = set(
-                getattr(recipeObj, 'crossRequires', []))
-            resultSet[buildTrove.getNameVersionFlavor(True)] = result
-        except Exception, err:
-            if isinstance(err, errors.RmakeError):
-                # we assume our internal errors have enough info
-                # to determine what the bug is.
-                fail = failure.LoadFailed(str(err))
-            else:
-                fail = failure.LoadFailed(str(err), traceback.format_exc())
+            result, fail = loaded.next()[1:]
+            if fail is None and loadCache is not None:
+                loadCache.put(hash, result)
+        if fail is not None:
             buildTrove.troveFailed(fail)
+        else:
+            resultSet[buildTrove.getNameVersionFlavor(True)] = result
     return resultSet
 
-def getSourceTrovesFromJob(job, troveList=None, repos=None, reposName=None):
+def getSourceTrovesFromJob(job, troveList=None, repos=None, reposName=None,
+                           workers=1, loadCachePath=None, openRepos=None):
+    """
+    Load the source troves of C{job}.  When they are loaded in more than
+    one process, each process calls C{openRepos()} for a repository
+    client of its own instead of sharing C{repos}; by default it opens
+    one from the job's configuration.
+    """
     cfg = job.getMainConfig()
     if repos:
         cacheDir = None
+        if openRepos is None:
+            openRepos = lambda: conaryclient.ConaryClient(cfg).getRepos()
     else:
         cacheDir = tempfile.mkdtemp(prefix='rmake-trovecache-')
-        try:
+        def openRepos():
             client = conaryclient.ConaryClient(cfg)
-            repos = repocache.CachingTroveSource(client.getRepos(), cacheDir)
+            return repocache.CachingTroveSource(client.getRepos(), cacheDir)
+        try:
+            repos = openRepos()
         except:
             util.rmtree(cacheDir)
             raise
@@ -347,11 +486,16 @@ def getSourceTrovesFromJob(job, troveList=None, repos=None, reposName=None):
             buildTroveSource = RemoveHostSource(trovesource.SimpleTroveSource(
                 buildTrovePackages), reposName)
         else:
+            buildTrovePackages = None
             buildTroveSource = None
 
         # don't search the internal repository explicitly for loadRecipe
         # sources - they may be a part of some bogus build.
         repos = RemoveHostRepos(repos, reposName)
+        if loadCachePath:
+            loadCache = LoadResultCache(loadCachePath, repos)
+        else:
+            loadCache = None
 
         trovesByConfig = {}
         for trove in troveList:
@@ -362,38 +506,161 @@ def getSourceTrovesFromJob(job, troveList=None, repos=None, reposName=None):
         for context, contextTroves in trovesByConfig.items():
             buildCfg = contextTroves[0].cfg
 
-            loadInstalledList = [ trovesource.TroveListTroveSource(repos, x)
-                for x in buildCfg.resolveTroveTups ]
-            loadInstalledList.append(repos)
-
-            if buildTroveSource is not None:
-                loadInstalledSource = trovesource.stack(buildTroveSource,
-                                                        *loadInstalledList)
-            else:
-                loadInstalledSource = trovesource.stack(*loadInstalledList)
-
-            loadInstalledRepos = trovesource.stack(*loadInstalledList)
-            if isinstance(loadInstalledRepos, trovesource.TroveSourceStack):
-                for source in loadInstalledRepos.iterSources():
-                    source._getLeavesOnly = True
-                    source.searchWithFlavor()
-                    # keep allowNoLabel set.
-            else:
-                loadInstalledRepos._getLeavesOnly = True
-                loadInstalledRepos.searchWithFlavor()
-            cachedRepos = CachingSource(loadInstalledRepos)
+            cachedRepos, loadInstalledSource = _getLoadSources(repos,
+                    buildCfg, buildTroveSource)
+            def openSources(buildCfg=buildCfg):
+                return _getLoadSources(RemoveHostRepos(openRepos(), reposName),
+                                       buildCfg, buildTroveSource)
 
             resultSet.update(loadSourceTroves(job, cachedRepos,
                 buildCfg.buildFlavor, contextTroves, total=total, count=count,
                 loadInstalledSource=loadInstalledSource,
                 installLabelPath=buildCfg.installLabelPath,
-                internalHostName=reposName))
-            count = len(resultSet)
+                internalHostName=reposName, workers=workers,
+                loadCache=loadCache, buildTroveTups=buildTrovePackages,
+                openSources=openSources))
+            count += len(contextTroves)
     finally:
         if cacheDir:
             util.rmtree(cacheDir)
     return resultSet
 
+def _getLoadSources(repos, buildCfg, buildTroveSource):
+    """
+    Returns the C{(repos, loadInstalledSource)} to load recipes for
+    C{buildCfg} with.
+    """
+    loadInstalledList = [ trovesource.TroveListTroveSource(repos, x)
+        for x in buildCfg.resolveTroveTups ]
+    loadInstalledList.append(repos)
+
+    if buildTroveSource is not None:
+        loadInstalledSource = trovesource.stack(buildTroveSource,
+                                                *loadInstalledList)
+    else:
+        loadInstalledSource = trovesource.stack(*loadInstalledList)
+
+    loadInstalledRepos = trovesource.stack(*loadInstalledList)
+    if isinstance(loadInstalledRepos, trovesource.TroveSourceStack):
+        for source in loadInstalledRepos.iterSources():
+            source._getLeavesOnly = True
+            source.searchWithFlavor()
+            # keep allowNoLabel set.
+    else:
+        loadInstalledRepos._getLeavesOnly = True
+        loadInstalledRepos.searchWithFlavor()
+    cachedRepos = CachingSource(loadInstalledRepos)
+    return cachedRepos, loadInstalledSource
+
+# trove config options read while loading a recipe and running its setup()
+_loadConfigOptions = ['autoLoadRecipes', 'defaultMacros', 'macros',
+                      'policyDirs', 'siteConfigPath', 'useDirs']
+
+def getLoadHash(buildCfg, buildTrove, buildFlavor, installLabelPath=None,
+                internalHostName=None, buildTroveTups=None):
+    # Hash the inputs to loadRecipe so that the result can be cached.  The
+    # troves loaded by the recipe from repositories are checked when the
+    # result is used, but loadInstalled may also find the troves being
+    # built in the same job, so those are part of the hash.
+    n, v, f = buildTrove.getNameVersionFlavor()
+    options = []
+    for key in _loadConfigOptions:
+        value = getattr(buildCfg, key, None)
+        if hasattr(value, 'items'):
+            value = sorted(value.items())
+        options.append('%s=%r' % (key, value))
+    inputs = [
+            '%s=%s[%s]' % (n, v.freeze(), f.freeze()),
+            buildFlavor is not None and buildFlavor.freeze() or '',
+            '\0'.join(str(x) for x in installLabelPath or []),
+            internalHostName or '',
+            '\1'.join('\0'.join(sorted('%s=%s[%s]' % (y[0], y[1].freeze(),
+                                                      y[2].freeze())
+                                       for y in x))
+                for x in buildCfg.resolveTroveTups),
+            '\0'.join(options),
+            '\0'.join(sorted('%s=%s[%s]' % (x[0], x[1].freeze(),
+                                             x[2].freeze())
+                              for x in buildTroveTups or [])),
+            ]
+    return digestlib.sha1('\2'.join(inputs)).hexdigest()
+
+class LoadResultCache(object):
+    """
+        Stores recipe load results keyed by getLoadHash().
+
+        Results are kept as compressed marshal data in a sqlite database.
+        A stored result is only used while every trove loaded to produce
+        it, such as superclasses and loadInstalled troves, is still the
+        latest version on its label in repos.
+    """
+
+    def __init__(self, path, repos):
+        self.path = path
+        self.repos = repos
+        self.db = None
+
+    def _getDb(self):
+        if self.db is None:
+            util.mkdirChain(self.path)
+            self.db = dbstore.connect(os.path.join(self.path, 'cache.db'),
+                                      driver='sqlite', timeout=30000)
+            cu = self.db.cursor()
+            cu.execute("""CREATE TABLE IF NOT EXISTS LoadResults (
+                            hash        TEXT PRIMARY KEY,
+                            data        BLOB NOT NULL)""")
+            self.db.commit()
+        return self.db
+
+    def getResults(self, hashes):
+        """
+            Returns a dict of hash to LoadTroveResult for each of hashes
+            that has a current result stored.
+        """
+        cu = self._getDb().cursor()
+        results = {}
+        for hash in hashes:
+            cu.execute("SELECT data FROM LoadResults WHERE hash = ?", hash)
+            row = cu.fetchone()
+            if row is not None:
+                data = marshal.loads(zlib.decompress(str(row[0])))
+                results[hash] = thaw('LoadTroveResult', data)
+        return self._getCurrent(results)
+
+    def _getCurrent(self, results):
+        query = {}
+        for result in results.itervalues():
+            for n, v, f in result.loadedTroves:
+                query.setdefault(n, {})[v.trailingLabel()] = None
+        if not query:
+            return results
+        try:
+            latest = self.repos.getTroveLatestByLabel(query)
+        except Exception, err:
+            log.warning('Could not check cached recipe load results: %s'
+                        % err)
+            return {}
+        current = {}
+        for hash, result in results.iteritems():
+            for n, v, f in result.loadedTroves:
+                if v not in latest.get(n, {}):
+                    break
+            else:
+                current[hash] = result
+        return current
+
+    def put(self, hash, result):
+        data = zlib.compress(marshal.dumps(freeze('LoadTroveResult', result)))
+        db = self._getDb()
+        cu = db.cursor()
+        try:
+            cu.execute("""INSERT OR REPLACE INTO LoadResults
+                          (hash, data) VALUES (?, ?)""",
+                       hash, cu.binary(data))
+            db.commit()
+        except DatabaseLocked:
+            db.rollback()
+
 class RemoveHostRepos(object):
     def __init__(self, troveSource, host):
         self.troveSource = troveSource
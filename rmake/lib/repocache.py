@@ -19,12 +19,17 @@
 Cache of changesets.
 """
 from StringIO import StringIO
+import errno
+import fcntl
 import os
 import itertools
 import tempfile
+import time
 
+from conary import dbstore
 from conary import trove
 
+from conary.dbstore.sqlerrors import DatabaseLocked
 from conary.deps import deps
 from conary.lib import sha1helper
 from conary.lib import util
@@ -33,6 +38,8 @@ from conary.repository import datastore
 from conary.repository import errors
 from conary.repository import filecontents
 
+from rmake.lib import procutil
+
 
 class CachingTroveSource:
     def __init__(self, troveSource, cacheDir, readOnly=False, depsOnly=False):
@@ -91,13 +98,25 @@ class RepositoryCache(object):
     """
         We cache changeset files by component.  When conary is fixed, we'll
         be able to combine the download of these troves.
+
+        Every cached file is recorded in an index, with its size and the
+        last time it was used.  If sizeLimit is set and the cache grows
+        past it, a background process removes the least recently used
+        files.  Files used in the last keepRecent seconds are never
+        removed, as a chroot may still be installing from them.
     """
-    def __init__(self, cacheDir, readOnly=False, depsOnly=False):
+    keepRecent = 3600
+
+    def __init__(self, cacheDir, readOnly=False, depsOnly=False,
+                 downloadWorkers=1, sizeLimit=0):
         self.root = cacheDir
         self.store = DataStore(cacheDir)
         self.readOnly = readOnly
         self.depsOnly = depsOnly
+        self.downloadWorkers = downloadWorkers
+        self.sizeLimit = sizeLimit
         self.fileCache = LazyFileCache(100)
+        self.index = CacheIndex(os.path.join(cacheDir, 'index.db'))
 
     def hashGroupDeps(self, groupTroves, depClass, dependency):
         depSet = deps.DependencySet()
@@ -151,6 +170,8 @@ class RepositoryCache(object):
         allToFind = []
         allFound = []
         allMissing = []
+        hits = []
+        added = []
         for depSet in depList:
             d = {}
             toFind = deps.DependencySet()
@@ -166,6 +187,7 @@ class RepositoryCache(object):
                     outFile = self.store.openFile(depHash)
                     results = DependencyResultList(outFile.read()).get()
                     found.append(results)
+                    hits.append(depHash)
                 else:
                     toFind.addDep(depClass, dependency)
                     found.append(None)
@@ -190,6 +212,8 @@ class RepositoryCache(object):
                     s.write(depResultList.freeze())
                     s.seek(0)
                     self.store.addFile(s, depHash, integrityCheck=False)
+                    added.append(self._getEntry(depHash))
+        self._updateIndex(added, hits, sum(len(x) for x in allMissing))
         allResults = {}
         for result, depSet in itertools.izip(allFound, depList):
             allResults[depSet] = result
@@ -218,7 +242,15 @@ class RepositoryCache(object):
         return results
 
     def getChangeSets(self, repos, jobList, withFiles=True,
-                      withFileContents=True, callback=None):
+                      withFileContents=True, callback=None, stats=None):
+        """
+            Returns a changeset for each job in jobList, downloading the
+            ones that are not cached yet.  With downloadWorkers > 1 they
+            are downloaded that many at a time, by forked processes that
+            each open their own connections to the repository, so repos
+            should not have been used yet.  Downloads are counted in
+            stats, a DownloadStats, if given.
+        """
         for job in jobList:
             if job[1][0]:
                 raise CacheError('can only cache install,'
@@ -226,53 +258,121 @@ class RepositoryCache(object):
             if job[3]:
                 raise CacheError('Cannot cache absolute changesets')
 
+        if stats is None:
+            stats = DownloadStats()
         changesets = [None for x in jobList]
         needed = []
+        hits = []
         for idx, job in enumerate(jobList):
             csHash = str(self.hashTrove(job[0], job[2][0], job[2][1],
                                         withFiles, withFileContents))
             if self.store.hasFile(csHash):
-                outFile = self.fileCache.open(self.store.hashToPath(csHash))
-                #outFile = self.store.openRawFile(csHash)
-                changesets[idx] = changeset.ChangeSetFromFile(outFile)
-            else:
-                needed.append((job, csHash, idx))
-
+                try:
+                    changesets[idx] = self._openChangeSet(csHash)
+                except (IOError, OSError), err:
+                    # removed by a prune since hasFile() was called
+                    if err.errno != errno.ENOENT:
+                        raise
+                else:
+                    stats.cached += 1
+                    hits.append(csHash)
+                    continue
+            needed.append((job, csHash, idx))
 
         total = len(needed)
-        for idx, (job, csHash, csIndex) in enumerate(needed):
+        start = time.time()
+        stored = set()
+        if self.downloadWorkers > 1 and not self.readOnly and total > 1:
+            stored = self._downloadInWorkers(repos, needed, withFiles,
+                                             withFileContents, callback,
+                                             stats)
+        for job, csHash, csIndex in needed:
+            if csIndex in stored:
+                changesets[csIndex] = self._openChangeSet(csHash)
+                continue
             if callback:
-                callback.setChangesetHunk(idx + 1, total)
+                callback.setChangesetHunk(len(stored) + 1, total)
 
             cs = repos.createChangeSet([job], recurse=False,
                                        callback=callback, withFiles=withFiles,
                                        withFileContents=withFileContents)
+            stats.roundTrips += 1
+            stored.add(csIndex)
             if self.readOnly:
                 changesets[csIndex] = cs
                 continue
 
-            hashPath = self.store.hashToPath(csHash)
-            self.store.makeDir(hashPath)
-            dirPath = os.path.dirname(hashPath)
-            fileName = os.path.basename(hashPath)
-            tmpFd, tmpName = tempfile.mkstemp(prefix=fileName, dir=dirPath)
-            os.close(tmpFd)
-            cs.writeToFile(tmpName)
+            tmpName = self._writeToTemp(cs, csHash)
             del cs
             # we could use this changeset, but 
             # cs.reset() is not necessarily reliable,
             # so instead we re-read from disk
+            stats.bytes += os.path.getsize(tmpName)
             self.store.addFileFromTemp(csHash, tmpName)
-
-            outFile = self.fileCache.open(self.store.hashToPath(csHash))
-            #outFile = self.store.openRawFile(csHash)
-            changesets[csIndex] = changeset.ChangeSetFromFile(outFile)
+            changesets[csIndex] = self._openChangeSet(csHash)
+        if total:
+            stats.elapsed += time.time() - start
+        added = []
+        if not self.readOnly:
+            added = [ self._getEntry(x[1]) for x in needed ]
+        self._updateIndex(added, hits, total)
 
         return changesets
 
+    def _openChangeSet(self, csHash):
+        outFile = self.fileCache.open(self.store.hashToPath(csHash))
+        #outFile = self.store.openRawFile(csHash)
+        return changeset.ChangeSetFromFile(outFile)
+
+    def _writeToTemp(self, cs, csHash):
+        hashPath = self.store.hashToPath(csHash)
+        self.store.makeDir(hashPath)
+        dirPath = os.path.dirname(hashPath)
+        fileName = os.path.basename(hashPath)
+        tmpFd, tmpName = tempfile.mkstemp(prefix=fileName, dir=dirPath)
+        os.close(tmpFd)
+        cs.writeToFile(tmpName)
+        return tmpName
+
+    def _downloadInWorkers(self, repos, needed, withFiles, withFileContents,
+                           callback, stats):
+        """
+            Download the changesets in needed across downloadWorkers forked
+            processes, each taking every downloadWorkers'th job and writing
+            its changesets next to their place in the store.  Each one is
+            moved into the store as soon as it is reported.  Returns the
+            indexes of the stored jobs; a worker that fails leaves the
+            rest of its jobs for the caller to download, so that the
+            error is raised there.
+        """
+        workers = min(self.downloadWorkers, len(needed))
+        for job, csHash, csIndex in needed:
+            self.store.makeDir(self.store.hashToPath(csHash))
+
+        def work(shard):
+            for job, csHash, csIndex in needed[shard::workers]:
+                cs = repos.createChangeSet([job], recurse=False,
+                                           withFiles=withFiles,
+                                           withFileContents=withFileContents)
+                tmpName = self._writeToTemp(cs, csHash)
+                del cs
+                yield csIndex, csHash, tmpName
+
+        stored = set()
+        for shard, (csIndex, csHash, tmpName) in procutil.forkWorkers(
+                                                            workers, work):
+            stats.roundTrips += 1
+            stats.bytes += os.path.getsize(tmpName)
+            self.store.addFileFromTemp(csHash, tmpName)
+            stored.add(csIndex)
+            if callback:
+                callback.setChangesetHunk(len(stored), len(needed))
+        return stored
+
     def getFileContents(self, repos, fileList, callback=None):
         contents = []
         needed = []
+        hits = []
         for idx, item in enumerate(fileList):
             fileId, fileVersion = item[0:2]
 
@@ -281,6 +381,7 @@ class RepositoryCache(object):
                 f = self.store.openFile(fileHash)
                 content = filecontents.FromFile(f)
                 contents.append(content)
+                hits.append(fileHash)
             else:
                 contents.append(None)
                 needed.append((idx, (fileId, fileVersion), fileHash))
@@ -289,11 +390,14 @@ class RepositoryCache(object):
         newContents = repos.getFileContents([x[1] for x in needed],
                                             callback=callback)
         itemList = itertools.izip(newContents, needed)
+        added = []
         for content, (idx, (fileId, fileVersion), fileHash) in itemList:
             if not self.readOnly:
                 self.store.addFile(content.get(), fileHash,
                                    integrityCheck=False)
+                added.append(self._getEntry(fileHash))
             contents[idx] = content
+        self._updateIndex(added, hits, total)
 
         return contents
 
@@ -306,6 +410,260 @@ class RepositoryCache(object):
             paths.append(self.store.hashToPath(fileHash))
         return paths
 
+    def getStats(self):
+        """
+            Returns a dict with the number of cache hits and misses, the
+            bytes that hits did not have to download, the number of
+            entries removed by pruning, and the number of entries in the
+            cache and their total size in bytes.
+        """
+        return self.index.getStats()
+
+    def syncIndex(self):
+        """
+            Index files that were cached before the index existed, and
+            drop entries whose files are gone.
+        """
+        indexed = set(x[0] for x in self.index.listEntries())
+        root = os.path.normpath(self.root)
+        onDisk = set()
+        added = []
+        for dirPath, dirNames, fileNames in os.walk(root):
+            for fileName in fileNames:
+                path = os.path.join(dirPath, fileName)
+                hash = path[len(root):].replace(os.sep, '')
+                if len(hash) != 40:
+                    # the index itself, or a temporary file
+                    continue
+                onDisk.add(hash)
+                if hash not in indexed:
+                    st = os.stat(path)
+                    added.append((hash, st.st_size, int(st.st_mtime)))
+        self.index.update(added=added, wait=True)
+        self.index.removeEntries(indexed - onDisk)
+        self.index.setSynced()
+
+    def prune(self, sizeLimit=None, sync=True):
+        """
+            Remove the least recently used files until the cache is no
+            larger than sizeLimit bytes, by default the cache's own limit.
+            The index is synced with the files on disk first if sync is
+            set or it never has been.  Returns the number of files and
+            bytes removed.
+        """
+        if sizeLimit is None:
+            sizeLimit = self.sizeLimit
+        if not sizeLimit:
+            return 0, 0
+        if sync or not self.index.getStats()['synced']:
+            self.syncIndex()
+        total = self.index.getStats()['size']
+        cutoff = time.time() - self.keepRecent
+        removed = []
+        freed = 0
+        for hash, size, lastUsed, hits in self.index.listEntries():
+            if total - freed <= sizeLimit or lastUsed > cutoff:
+                break
+            util.removeIfExists(self.store.hashToPath(hash))
+            removed.append(hash)
+            freed += size
+        self.index.removeEntries(removed, evicted=True)
+        return len(removed), freed
+
+    def _getEntry(self, hash):
+        path = self.store.hashToPath(hash)
+        return hash, os.path.getsize(path), int(time.time())
+
+    def _updateIndex(self, added=(), hits=(), misses=0):
+        if self.readOnly:
+            return
+        self.index.update(added, hits, misses)
+        if added and self.sizeLimit:
+            self._pruneInBackground()
+
+    def _pruneInBackground(self):
+        """
+            Prune the cache to 90% of its size limit, if it is over the
+            limit, from a detached process so that the caller does not
+            wait for it.
+        """
+        if self.index.getStats()['size'] <= self.sizeLimit:
+            return
+        def prune():
+            # sqlite connections must not be shared with the parent
+            self.index = CacheIndex(self.index.path)
+            lockFile = open(os.path.join(self.root, 'prune.lock'), 'w')
+            try:
+                fcntl.flock(lockFile, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except IOError:
+                # another process is already pruning
+                return
+            self.prune(int(self.sizeLimit * .9), sync=False)
+        procutil.runInBackground(prune, os.path.join(self.root, 'prune.log'))
+
+def removeCache(cacheDir):
+    """
+        Remove every file cached in C{cacheDir}, along with the index,
+        leaving the directory itself.
+    """
+    for name in os.listdir(cacheDir):
+        path = os.path.join(cacheDir, name)
+        if os.path.isdir(path):
+            util.rmtree(path)
+        else:
+            # the index and the prune lock and log
+            os.remove(path)
+
+class CacheIndex(object):
+    """
+        Records the size, time of last use and number of hits of each file
+        in a RepositoryCache, and counts hits, misses, the bytes that hits
+        saved downloading and the files removed by pruning.
+
+        Hits and new entries are recorded through a second connection that
+        waits at most updateTimeout milliseconds for the index, as they
+        are recorded while setting up chroots.
+    """
+    updateTimeout = 1000
+
+    def __init__(self, path):
+        self.path = path
+        self.db = None
+        self.updateDb = None
+
+    def _getDb(self):
+        if self.db is None:
+            util.mkdirChain(os.path.dirname(self.path))
+            self.db = dbstore.connect(self.path, driver='sqlite',
+                                      timeout=30000)
+            cu = self.db.cursor()
+            cu.execute("""CREATE TABLE IF NOT EXISTS CacheEntries (
+                            hash        TEXT PRIMARY KEY,
+                            size        INTEGER NOT NULL,
+                            lastUsed    INTEGER NOT NULL,
+                            hits        INTEGER NOT NULL DEFAULT 0)""")
+            cu.execute("""CREATE INDEX IF NOT EXISTS CacheEntriesLastUsedIdx
+                            ON CacheEntries(lastUsed)""")
+            cu.execute("""CREATE TABLE IF NOT EXISTS CacheStats (
+                            name        TEXT PRIMARY KEY,
+                            value       INTEGER NOT NULL)""")
+            for name in ('hits', 'misses', 'bytesSaved', 'evicted', 'synced'):
+                cu.execute("""INSERT OR IGNORE INTO CacheStats
+                              (name, value) VALUES (?, 0)""", name)
+            self.db.commit()
+        return self.db
+
+    def _getUpdateDb(self):
+        if self.updateDb is None:
+            # create the tables first
+            self._getDb()
+            self.updateDb = dbstore.connect(self.path, driver='sqlite',
+                                            timeout=self.updateTimeout)
+        return self.updateDb
+
+    def _count(self, cu, name, value):
+        if value:
+            cu.execute("UPDATE CacheStats SET value = value + ?"
+                       " WHERE name = ?", value, name)
+
+    def update(self, added=(), hits=(), misses=0, wait=False):
+        """
+            Record new entries, as (hash, size, lastUsed) tuples, the hashes
+            of the entries that were used, and the number of lookups that
+            missed.  Unless wait is set, nothing is recorded if the index
+            stays locked for longer than updateTimeout.
+        """
+        if not (added or hits or misses):
+            return
+        now = int(time.time())
+        if wait:
+            db = self._getDb()
+        else:
+            db = self._getUpdateDb()
+        try:
+            cu = db.cursor()
+            for hash, size, lastUsed in added:
+                cu.execute("""INSERT OR REPLACE INTO CacheEntries
+                              (hash, size, lastUsed, hits)
+                              VALUES (?, ?, ?, 0)""", hash, size, lastUsed)
+            saved = 0
+            for hash in hits:
+                cu.execute("SELECT size FROM CacheEntries WHERE hash = ?",
+                           hash)
+                row = cu.fetchone()
+                if row is None:
+                    # cached before the index existed; syncIndex adds it
+                    continue
+                saved += row[0]
+                cu.execute("""UPDATE CacheEntries
+                              SET lastUsed = ?, hits = hits + 1
+                              WHERE hash = ?""", now, hash)
+            self._count(cu, 'hits', len(hits))
+            self._count(cu, 'misses', misses)
+            self._count(cu, 'bytesSaved', saved)
+            db.commit()
+        except DatabaseLocked:
+            db.rollback()
+            if wait:
+                raise
+            # bookkeeping only, not worth waiting for.
+
+    def setSynced(self):
+        db = self._getDb()
+        db.cursor().execute("UPDATE CacheStats SET value = ?"
+                            " WHERE name = 'synced'", int(time.time()))
+        db.commit()
+
+    def removeEntries(self, hashes, evicted=False):
+        hashes = list(hashes)
+        if not hashes:
+            return
+        db = self._getDb()
+        cu = db.cursor()
+        for hash in hashes:
+            cu.execute("DELETE FROM CacheEntries WHERE hash = ?", hash)
+        if evicted:
+            self._count(cu, 'evicted', len(hashes))
+        db.commit()
+
+    def listEntries(self):
+        """
+            Returns (hash, size, lastUsed, hits) for every entry, least
+            recently used first.
+        """
+        cu = self._getDb().cursor()
+        cu.execute("""SELECT hash, size, lastUsed, hits FROM CacheEntries
+                      ORDER BY lastUsed""")
+        return [ tuple(x) for x in cu.fetchall() ]
+
+    def getStats(self):
+        cu = self._getDb().cursor()
+        cu.execute("SELECT name, value FROM CacheStats")
+        stats = dict(cu.fetchall())
+        cu.execute("SELECT COUNT(*), SUM(size) FROM CacheEntries")
+        entries, size = cu.fetchone()
+        stats.update(entries=entries, size=size or 0)
+        return stats
+
+class DownloadStats(object):
+    """
+        Changeset downloads made by RepositoryCache.getChangeSets, with
+        the time spent waiting for them.
+    """
+    def __init__(self):
+        self.cached = 0
+        self.roundTrips = 0
+        self.bytes = 0
+        self.elapsed = 0.0
+
+    def getRate(self):
+        """
+            Returns bytes downloaded per second.
+        """
+        if not self.elapsed:
+            return 0.0
+        return self.bytes / self.elapsed
+
 class DataStore(datastore.DataStore):
     def addFileFromTemp(self, hash, tmpPath):
         """
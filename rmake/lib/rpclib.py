@@ -20,6 +20,7 @@ Classes for extracting and examining authentification methods passed from
 external servers
 """
 import base64
+import errno
 import fcntl
 import IN
 import pwd
@@ -32,6 +33,7 @@ import socket
 import SocketServer
 import struct
 import urllib
+from StringIO import StringIO
 
 from rmake.lib import localrpc
 from rmake.lib import xmlrpc_null
@@ -212,9 +214,11 @@ class DelayableXMLRPCRequestHandler(QuietXMLRPCRequestHandler):
             # SimpleXMLRPCDispatcher. To maintain backwards compatibility,
             # check to see if a subclass implements _dispatch and dispatch
             # using that method if present.
-            self.server._marshaled_dispatch(data,
-                                        StreamXMLRPCResponseHandler(self),
-                                        self.headers)
+            responseHandler = StreamXMLRPCResponseHandler(self)
+            self.server._marshaled_dispatch(data, responseHandler,
+                                            self.headers)
+            if responseHandler.isDelayed():
+                self.server.delayRequest(self.request)
         except: # This should only happen if the module is buggy
             # internal error, report as HTTP server error
             self.send_response(500)
@@ -226,10 +230,22 @@ class DelayableXMLRPCRequestHandler(QuietXMLRPCRequestHandler):
     def _finish(self):
         SimpleXMLRPCRequestHandler.finish(self)
 
+def serializeResponse(response):
+    if isinstance(response, xmlrpclib.Fault):
+        response = xmlrpc_null.dumps(response)
+    else:
+        response = (response,)
+        response = xmlrpc_null.dumps(response, methodresponse=1)
+    return response
+
 class XMLRPCResponseHandler(object):
     def __init__(self, request, debug=True):
         self.request = request
         self.debug = debug
+        self._delayed = False
+
+    def isDelayed(self):
+        return self._delayed
 
     def callResponseFn(self, fn, *args, **kw):
         try:
@@ -273,12 +289,7 @@ class XMLRPCResponseHandler(object):
             os._exit(1)
 
     def serializeResponse(self, response):
-        if isinstance(response, xmlrpclib.Fault):
-            response = xmlrpc_null.dumps(response)
-        else:
-            response = (response,)
-            response = xmlrpc_null.dumps(response, methodresponse=1)
-        return response
+        return serializeResponse(response)
 
     def sendResponse(self, response):
         try:
@@ -291,14 +302,28 @@ class XMLRPCResponseHandler(object):
                 self._delayed = True
                 return
             response = self.serializeResponse(response)
-            self.transferResponse(response)
-            self.close()
         except:
-            # internal error, report as HTTP server error
-            self.sendInternalError()
+            self._sendError()
+            return
+        self.sendSerializedResponse(response)
+
+    def sendSerializedResponse(self, responseString):
+        """
+            Send a response that has already been through
+            serializeResponse, possibly in another process.
+        """
+        try:
+            self.transferResponse(responseString)
             self.close()
-            self.request.send_response(500)
-            self.request.end_headers()
+        except:
+            self._sendError()
+
+    def _sendError(self):
+        # internal error, report as HTTP server error
+        self.sendInternalError()
+        self.close()
+        self.request.send_response(500)
+        self.request.end_headers()
 
 
 class StreamXMLRPCResponseHandler(XMLRPCResponseHandler):
@@ -323,6 +348,69 @@ class StreamXMLRPCResponseHandler(XMLRPCResponseHandler):
         self.request.end_headers()
         self.request.wfile.write(responseString)
 
+    def getHTTPResponse(self, responseString):
+        """
+            Return what transferResponse would write to the client for
+            C{responseString}, headers included.
+        """
+        wfile = self.request.wfile
+        self.request.wfile = StringIO()
+        try:
+            self.transferResponse(responseString)
+            return self.request.wfile.getvalue()
+        finally:
+            self.request.wfile = wfile
+
+
+class ResponseWriter(object):
+    """
+        Sends a serialized response to the client as the connection
+        becomes writable, so that a client that reads slowly does not
+        stall the process sending it.  Call write() each time fileno() is
+        ready for writing until it returns True.
+
+        SSL connections are written with one blocking write.
+    """
+
+    def __init__(self, responseHandler, responseString):
+        self.responseHandler = responseHandler
+        self.responseString = responseString
+        self.connection = responseHandler.request.connection
+        if SSL and isinstance(self.connection, SSLConnection):
+            self.data = None
+        else:
+            self.data = responseHandler.getHTTPResponse(responseString)
+            self.connection.setblocking(0)
+        self.offset = 0
+
+    def fileno(self):
+        return self.connection.fileno()
+
+    def write(self):
+        """
+            Write as much of the response as the client will take without
+            blocking.  Returns True once the whole response is sent and
+            the connection closed.
+        """
+        if self.data is None:
+            self.responseHandler.sendSerializedResponse(self.responseString)
+            return True
+        while self.offset < len(self.data):
+            try:
+                self.offset += self.connection.send(buffer(self.data,
+                                                           self.offset))
+            except socket.error, err:
+                if err.args[0] in (errno.EAGAIN, errno.EINTR):
+                    return False
+                # the client went away
+                break
+        self.connection.setblocking(1)
+        try:
+            self.responseHandler.close()
+        except socket.error:
+            pass
+        return True
+
 class ResponseModifier(object):
     pass
 
@@ -333,12 +421,17 @@ class DelayedResponse(ResponseModifier):
     pass
 
 class DelayableXMLRPCDispatcher(SimpleXMLRPCDispatcher):
+    # SocketServer's default backlog of 5 resets connections as soon as a
+    # handful of clients connect while a request is being handled.
+    request_queue_size = 128
+
     def __init__(self):
         if sys.version[0:3] == '2.4':
             SimpleXMLRPCDispatcher.__init__(self)
         else:
             SimpleXMLRPCDispatcher.__init__(self, False, None)
         self.authMethod = None
+        self._delayedRequests = set()
 
     def setAuthMethod(self, authMethod):
         self.authMethod = authMethod
@@ -353,6 +446,28 @@ class DelayableXMLRPCDispatcher(SimpleXMLRPCDispatcher):
         self.auth = self._getAuth(request, client_address)
         return True
 
+    def delayRequest(self, request):
+        """
+            Keep request open after it has been handled, because its
+            response will be sent later.
+        """
+        self._delayedRequests.add(request)
+
+    # The connection for a delayed request is closed by its response
+    # handler once the response is sent.  Python 2.7 shuts down the
+    # connection first (shutdown_request), older versions only close it.
+    def shutdown_request(self, request):
+        if request in self._delayedRequests:
+            self._delayedRequests.discard(request)
+            return
+        SocketServer.TCPServer.shutdown_request(self, request)
+
+    def close_request(self, request):
+        if request in self._delayedRequests:
+            self._delayedRequests.discard(request)
+            return
+        SocketServer.TCPServer.close_request(self, request)
+
     def _marshaled_dispatch(self, data, responseHandler, headers):
         params, method = xmlrpc_null.loads(data)
         if self.auth:
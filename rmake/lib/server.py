@@ -19,7 +19,9 @@
 Utility server that manages child processes.
 """
 import errno
+import fcntl
 import os
+import select
 import signal
 import sys
 import time
@@ -29,8 +31,13 @@ from conary.lib import coveragehook
 
 from rmake import errors
 from rmake.lib import logger as logger_
+from rmake.lib import pipereader
 
 class Server(object):
+    # (read fd, write fd) of the pipe written to when a child exits,
+    # see _watchChildren.
+    _childWakeup = None
+
     def __init__(self, logger=None):
         if logger is None:
             logger = logger_.Logger()
@@ -159,6 +166,80 @@ class Server(object):
     def _resetSignalHandlers(self):
         signal.signal(signal.SIGTERM, signal.SIG_DFL)
         signal.signal(signal.SIGINT, signal.default_int_handler)
+        if self._childWakeup is not None:
+            signal.set_wakeup_fd(-1)
+            signal.signal(signal.SIGCHLD, signal.SIG_DFL)
+            for fd in self._childWakeup:
+                os.close(fd)
+            self._childWakeup = None
+
+    def _watchChildren(self):
+        """
+            Makes the death of a child process wake up _waitForInput
+            immediately instead of waiting for its timeout to expire.
+
+            A SIGCHLD handler is installed that writes to a pipe that
+            _waitForInput polls along with its other file descriptors.
+        """
+        if self._childWakeup is not None:
+            return
+        inF, outF = pipereader.makePipes()
+        for fd in (inF, outF):
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self._childWakeup = (inF, outF)
+        signal.signal(signal.SIGCHLD, self._childSignalHandler)
+        # restart system calls interrupted by SIGCHLD where possible.
+        signal.siginterrupt(signal.SIGCHLD, False)
+        signal.set_wakeup_fd(outF)
+
+    def _childSignalHandler(self, sigNum, frame):
+        # The write to the wakeup pipe is done by the interpreter itself,
+        # there's nothing left to do here.
+        pass
+
+    def _waitForInput(self, readers, timeout=None):
+        """
+            Waits until one of readers is ready to be read from, a child
+            process exits (if _watchChildren has been called) or timeout
+            seconds pass.  A timeout of None waits forever.
+
+            Readers whose fileno() raises IOError because they have already
+            been closed are skipped.
+
+            @return: list of readers that are ready to be read.
+        """
+        poller = select.poll()
+        readersByFd = {}
+        for reader in readers:
+            try:
+                fd = reader.fileno()
+            except IOError:
+                continue
+            readersByFd[fd] = reader
+            poller.register(fd, select.POLLIN | select.POLLPRI)
+        if self._childWakeup is not None:
+            poller.register(self._childWakeup[0], select.POLLIN)
+        if timeout is not None:
+            timeout = int(timeout * 1000)
+        try:
+            events = poller.poll(timeout)
+        except select.error, err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return []
+        ready = []
+        for fd, event in events:
+            if fd in readersByFd:
+                ready.append(readersByFd[fd])
+            elif self._childWakeup is not None and fd == self._childWakeup[0]:
+                try:
+                    while os.read(fd, 4096):
+                        pass
+                except OSError, err:
+                    if err.errno != errno.EAGAIN:
+                        raise
+        return ready
 
     def _signalHandler(self, sigNum, frame):
         # if they rekill, we just exit
@@ -29,6 +29,7 @@ import socket
 import sys
 import time
 
+from rmake.messagebus import eventloop
 from rmake.messagebus import logger
 from rmake.messagebus import messages
 from rmake.messagebus import messageprocessor
@@ -188,7 +189,7 @@ class _SessionClient(asyncore.dispatcher):
                  user=None, password=None, sessionClass='', 
                  connectionTimeout=0, subscriptions=None):
         self.callback = callback
-        self._map = {}
+        self._map = eventloop.EventMap()
         self.messageProcessor = messageprocessor.MessageProcessor()
 
         asyncore.dispatcher.__init__(self, None, self._map)
@@ -208,6 +209,8 @@ class _SessionClient(asyncore.dispatcher):
         self.logger = logger
         self.outMessages = []
         self.subscriptions = subscriptions
+        # negotiated with the message bus when connecting
+        self.payloadEncoding = messages.PAYLOAD_XMLRPC
 
     def __repr__(self):
         return "SessionDispatcher(sessionId=%r)" % (self.sessionId)
@@ -286,7 +289,8 @@ class _SessionClient(asyncore.dispatcher):
         self._movedData = True
         try:
             m = self.messageProcessor.processData(self.recv,
-                                                  self.bufferSize)
+                                                  self.bufferSize,
+                                                  self.recv_into)
         except socket.error, e:
             self.handle_error()
             return
@@ -300,11 +304,15 @@ class _SessionClient(asyncore.dispatcher):
             else:
                 self.handle_message(m)
 
+    def recv_into(self, buf, nbytes):
+        return messageprocessor.recvInto(self, buf, nbytes)
+
     def handle_message(self, m):
         self.logger.logMessage(m)
         if isinstance(m, messages.ConnectedResponse):
             self.logger.setSessionId(m.getSessionId())
             self.sessionId = m.headers.sessionId
+            self.payloadEncoding = m.getSessionPayloadEncoding()
             # send any queued messages that were waiting for 
             # connection to be confirmed
             for outM in self.outMessages:
@@ -345,7 +353,9 @@ class _SessionClient(asyncore.dispatcher):
             return
         elif self.sessionId:
             self.stamp(m)
+            m.setPayloadEncoding(self.payloadEncoding)
         self.messageProcessor.sendMessage(m)
+        self._map.wantWrite(self._fileno)
 
     def stamp(self, m):
         messageId = '%s:%s' % (self.sessionId , self.count)
@@ -363,7 +373,7 @@ class _SessionClient(asyncore.dispatcher):
         self._movedData = True
         while count < maxIterations:
             self._movedData = False
-            asyncore.poll2(timeout=timeout, map=self._map)
+            self._map.poll(timeout)
             if not self._movedData:
                 break
             count += 1
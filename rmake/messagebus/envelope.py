@@ -217,75 +217,56 @@ class PHeader(object):
             return False
 
 class EnvelopeWriter(object):
+    """
+        Writes an envelope out through streamWriter, which may write only
+        part of what it is given and returns how much it wrote (or None if
+        it wrote everything).  The lead and header are framed into one
+        string and the payload is read once; partial writes are tracked by
+        offset and resent as buffer()s, so nothing is copied again.
+    """
     def __init__(self, envelope):
         self._envelope = envelope
-        self._leadWritten = False
-        self._headerWritten = False
-        self._lead = None
-        self._header = None
-        self._buf = None
-        self._bytesWritten = 0
+        self._parts = None
+        self._offset = 0
 
-    def __call__(self, streamWriter):
+    def _frame(self):
         envelope = self._envelope
-        if self._header is None:
-            # Freeze header first to set message size
-            self._header = envelope._header.freeze()
-            envelope._lead.msgHeaderSize.set(len(self._header))
-            self._lead = envelope._lead.freeze()
-
-        if not self._leadWritten:
-            rc = streamWriter(self._lead)
-            if rc is None:
-                rc = len(self._lead)
-
-            self._lead = self._lead[rc:]
-            if not self._lead:
-                self._leadWritten = True
-            else:
-                return False
-        if not self._headerWritten:
-            rc = streamWriter(self._header)
-            if rc is None:
-                rc = len(self._header)
-            self._header = self._header[rc:]
-            if not self._header:
-                self._headerWritten = True
-            else:
-                return False
+        # Freeze header first to set message size
+        header = envelope._header.freeze()
+        envelope._lead.msgHeaderSize.set(len(header))
+        parts = [envelope._lead.freeze() + header]
 
-        # Write payload
+        payloadSize = envelope._lead.msgPayloadSize()
         if envelope._payloadStream is None:
             # No payload
-            return True
+            if payloadSize > 0:
+                raise ValueError
+            return parts
+        payload = envelope._getPayloadData()
+        if len(payload) != payloadSize:
+            raise ValueError('payload stream has %s bytes, expected %s'
+                             % (len(payload), payloadSize))
+        if payload:
+            parts.append(payload)
+        return parts
 
-        # Rewind payload stream
-        envelope._payloadStream.seek(0)
-
-        payloadSize = envelope._lead.msgPayloadSize()
-        if payloadSize > 0 and envelope._payloadStream is None:
-            raise ValueError
-
-        if self._buf is None:
-            self._bytesRead = 0
-            self._bytesWritten = 0
-            self._buf = ''
-        if self._bytesWritten < payloadSize:
-            if not self._buf:
-                envelope._payloadStream.seek(self._bytesRead)
-                toRead = payloadSize - self._bytesRead
-                self._buf = envelope._payloadStream.read(toRead)
-                self._bytesRead += len(self._buf)
-                if not self._buf:
-                    return False
-            rc = streamWriter(self._buf)
+    def __call__(self, streamWriter):
+        if self._parts is None:
+            self._parts = self._frame()
+        while self._parts:
+            part = self._parts[0]
+            if self._offset:
+                rc = streamWriter(buffer(part, self._offset))
+            else:
+                rc = streamWriter(part)
             if rc is None:
-                rc = len(self._buf)
-            self._bytesWritten += rc
-            self._buf = self._buf[rc:]
-        if self._bytesWritten == payloadSize:
-            self._buf = None
-            return True
+                rc = len(part) - self._offset
+            self._offset += rc
+            if self._offset < len(part):
+                return False
+            self._parts.pop(0)
+            self._offset = 0
+        return True
 
 class Envelope(object):
     def __init__(self):
@@ -299,6 +280,11 @@ class Envelope(object):
         self._incHeader = None
         self._incPayload = None
         self._writer = None
+        # payload data cached by _getPayloadData
+        self._payloadData = None
+        # payload being read with readInto
+        self._payloadBuffer = None
+        self._payloadRead = 0
 
     def thawLead(self, streamReader):
         """Read the lead from the stream"""
@@ -317,6 +303,7 @@ class Envelope(object):
 
     def setPayloadStream(self, stream):
         self._payloadStream = stream
+        self._payloadData = None
 
     def setHeaderSize(self, size):
         return self._lead.msgHeaderSize.set(size)
@@ -342,6 +329,17 @@ class Envelope(object):
     def getWriter(self):
         return EnvelopeWriter(self)
 
+    def _getPayloadData(self):
+        """
+            Returns the payload as a string, read once and shared by all
+            writers of this envelope.
+        """
+        if self._payloadData is None:
+            stream = self._payloadStream
+            stream.seek(0)
+            self._payloadData = stream.read(self._lead.msgPayloadSize())
+        return self._payloadData
+
     def freezeToStream(self, streamWriter):
         """
             Note - with this you can't write this message out to 
@@ -366,12 +364,14 @@ class Envelope(object):
         if s is not None:
             return s.getvalue()
 
-    def thawFromStream(self, streamReader, blocking=False):
+    def thawFromStream(self, streamReader, blocking=False, readInto=None):
         """
         If blocking is True, the read from the stream is blocking.
         Returns True if thawing the message succeded, False if a short read
         happened (and the lead + header could not be completely read). False
         cannot be returned if blocking is True.
+        If readInto is given, it is called like socket.recv_into to read
+        the payload straight into a buffer of the right size.
         """
         if (self._incLead, self._incHeader, self._incPayload) == \
                 (None, None, None):
@@ -379,6 +379,9 @@ class Envelope(object):
             self._incPayload = True
 
             self._payloadStream = StringIO()
+            self._payloadData = None
+            self._payloadBuffer = None
+            self._payloadRead = 0
 
         while 1:
             if self._incLead:
@@ -395,7 +398,14 @@ class Envelope(object):
                     return False
                 continue
 
-            if self._incPayload:
+            if self._incPayload and readInto is not None:
+                self._incPayload = not self._readPayloadInto(readInto)
+                if self._incPayload:
+                    if not blocking:
+                        return False
+                    continue
+
+            elif self._incPayload:
                 payloadSize = self._lead.msgPayloadSize()
                 toRead = payloadSize - self._payloadStream.tell()
                 assert toRead > 0, toRead
@@ -424,6 +434,23 @@ class Envelope(object):
         self._payloadStream.seek(0)
         return True
 
+    def _readPayloadInto(self, readInto):
+        payloadSize = self._lead.msgPayloadSize()
+        if self._payloadBuffer is None:
+            self._payloadBuffer = bytearray(payloadSize)
+            self._payloadRead = 0
+        toRead = payloadSize - self._payloadRead
+        assert toRead > 0, toRead
+
+        view = memoryview(self._payloadBuffer)[self._payloadRead:]
+        self._payloadRead += readInto(view, toRead)
+        if self._payloadRead < payloadSize:
+            return False
+        # wraps the buffer without copying it
+        self._payloadStream = StringIO(self._payloadBuffer)
+        self._payloadBuffer = None
+        return True
+
     def hasCompleteLead(self):
         """Returns True if he lead was read"""
         return not self._incLead
@@ -463,6 +490,13 @@ class Envelope(object):
         """Writes the data into the message"""
         if self._payloadStream is None:
             self._payloadStream = StringIO()
+        elif not hasattr(self._payloadStream, 'write'):
+            # read-only stream from thawFromStream
+            stream = self._payloadStream
+            self._payloadStream = StringIO()
+            self._payloadStream.write(stream.getvalue())
+            self._payloadStream.seek(stream.tell())
+        self._payloadData = None
 
         self._payloadStream.write(data)
 
@@ -476,6 +510,7 @@ class Envelope(object):
         return self._payloadStream.tell()
 
     def truncate(self, size=None):
+        self._payloadData = None
         if size:
             self._payloadStream.truncate(size)
         else:
@@ -0,0 +1,154 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+    epoll-backed socket map for asyncore dispatchers.
+
+    asyncore.poll2 builds a new poll set from every dispatcher in the map
+    each time it is called, asking each one whether it is readable and
+    writable.  With hundreds of sessions on the message bus that is most
+    of the work done per loop.  EventMap keeps its sockets registered with
+    a single epoll object instead, and only asks for write events while a
+    dispatcher has something to send.
+"""
+import asyncore
+import errno
+import fcntl
+import os
+import select
+
+_READ_EVENTS = getattr(select, 'EPOLLIN', 0) | getattr(select, 'EPOLLPRI', 0)
+_WRITE_EVENTS = getattr(select, 'EPOLLOUT', 0)
+
+
+class EventMap(dict):
+    """
+        Drop-in replacement for the dict asyncore uses as a socket map.
+
+        asyncore adds and removes dispatchers by setting and deleting keys,
+        which is when sockets are registered and unregistered.  Dispatchers
+        must call wantWrite() after queueing data; write interest is
+        dropped again the first time the socket is writable with nothing
+        left to send.
+    """
+
+    def __init__(self):
+        dict.__init__(self)
+        self._writers = set()
+        self._poller = None
+        self._pid = None
+        self._reset()
+
+    def _reset(self):
+        # epoll sets are shared across fork, so a forked child that polls
+        # needs its own.
+        if self._poller is not None:
+            self._poller.close()
+        self._pid = os.getpid()
+        if not hasattr(select, 'epoll'):
+            return
+        self._poller = select.epoll()
+        fd = self._poller.fileno()
+        fcntl.fcntl(fd, fcntl.F_SETFD,
+                    fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+        for fd in self:
+            self._register(fd)
+
+    def _register(self, fd):
+        events = _READ_EVENTS
+        if fd in self._writers:
+            events |= _WRITE_EVENTS
+        try:
+            self._poller.register(fd, events)
+        except IOError, err:
+            if err.args[0] != errno.EEXIST:
+                raise
+            self._poller.modify(fd, events)
+
+    def __setitem__(self, fd, obj):
+        dict.__setitem__(self, fd, obj)
+        if obj.writable() and not obj.accepting:
+            self._writers.add(fd)
+        else:
+            self._writers.discard(fd)
+        if self._poller is not None:
+            self._register(fd)
+
+    def __delitem__(self, fd):
+        dict.__delitem__(self, fd)
+        self._writers.discard(fd)
+        if self._poller is not None:
+            try:
+                self._poller.unregister(fd)
+            except (IOError, ValueError):
+                # already closed
+                pass
+
+    def clear(self):
+        for fd in self.keys():
+            del self[fd]
+
+    def close(self):
+        self.clear()
+        if self._poller is not None:
+            self._poller.close()
+            self._poller = None
+
+    def wantWrite(self, fd):
+        """
+            Ask for write events on fd, until it has nothing left to send.
+        """
+        if fd not in self or fd in self._writers:
+            return
+        self._writers.add(fd)
+        if self._poller is not None:
+            self._poller.modify(fd, _READ_EVENTS | _WRITE_EVENTS)
+
+    def _stopWrite(self, fd):
+        self._writers.discard(fd)
+        self._poller.modify(fd, _READ_EVENTS)
+
+    def poll(self, timeout=0.0):
+        """
+            Wait up to timeout seconds for events and dispatch them,
+            like asyncore.poll2.
+        """
+        if self._pid != os.getpid():
+            self._reset()
+        if self._poller is None:
+            asyncore.poll2(timeout=timeout, map=self)
+            return
+        if timeout is None:
+            timeout = -1
+        try:
+            events = self._poller.poll(timeout)
+        except IOError, err:
+            if err.args[0] != errno.EINTR:
+                raise
+            return
+        for fd, flags in events:
+            obj = self.get(fd)
+            if obj is None:
+                # closed by an earlier handler
+                continue
+            if (flags & _WRITE_EVENTS and fd in self._writers
+                and obj.connected and not obj.writable()):
+                self._stopWrite(fd)
+                flags &= ~_WRITE_EVENTS
+                if not flags:
+                    continue
+            asyncore.readwrite(obj, flags)
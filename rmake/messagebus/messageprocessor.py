@@ -15,6 +15,9 @@
 #
 
 
+import asyncore
+import collections
+import socket
 import StringIO
 import cPickle
 import xmlrpclib
@@ -22,19 +25,42 @@ import xmlrpclib
 from rmake.messagebus import envelope
 from rmake.messagebus import messages
 
+class QueueFull(Exception):
+    "Raised when a message is sent to a session whose send queue is full."
+
+
+def recvInto(dispatcher, buf, nbytes):
+    """
+        socket.recv_into for an asyncore dispatcher, handling a closed
+        connection the way asyncore.dispatcher.recv does.
+    """
+    try:
+        count = dispatcher.socket.recv_into(buf, nbytes)
+    except socket.error, why:
+        if why.args[0] in asyncore._DISCONNECTED:
+            dispatcher.handle_close()
+            return 0
+        raise
+    if not count:
+        # a closed connection
+        dispatcher.handle_close()
+    return count
+
+
 class MessageProcessor(object):
-    def __init__(self):
-        self.messageQueue = []
+    def __init__(self, maxQueue=None):
+        self.messageQueue = collections.deque()
+        self.maxQueue = maxQueue
         self.partialReadEnvelope = None
         self.partialWriteEnvelope = None
 
-    def processData(self, streamReader, maxRead):
+    def processData(self, streamReader, maxRead, readInto=None):
         if self.partialReadEnvelope:
             e = self.partialReadEnvelope
         else:
             e = envelope.Envelope()
 
-        if e.thawFromStream(streamReader):
+        if e.thawFromStream(streamReader, readInto=readInto):
             self.partialReadEnvelope = None
             m = self.extractMessage(e)
             return m
@@ -49,6 +75,8 @@ class MessageProcessor(object):
         return m
 
     def sendMessage(self, message):
+        if self.maxQueue and len(self.messageQueue) >= self.maxQueue:
+            raise QueueFull('%s messages already queued' % self.maxQueue)
         headers, payloadStream, payloadSize = message.freeze()
         e = envelope.Envelope()
         e.setHeaders(headers)
@@ -66,7 +94,7 @@ class MessageProcessor(object):
         if self.partialWriteEnvelope:
             e, writer = self.partialWriteEnvelope
         elif self.messageQueue:
-            e = self.messageQueue.pop(0)
+            e = self.messageQueue.popleft()
             writer = e.getWriter()
         else:
             return
@@ -15,9 +15,148 @@
 #
 
 
+import marshal
 import StringIO
+import struct
+import zlib
+
 from rmake.lib import xmlrpc_null
 
+# Payload encodings, in order of preference.  Sessions offer the encodings
+# they understand when connecting and the message bus picks the first one
+# both sides support.  Peers that offer nothing only get XML-RPC.
+PAYLOAD_MARSHAL = 'marshal'
+PAYLOAD_XMLRPC = 'xmlrpc'
+PAYLOAD_ENCODINGS = (PAYLOAD_MARSHAL, PAYLOAD_XMLRPC)
+
+# marshal payloads larger than this are sent compressed.
+COMPRESS_THRESHOLD = 8192
+
+def negotiatePayloadEncoding(offered):
+    """
+        Pick the payload encoding to use for a session from the
+        comma-separated list of encodings it offered.
+    """
+    offered = set(x.strip() for x in offered.split(','))
+    for encoding in PAYLOAD_ENCODINGS:
+        if encoding in offered:
+            return encoding
+    return PAYLOAD_XMLRPC
+
+def encodePayload(d, encoding):
+    """
+        Encode a payload dict.  Returns the encoded string and the value of
+        the payloadEncoding header that describes it.
+    """
+    if encoding == PAYLOAD_MARSHAL:
+        try:
+            frz = marshal.dumps(d)
+        except ValueError:
+            # something marshal can't handle, XML-RPC might.
+            pass
+        else:
+            if len(frz) > COMPRESS_THRESHOLD:
+                return zlib.compress(frz, 1), PAYLOAD_MARSHAL + '+zlib'
+            return frz, PAYLOAD_MARSHAL
+    return xmlrpc_null.dumps((d,), allow_none=True), ''
+
+def decodePayload(frz, encoding):
+    """
+        Decode a payload encoded as described by a payloadEncoding header.
+    """
+    if not encoding or encoding == PAYLOAD_XMLRPC:
+        return xmlrpc_null.loads(frz)[0][0]
+    encoding = encoding.split('+')
+    if encoding[1:] == ['zlib']:
+        frz = zlib.decompress(frz)
+    elif encoding[1:]:
+        raise RuntimeError('Unknown payload compression %s' % encoding[1])
+    if encoding[0] != PAYLOAD_MARSHAL:
+        raise RuntimeError('Unknown payload encoding %s' % encoding[0])
+    # any bus peer can send a marshal payload, so check it before
+    # marshal.loads() sees it.
+    _checkMarshal(frz)
+    # payloads are thawed by code that expects what XML-RPC returns.
+    return _listify(marshal.loads(frz))
+
+# marshal type codes that may appear in a payload, with the size of their
+# fixed-size data.  Everything a payload can hold in XML-RPC is here;
+# code objects, sets and the like are not.
+_marshalSizes = {'0': 0, 'N': 0, 'F': 0, 'T': 0,
+                 'i': 4, 'I': 8, 'g': 8}
+
+def _readMarshalInt(frz, pos):
+    if pos + 4 > len(frz):
+        raise RuntimeError('Bad marshal payload: truncated')
+    return struct.unpack('<i', frz[pos:pos + 4])[0]
+
+def _checkMarshal(frz):
+    """
+        Raise RuntimeError unless frz is marshal data made only of the
+        types an XML-RPC payload could hold.  marshal.loads() is not safe
+        against malformed or malicious data.
+    """
+    pos = 0
+    interned = 0
+    # items left to read in each open container, -1 for a dict, which is
+    # read up to its '0' terminator.
+    toRead = [1]
+    while toRead:
+        if not toRead[-1]:
+            toRead.pop()
+            continue
+        if pos >= len(frz):
+            raise RuntimeError('Bad marshal payload: truncated')
+        code = frz[pos]
+        pos += 1
+        if toRead[-1] > 0:
+            toRead[-1] -= 1
+        if code in _marshalSizes:
+            if code == '0':
+                if toRead[-1] != -1:
+                    raise RuntimeError('Bad marshal payload: misplaced null')
+                toRead.pop()
+            pos += _marshalSizes[code]
+        elif code == 'l':
+            pos += 4 + 2 * abs(_readMarshalInt(frz, pos))
+        elif code == 'f':
+            if pos >= len(frz):
+                raise RuntimeError('Bad marshal payload: truncated')
+            pos += 1 + ord(frz[pos])
+        elif code in 'stu':
+            size = _readMarshalInt(frz, pos)
+            if size < 0:
+                raise RuntimeError('Bad marshal payload: bad size')
+            pos += 4 + size
+            if code == 't':
+                interned += 1
+        elif code == 'R':
+            if not 0 <= _readMarshalInt(frz, pos) < interned:
+                raise RuntimeError('Bad marshal payload: bad string reference')
+            pos += 4
+        elif code in '([':
+            size = _readMarshalInt(frz, pos)
+            if size < 0:
+                raise RuntimeError('Bad marshal payload: bad size')
+            pos += 4
+            toRead.append(size)
+        elif code == '{':
+            toRead.append(-1)
+        else:
+            raise RuntimeError('Bad marshal payload: type %r not allowed'
+                               % code)
+        if pos > len(frz):
+            raise RuntimeError('Bad marshal payload: truncated')
+    if pos != len(frz):
+        raise RuntimeError('Bad marshal payload: trailing data')
+
+def _listify(item):
+    if isinstance(item, (tuple, list)):
+        return [ _listify(x) for x in item ]
+    elif isinstance(item, dict):
+        return dict((x[0], _listify(x[1])) for x in item.iteritems())
+    return item
+
 
 class MessageHeaders(object):
     def __setattr__(self, key, value):
@@ -102,6 +241,7 @@ class _Message:
         self.headers.messageId = '<no messageId>'
         self.headers.sessionId ='<no sessionId>'
         self.headers.timeStamp = 0
+        self._payloadEncoding = PAYLOAD_XMLRPC
         if args or kw:
             self.set(*args, **kw)
 
@@ -138,6 +278,28 @@ class _Message:
     def getTimestamp(self):
         return float(self.headers.timeStamp)
 
+    def setPayloadEncoding(self, encoding):
+        """
+            Set the encoding to use when this message's payload is frozen.
+        """
+        if encoding == self._payloadEncoding:
+            return
+        self._payloadEncoding = encoding
+        if (self._payload.getStream()
+            and [ x for x in self._payload.__dict__ if x[0] != '_' ]):
+            # frozen with the old encoding, refreeze when next needed.
+            # Payloads that were never thawed keep their stream, it
+            # carries its own payloadEncoding header.
+            self._payload._stream = None
+            self._payload._streamSize = 0
+            self._payload._thawed = True
+
+    def getPayloadEncoding(self):
+        """
+            Returns the payloadEncoding header of the frozen payload.
+        """
+        return getattr(self.headers, 'payloadEncoding', '')
+
     def thawPayloadStream(self):
         if self._payload._thawed:
             return
@@ -150,12 +312,14 @@ class _Message:
         self._payload.__dict__.update(d)
 
     def loadPayloadFromString(self, frz):
-        d = xmlrpc_null.loads(frz)[0][0]
+        d = decodePayload(frz, self.getPayloadEncoding())
         self.loadPayloadFromDict(d)
         self.payload._thawed = True
 
     def payloadToString(self):
-        return xmlrpc_null.dumps((self.payloadToDict(),), allow_none=True)
+        frz, self.headers.payloadEncoding = encodePayload(
+                                self.payloadToDict(), self._payloadEncoding)
+        return frz
 
     def payloadToDict(self):
         return dict((x[0], x[1]) for x in 
@@ -187,7 +351,9 @@ class _Message:
         self.payload.setStream(stream, size)
 
     def freeze(self):
-        return ( self.headers.__dict__, self.getPayloadStream(),
+        # freezing the payload sets the payloadEncoding header
+        payloadStream = self.getPayloadStream()
+        return ( self.headers.__dict__, payloadStream,
                  self.getPayloadStreamSize() )
 
     def thaw(self, headers, payload):
@@ -206,11 +372,12 @@ class ConnectionRequest(_Message):
     messageType = 'CONNECT'
 
     def set(self, user, password, sessionClass='', sessionId='',
-            subscriptions=None):
+            subscriptions=None, payloadEncodings=PAYLOAD_ENCODINGS):
         self.headers.user = user
         self.headers.password = password
         self.headers.requestedSessionId = sessionId
         self.headers.sessionClass = sessionClass
+        self.headers.payloadEncodings = ','.join(payloadEncodings)
         if subscriptions is None:
             subscriptions = []
         self.payload.subscriptions = subscriptions
@@ -221,11 +388,18 @@ class ConnectionRequest(_Message):
     def getSubscriptions(self):
         return self.payload.subscriptions
 
+    def getPayloadEncodings(self):
+        return getattr(self.headers, 'payloadEncodings', '')
+
 class ConnectedResponse(_Message):
     messageType = 'CONNECTED'
 
-    def set(self, sessionId):
+    def set(self, sessionId, payloadEncoding=PAYLOAD_XMLRPC):
         self.headers.sessionId = sessionId
+        self.headers.sessionPayloadEncoding = payloadEncoding
+
+    def getSessionPayloadEncoding(self):
+        return getattr(self.headers, 'sessionPayloadEncoding', PAYLOAD_XMLRPC)
 
 class SubscribeRequest(_Message):
     messageType = 'SUBSCRIBE'
@@ -308,6 +482,26 @@ class NodeStatus(Message):
         return self.headers.status == 'DISCONNECTED'
 
 
+def recodeMessage(m, encoding):
+    """
+        Return m with its payload in the given encoding, for passing on
+        to a session that negotiated a different encoding than the
+        sender's.  The payload is not thawed into objects.
+    """
+    # freezing the payload, if needed, sets the payloadEncoding header
+    stream = m.getPayloadStream()
+    current = m.getPayloadEncoding()
+    if (not current or current == PAYLOAD_XMLRPC
+        or current.split('+')[0] == encoding):
+        # everyone understands XML-RPC
+        return m
+    stream.seek(0)
+    d = decodePayload(stream.read(m.getPayloadStreamSize()), current)
+    frz, newEncoding = encodePayload(d, encoding)
+    headers = dict(m.headers.__dict__)
+    headers['payloadEncoding'] = newEncoding
+    return thawMessage(headers, StringIO.StringIO(frz), len(frz))
+
 def thawMessage(headers, payloadStream, payloadSize):
     messageType = headers['messageType']
     if messageType in _messageTypes:
@@ -24,6 +24,7 @@
     The DispatcherClient provides and XMLRPC-over-messagebus interface
     to the dispatcher for querying the dispatcher status out-of-band.
 """
+import heapq
 import os
 import signal
 
@@ -106,6 +107,9 @@ class DispatcherServer(server.Server):
     def getNamesByIds(self, idList):
             return self._nodes.getNamesByIds(idList)
 
+    def getOpenSlotCount(self):
+        return self._nodes.getOpenSlotCount()
+
     def requestCommandAssignment(self, *commands):
         """
             Entry point from message bus to assign commands.  We
@@ -289,6 +293,11 @@ class DispatcherNodeClient(nodeclient.NodeClient):
     def getNamesByIds(self, callData, idList):
         return self.server.getNamesByIds(idList)
 
+    @api(version=1)
+    @api_return(1, None)
+    def getOpenSlotCount(self, callData):
+        return self.server.getOpenSlotCount()
+
     @api(version=1)
     @api_parameters(1, None, None)
     @api_return(1, None)
@@ -354,6 +363,9 @@ class DispatcherRPCClient(object):
     def getNamesByIds(self, idList):
         return self.proxy.getNamesByIds(idList)
 
+    def getOpenSlotCount(self):
+        return self.proxy.getOpenSlotCount()
+
     def suspendNodes(self, idList, suspend=True):
         return self.proxy.suspendNodes(idList, suspend)
 
@@ -367,12 +379,17 @@ class NodeList(object):
         self._openChroots = {}
         self._commandsByJob = {}
         self._suspended = set()
+        # frozenset of flavors -> set of sessionIds that can build them
+        self._flavorCache = {}
         self.nodeDb = nodeDb
         self.logger = logger
 
     def add(self, sessionId, node):
         node.sessionId = sessionId
         self._nodes[sessionId] = node
+        for flavors, eligible in self._flavorCache.iteritems():
+            if self._canBuildFlavors(node, flavors):
+                eligible.add(sessionId)
         self._assignedCommands[sessionId] = []
         self._openSlots[sessionId] = node.slots
         self._openChroots[sessionId] = node.chrootLimit
@@ -387,6 +404,8 @@ class NodeList(object):
         self._openSlots.pop(sessionId, None)
         self._openChroots.pop(sessionId, None)
         self._suspended.discard(sessionId)
+        for eligible in self._flavorCache.itervalues():
+            eligible.discard(sessionId)
 
     def suspend(self, sessionId):
         if sessionId not in self._nodes:
@@ -423,10 +442,11 @@ class NodeList(object):
         else:
             return usedSlots / float(node.slots)
 
+    def _getRank(self, node):
+        return (self._getScore(node), int(node.nodeInfo.loadavg[0]))
+
     def rankNodes(self, nodeList):
-        return sorted(nodeList, key = lambda x: (self._getScore(x),
-                                                 int(x.nodeInfo.loadavg[0]),
-                                               ))
+        return sorted(nodeList, key=self._getRank)
 
     def getNodes(self):
         return self._nodes.values()
@@ -443,33 +463,55 @@ class NodeList(object):
         return [ x for x in availNodes
                  if x.nodeInfo.getLoadAverage(1) < x.loadThreshold ]
 
+    def getOpenSlotCount(self, requiresChroot=False):
+        """
+            Returns the total number of free slots on nodes that are
+            currently accepting commands.
+        """
+        return sum(self._openSlots[x.sessionId]
+                   for x in self.getOpenNodes(requiresChroot=requiresChroot))
+
     def getCommandAssignments(self):
         # returns commandId, sessionId pairs
         return [ (x[0], x[1][0]) for x in self._commands.items() ]
 
-    def getNodeForFlavors(self, flavors, requiresChroot=False):
-        nodes = []
-        for node in self.getOpenNodes(requiresChroot=requiresChroot):
-            if not flavors:
-                nodes.append(node)
-                continue
-            for flavor in flavors:
-                found = False
-                archFlavor = flavorutil.getArchFlags(flavor, getTarget=False,
-                                                     withFlags=False)
-                for buildFlavor in node.buildFlavors:
-                    filteredFlavor = deps.filterFlavor(flavor, [buildFlavor,
-                                                                archFlavor])
-                    if buildFlavor.stronglySatisfies(filteredFlavor):
-                        found = True
-                        break
-                if not found:
+    def _canBuildFlavors(self, node, flavors):
+        for flavor in flavors:
+            archFlavor = flavorutil.getArchFlags(flavor, getTarget=False,
+                                                 withFlags=False)
+            for buildFlavor in node.buildFlavors:
+                filteredFlavor = deps.filterFlavor(flavor, [buildFlavor,
+                                                            archFlavor])
+                if buildFlavor.stronglySatisfies(filteredFlavor):
                     break
-            if found:
-                nodes.append(node)
+            else:
+                return False
+        return True
+
+    def _getEligibleNodes(self, flavors):
+        """
+            Returns the set of sessionIds of nodes that can build all of
+            flavors, or None if there are no flavors to match.  Kept up to
+            date as nodes are added and removed.
+        """
+        if not flavors:
+            return None
+        flavors = frozenset(flavors)
+        eligible = self._flavorCache.get(flavors)
+        if eligible is None:
+            eligible = set(x.sessionId for x in self._nodes.itervalues()
+                           if self._canBuildFlavors(x, flavors))
+            self._flavorCache[flavors] = eligible
+        return eligible
+
+    def getNodeForFlavors(self, flavors, requiresChroot=False):
+        eligible = self._getEligibleNodes(flavors)
+        nodes = [ x for x in self.getOpenNodes(requiresChroot=requiresChroot)
+                  if eligible is None or x.sessionId in eligible ]
         if not nodes:
             return None
-        return self.rankNodes(nodes)[0]
+        # min() picks the first of equally ranked nodes, like rankNodes.
+        return min(nodes, key=self._getRank)
 
     def updateStatus(self, sessionId, nodeInfo, commandIds):
         #self.db.updateNode(sessionId, nodeInfo)
@@ -505,35 +547,72 @@ class NodeList(object):
             self._assignedCommands[sessionId].remove(command)
         return command
 
-    def _logDict(self, title, data):
-        self.logger.info('%s:' % title)
-        for item in sorted([ '\t%s: %s' % (x, y) for x, y in data.iteritems() ]):
-            self.logger.info(item)
-
     def assignCommand(self, command, node):
         sessionId = node.sessionId
         self._commands[command.getCommandId()] = sessionId, command
         self._commandsByJob.setdefault(command.getJobId(), []).append(
                                                                   command)
         self._assignedCommands[sessionId].append(command)
-        self._logDict('Current OpenSlots', self._openSlots)
         self._openSlots[sessionId] -= 1
         if command.requiresChroot():
-            self._logDict('Current OpenChroots', self._openChroots)
             self._openChroots[sessionId] -= 1
 
-        self.logger.info('assigned %s to %s' % (command.getCommandId(), node.host))
+        self.logger.info('assigned %s to %s (%s slots, %s chroots open)' % (
+                         command.getCommandId(), node.host,
+                         self._openSlots[sessionId],
+                         self._openChroots[sessionId]))
 
     def assignCommands(self, commands):
+        """
+            Assigns as many of commands as possible, in order, each to the
+            best ranked open node that can build it.  Returns a list of
+            (command, node) pairs.
+
+            Open nodes are kept in a heap ordered like rankNodes for each
+            distinct (flavors, requiresChroot) in commands.  Assigning a
+            command changes its node's rank, so heap entries carry a
+            version and stale ones are dropped when they reach the top.
+        """
+        openNodes = self.getOpenNodes()
+        position = dict((x.sessionId, idx) for idx, x in enumerate(openNodes))
+        versions = dict.fromkeys(position, 0)
+        def _entry(node):
+            sessionId = node.sessionId
+            return (self._getRank(node), position[sessionId],
+                    versions[sessionId], sessionId)
+
+        heaps = {}
         l = []
         for command in commands:
             flavors = command.getRequiredFlavors()
-            node = self.getNodeForFlavors(flavors,
-                                     requiresChroot=command.requiresChroot())
+            requiresChroot = command.requiresChroot()
+            key = (flavors and frozenset(flavors) or None, requiresChroot)
+            if key not in heaps:
+                eligible = self._getEligibleNodes(flavors)
+                heap = [ _entry(x) for x in openNodes
+                         if eligible is None or x.sessionId in eligible ]
+                heapq.heapify(heap)
+                heaps[key] = eligible, heap
+            eligible, heap = heaps[key]
+            node = None
+            while heap:
+                rank, idx, version, sessionId = heap[0]
+                if (version == versions[sessionId]
+                    and self._openSlots[sessionId] > 0
+                    and (not requiresChroot
+                         or self._openChroots[sessionId] > 0)):
+                    node = self._nodes[sessionId]
+                    break
+                heapq.heappop(heap)
             if node is None:
                 continue
             self.assignCommand(command, node)
             l.append((command, node))
+            versions[sessionId] += 1
+            if self._openSlots[sessionId] > 0:
+                for eligible, heap in heaps.itervalues():
+                    if eligible is None or sessionId in eligible:
+                        heapq.heappush(heap, _entry(node))
         return l
 
     def getCommandsForJob(self, jobId):
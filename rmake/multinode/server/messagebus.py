@@ -46,12 +46,16 @@ from rmake.lib import apirpc
 from rmake.lib.apiutils import api, api_parameters, api_return, freeze, thaw
 from rmake.lib.daemon import daemonize, setDebugHook
 
+from rmake.messagebus import eventloop
 from rmake.messagebus import logger
 from rmake.messagebus import messageprocessor
 from rmake.messagebus import messages
 from rmake.messagebus import rpclib
 from rmake.messagebus.busclient import ConnectionClosed
 
+# Messages that can be queued for a single session before the bus gives up
+# on it.
+SESSION_QUEUE_LIMIT = 10000
 
 class MessageBus(apirpc.ApiServer):
     """
@@ -63,11 +67,15 @@ class MessageBus(apirpc.ApiServer):
             host - host to listen for connections at, generally ''
             port - port to listen to connections at.  If 0, will be an open
                    port assigned by operating system.
+            maxQueue - number of messages that may be waiting to be sent
+                   to a session before it is disconnected as too slow.
     """
-    def __init__(self, host, port, logPath, messagePath=None):
+    def __init__(self, host, port, logPath, messagePath=None,
+                 maxQueue=SESSION_QUEUE_LIMIT):
         l = logger.MessageBusLogger('messagebus', logPath)
         apirpc.ApiServer.__init__(self, l)
-        self._map = {}
+        self._map = eventloop.EventMap()
+        self._maxQueue = maxQueue
         self._sessionCount = {}
         self._messageCount = 0
         self._pendingSessions = []
@@ -87,8 +95,10 @@ class MessageBus(apirpc.ApiServer):
         self._server.close()
         for session in self._pendingSessions:
             session.close()
-        for session in self._sessions.itervalues():
-            session.close()
+        for session in self._sessions.values():
+            if session:
+                session.close()
+        self._map.close()
 
     def listSessions(self):
         return [ x for x in self._sessions.values() if x is not None ]
@@ -132,6 +142,8 @@ class MessageBus(apirpc.ApiServer):
             self._sessionCount[session.hostname] += 1
 
         session.setSessionId(sessionId)
+        session.setPayloadEncoding(
+                messages.negotiatePayloadEncoding(m.getPayloadEncodings()))
         self._sessions[sessionId] = session
         self._pendingSessions.remove(session)
 
@@ -141,7 +153,7 @@ class MessageBus(apirpc.ApiServer):
         m.set(session.sessionId, status)
         self.sendMessage('/internal/nodes', m)
         m = messages.ConnectedResponse()
-        m.set(session.sessionId)
+        m.set(session.sessionId, session.getPayloadEncoding())
         session.sendMessage(m)
 
     def closeSession(self, session):
@@ -157,15 +169,18 @@ class MessageBus(apirpc.ApiServer):
     def getPort(self):
         return self._server.getPort()
 
+    def getMaxQueue(self):
+        return self._maxQueue
+
     def hasMessages(self):
         return bool([ x for x in self._sessions.itervalues() 
                       if x and x.writable()])
 
     def handleRequestIfReady(self, sleepTime):
-        asyncore.poll2(timeout=sleepTime, map=self._map)
+        self._map.poll(sleepTime)
 
     def serve_once(self):
-        asyncore.poll2(map=self._map)
+        self._map.poll()
 
     def sendMessage(self, destination, m):
         messageId = '%s:%s' % ('messagebus', self._messageCount)
@@ -241,7 +256,8 @@ class SessionManager(asyncore.dispatcher):
         SessionManager - manages one connection to the message bus.
     """
     def __init__(self, messageBus, sock, client_address, map, logger):
-        self.messageProcessor = messageprocessor.MessageProcessor()
+        self.messageProcessor = messageprocessor.MessageProcessor(
+                                        maxQueue=messageBus.getMaxQueue())
         self.messageBus = messageBus
         self.logger = logger
         self.bufferSize = 4096
@@ -252,9 +268,17 @@ class SessionManager(asyncore.dispatcher):
         self.socket = sock
         self.sessionId = None
         self.sessionClass = None
+        self.payloadEncoding = messages.PAYLOAD_XMLRPC
+        self._overflowed = False
         self._map = map
 
 
+    def setPayloadEncoding(self, encoding):
+        self.payloadEncoding = encoding
+
+    def getPayloadEncoding(self):
+        return self.payloadEncoding
+
     def setSessionClass(self, sessionClass):
         self.sessionClass = sessionClass
 
@@ -293,7 +317,8 @@ class SessionManager(asyncore.dispatcher):
 
     def handle_read(self):
         try:
-            m = self.messageProcessor.processData(self.recv, self.bufferSize)
+            m = self.messageProcessor.processData(self.recv, self.bufferSize,
+                                                  self.recv_into)
         except errors.uncatchableExceptions:
             raise
         except ConnectionClosed:
@@ -309,6 +334,9 @@ class SessionManager(asyncore.dispatcher):
             # this socket stops.
             raise ConnectionClosed
 
+    def recv_into(self, buf, nbytes):
+        return messageprocessor.recvInto(self, buf, nbytes)
+
     def handle_error(self):
         error = sys.exc_info()[1]
         if isinstance(error, ConnectionClosed):
@@ -332,7 +360,19 @@ class SessionManager(asyncore.dispatcher):
         """
             Queue a message to be sent to this session (non-blocking)
         """
-        self.messageProcessor.sendMessage(m)
+        if self._overflowed:
+            # being disconnected already
+            return
+        m = messages.recodeMessage(m, self.payloadEncoding)
+        try:
+            self.messageProcessor.sendMessage(m)
+        except messageprocessor.QueueFull, err:
+            self._overflowed = True
+            self.logger.error('Send queue for %s is full (%s), '
+                              'disconnecting' % (self.sessionId, err))
+            self.close()
+            return
+        self._map.wantWrite(self._fileno)
 
     def getQueuedMessages(self):
         return self.messageProcessor.getQueuedMessages()
@@ -365,14 +405,28 @@ class SubscriptionManager(object):
     """
         Sessions "subscribe" to different channels, on which they get
         their messages.  This manages those subscribers.
+
+        Subscriptions are indexed by channel and then by the first
+        attribute of their pattern and its value, so routing a message
+        only looks at subscriptions that can match it.
     """
     def __init__(self):
-        self._subscribers = {}
+        # channel -> _Channel
+        self._channels = {}
+        # id(session) -> list of (channel, subscriptionId, indexKey)
+        self._sessions = {}
+        self._count = 0
 
     def iterSubscribers(self, m):
-        lst = self._subscribers.get(m.headers.destination, [])
-        for subscriber, pattern in lst:
-            if m.getTargetId() and m.getTargetId() != subscriber.sessionId:
+        channel = self._channels.get(m.headers.destination)
+        if channel is None:
+            return
+        matches = channel.match(m.headers)
+        # deliver in the order subscriptions were made
+        matches.sort()
+        targetId = m.getTargetId()
+        for subscriptionId, (subscriber, pattern) in matches:
+            if targetId and targetId != subscriber.sessionId:
                 continue
             found = True
             for key, value in pattern.iteritems():
@@ -394,15 +448,81 @@ class SubscriptionManager(object):
             for attr in [attr] + rest:
                 key, value = urllib.splitvalue(attr)
                 pattern[key] = value
-        self._subscribers.setdefault(channel, []).append((session, pattern))
+        self._count += 1
+        subscriptionId = self._count
+        if channel not in self._channels:
+            self._channels[channel] = _Channel()
+        indexKey = self._channels[channel].add(subscriptionId, session,
+                                               pattern)
+        self._sessions.setdefault(id(session), []).append(
+                                        (channel, subscriptionId, indexKey))
 
     def deleteSubscriber(self, session):
         """
         Delete all subscriptions by a particular C{session}.
         """
-        for channel, subscribers in self._subscribers.items():
-            self._subscribers[channel] = [x for x in subscribers
-                    if x[0] is not session]
+        for channel, subscriptionId, indexKey in self._sessions.pop(
+                                                        id(session), []):
+            self._channels[channel].remove(subscriptionId, indexKey)
+            if not self._channels[channel]:
+                del self._channels[channel]
+
+
+class _Channel(object):
+    """
+        Subscriptions to one channel.  Each bucket maps subscription id
+        to (session, pattern).  Subscriptions without a pattern are all in
+        one bucket, the rest are bucketed by the first key of their
+        pattern and its value.
+    """
+    def __init__(self):
+        self.unfiltered = {}
+        # key -> value -> bucket
+        self.indexed = {}
+
+    def __nonzero__(self):
+        return bool(self.unfiltered or self.indexed)
+
+    def add(self, subscriptionId, session, pattern):
+        """
+            Add a subscription, returning the (key, value) it was indexed
+            under, or None.
+        """
+        if not pattern:
+            self.unfiltered[subscriptionId] = (session, pattern)
+            return None
+        key = min(pattern)
+        values = self.indexed.setdefault(key, {})
+        values.setdefault(pattern[key], {})[subscriptionId] = (session,
+                                                               pattern)
+        return key, pattern[key]
+
+    def remove(self, subscriptionId, indexKey):
+        if indexKey is None:
+            del self.unfiltered[subscriptionId]
+            return
+        key, value = indexKey
+        values = self.indexed[key]
+        del values[value][subscriptionId]
+        if not values[value]:
+            del values[value]
+            if not values:
+                del self.indexed[key]
+
+    def match(self, headers):
+        """
+            Returns (subscriptionId, (session, pattern)) for subscriptions
+            that could match a message with these headers.
+        """
+        matches = self.unfiltered.items()
+        for key, values in self.indexed.iteritems():
+            value = getattr(headers, key, None)
+            if value is None:
+                continue
+            bucket = values.get(value)
+            if bucket:
+                matches.extend(bucket.iteritems())
+        return matches
 
 
 class MessageBusListener(asyncore.dispatcher):
@@ -511,6 +631,8 @@ def main(args):
     parser.add_option('-P', '--pid-file')
     parser.add_option('-l', '--log-file')
     parser.add_option('-m', '--log-messages')
+    parser.add_option('-q', '--max-queue', default=SESSION_QUEUE_LIMIT,
+            help="Disconnect sessions with this many unsent messages")
     options, args = parser.parse_args(args)
     if args:
         parser.error("No arguments expected")
@@ -518,7 +640,8 @@ def main(args):
         parser.error("You must specify a log file")
 
     bus = MessageBus(options.bind, int(options.port),
-            options.log_file, options.log_messages)
+            options.log_file, options.log_messages,
+            maxQueue=int(options.max_queue))
 
     pidFile = None
     if options.pid_file:
@@ -29,6 +29,7 @@ from conary import command
 from rmake import constants
 from rmake import plugins
 from rmake.lib import daemon
+from rmake.lib import repocache
 from rmake.worker.chroot import rootmanager
 from rmake.multinode import workernode
 
@@ -40,16 +41,15 @@ class ResetCommand(daemon.DaemonCommand):
     help = 'Remove all job data from rmake'
 
     def runCommand(self, daemon, cfg, argSet, args):
-        for dir in (cfg.getBuildLogDir(),):
+        for dir in (cfg.getBuildLogDir(), cfg.getLoadCachePath()):
             if os.path.exists(dir):
                 print "Deleting %s" % dir
                 shutil.rmtree(dir)
 
         for dir in (cfg.getCacheDir(),):
             if os.path.exists(dir):
-                print "Deleting subdirectories of %s" % dir
-                for subDir in os.listdir(dir):
-                    shutil.rmtree(dir + '/' + subDir)
+                print "Deleting contents of %s" % dir
+                repocache.removeCache(dir)
         rootManager = rootmanager.ChrootManager(cfg)
         chroots = rootManager.listChroots()
         print "Deleting %s chroots" % len(chroots)
@@ -81,7 +81,8 @@ class rMakeNodeDaemon(daemon.Daemon):
     groups = [constants.chrootUser]
     capabilities = 'cap_sys_chroot+ep'
     commandList = list(daemon.Daemon.commandList) + \
-                  [ResetCommand, HelpCommand]
+                  [ResetCommand, daemon.CacheStatsCommand,
+                   daemon.PruneCacheCommand, HelpCommand]
 
     def getConfigFile(self, argv):
         self.plugins = plugins.getPluginManager(argv, nodecfg.NodeConfiguration)
@@ -18,6 +18,7 @@
 import select
 import time
 import urllib
+import zlib
 
 from conary.lib import util
 
@@ -46,10 +47,33 @@ class rMakeClient(object):
                            rMake server.
         @type clientCert: C{str}
     """
+    # largest piece of a build log fetched in one call
+    buildLogChunkSize = 1024 * 1024
+
     def __init__(self, uri, clientCert=None):
         self.uri = uri
         self.proxy = apirpc.XMLApiProxy(server.rMakeServer, uri,
             key_file=clientCert)
+        # methods the server turned out not to have
+        self._missingMethods = set()
+
+    def _callIfPresent(self, methodName, *args):
+        """
+            Call methodName on the server.  Returns (True, result), or
+            (False, None) if the server is too old to have the method.
+        """
+        if methodName in self._missingMethods:
+            return False, None
+        try:
+            return True, getattr(self.proxy, methodName)(*args)
+        except RuntimeError, err:
+            # older servers pass NoSuchMethodError back as a generic
+            # exception
+            if ('NoSuchMethodError: No such method: %s\n' % methodName
+                    not in str(err)):
+                raise
+            self._missingMethods.add(methodName)
+            return False, None
 
     def buildTroves(self, troveList, cfg):
         """
@@ -158,20 +182,80 @@ class rMakeClient(object):
         """
         return self.proxy.getTroveLogs(jobId, troveTuple, mark)
 
-    def getTroveBuildLog(self, jobId, troveTuple, mark=0):
+    def getJobLogsSince(self, jobId, logId=0):
         """
-            Return build log for trove.
+            Return the state logs for job that come after C{logId}.
+
+            @param jobId: jobId or UUID for job.
+            @param logId: id of the last log message already seen, or 0.
+            @rtype: list of (logId, timeStamp, message, args) tuples
+        """
+        found, logs = self._callIfPresent('getJobLogsSince', jobId, logId)
+        if found:
+            return logs
+        # for older servers, logId counts the logs already returned
+        return [ (logId + idx + 1,) + tuple(x)
+                 for idx, x in enumerate(self.getJobLogs(jobId, logId)) ]
+
+    def getTroveLogsSince(self, jobId, troveTuple, logId=0):
+        """
+            Return the state logs for trove that come after C{logId}.
+
+            @param jobId: jobId or UUID for job.
+            @param troveTuple: (name, version, flavor) for job.
+            @param logId: id of the last log message already seen, or 0.
+            @rtype: list of (logId, timeStamp, message, args) tuples
+        """
+        found, logs = self._callIfPresent('getTroveLogsSince', jobId,
+                                          troveTuple, logId)
+        if found:
+            return logs
+        # for older servers, logId counts the logs already returned
+        return [ (logId + idx + 1,) + tuple(x) for idx, x in
+                 enumerate(self.getTroveLogs(jobId, troveTuple, logId)) ]
+
+    def getTroveBuildLog(self, jobId, troveTuple, mark=0, maxSize=None,
+                         timeout=0):
+        """
+            Return build log for trove.  The log is transferred compressed,
+            in chunks of at most buildLogChunkSize bytes.
 
             @param jobId: jobId or UUID for job.
             @param troveTuple: (name, version, flavor) tuple for trove.
             @param mark: location in file to start reading logs from.
-            @return: (isBuilding, contents) tuple.  If isBuilding is True,
-            more logs may be available later.
-            @rtype: (boolean, string) tuple.
-        """
-        isBuilding, wrappedData, mark = self.proxy.getTroveBuildLog(jobId,
-                                                              troveTuple, mark)
-        return isBuilding, wrappedData.data, mark
+            If negative, start that many bytes from the end of the log.
+            @param maxSize: if given, return at most this many bytes.
+            Otherwise return everything up to the end of the log.
+            @param timeout: if the trove is building and there is no new
+            data past C{mark}, wait up to this many seconds for more.
+            @return: (isBuilding, contents, mark) tuple.  If isBuilding is
+            True, more logs may be available later.  Pass mark back in
+            to continue reading where this call left off.
+            @rtype: (boolean, string, int) tuple.
+        """
+        chunks = []
+        while True:
+            chunkSize = maxSize or self.buildLogChunkSize
+            found, rv = self._callIfPresent('getTroveBuildLogChunk', jobId,
+                                    troveTuple, mark, chunkSize, timeout, True)
+            if not found:
+                return self._getWholeTroveBuildLog(jobId, troveTuple, mark)
+            isBuilding, wrappedData, mark = rv
+            data = zlib.decompress(wrappedData.data)
+            chunks.append(data)
+            if maxSize or len(data) < chunkSize:
+                break
+            timeout = 0
+        return isBuilding, ''.join(chunks), mark
+
+    def _getWholeTroveBuildLog(self, jobId, troveTuple, mark):
+        # older servers return everything past mark in one piece
+        isBuilding, wrappedData, newMark = self.proxy.getTroveBuildLog(jobId,
+                                                troveTuple, max(mark, 0))
+        data = wrappedData.data
+        if mark < 0:
+            data = data[mark:]
+        return isBuilding, data, newMark
 
     def getJob(self, jobId, withTroves=True, withConfigs=False):
         """
@@ -196,6 +280,20 @@ class rMakeClient(object):
         return [ thaw('BuildJob', x)
                  for x in self.proxy.getJobs(jobIds, withTroves, withConfigs) ]
 
+    def getJobSummary(self, jobId):
+        """
+            Return a summary of the troves in a job.  Much cheaper than
+            getJob for large jobs, since no trove objects are sent.
+            @param jobId: jobId or UUID for job.
+            @rtype: dict with C{troveCounts}, a dict of trove counts by
+            state, and C{names}, C{contexts}, C{states}, C{starts} and
+            C{finishes}, parallel lists with an entry per trove.
+            @raises: JobNotFound if job does not exist.
+        """
+        summary = self.proxy.getJobSummary(jobId)
+        summary['troveCounts'] = dict(summary['troveCounts'])
+        return summary
+
     def listSubscribers(self, jobId):
         """
             Return subscribers for jobId
@@ -219,6 +317,26 @@ class rMakeClient(object):
     def deleteAllChroots(self):
         self.proxy.deleteAllChroots()
 
+    def listChrootCache(self):
+        """
+            Return the contents of the server's chroot cache, least
+            recently used first.
+            @rtype: list of (fingerprint, size, created, lastUsed, hits)
+            tuples.  Sizes are in bytes, created and lastUsed are
+            timestamps.
+        """
+        return [ (x[0], int(x[1])) + tuple(x[2:])
+                 for x in self.proxy.listChrootCache() ]
+
+    def getResolverCacheStats(self):
+        """
+            Return hit and miss counts for the server's resolver cache,
+            along with the number of cached results ('entries') and their
+            total size in bytes ('size').
+            @rtype: dict
+        """
+        return self.proxy.getResolverCacheStats()
+
     def connectToChroot(self, jobId, troveTuple, command, superUser=False,
                         chrootHost='', chrootPath=''):
         if not chrootPath:
@@ -30,7 +30,11 @@ from conary import command
 from rmake import compat
 from rmake import constants
 from rmake import plugins
+from rmake.build import buildjob
+from rmake.db import database
+from rmake.db import logstore
 from rmake.lib import daemon
+from rmake.lib import repocache
 from rmake.server import repos
 from rmake.server import servercfg
 from rmake.server import server
@@ -45,16 +49,15 @@ class ResetCommand(daemon.DaemonCommand):
     def runCommand(self, daemon, cfg, argSet, args):
         for dir in (cfg.getReposDir(), cfg.getBuildLogDir(),
                     cfg.getDbContentsPath(), cfg.getProxyDir(),
-                    cfg.getResolverCachePath()):
+                    cfg.getResolverCachePath(), cfg.getLoadCachePath()):
             if os.path.exists(dir):
                 print "Deleting %s" % dir
                 shutil.rmtree(dir)
 
         for dir in (cfg.getCacheDir(),):
             if os.path.exists(dir):
-                print "Deleting subdirectories of %s" % dir
-                for subDir in os.listdir(dir):
-                    shutil.rmtree(dir + '/' + subDir)
+                print "Deleting contents of %s" % dir
+                repocache.removeCache(dir)
         for path in (cfg.getDbPath()[1],):
             if os.path.exists(path):
                 print "Deleting %s" % path
@@ -65,6 +68,29 @@ class ResetCommand(daemon.DaemonCommand):
         for chroot in chroots:
             rootManager.deleteChroot(chroot)
 
+class CompressLogsCommand(daemon.DaemonCommand):
+    commands = ['compress-logs']
+
+    help = 'Compress build logs stored uncompressed'
+
+    def runCommand(self, daemon, cfg, argSet, args):
+        db = database.Database(cfg.getDbPath(), cfg.getDbContentsPath())
+        activeLogs = set()
+        for state in buildjob.ACTIVE_STATES:
+            for job in db.getJobsByState(state):
+                activeLogs.update(x.logPath for x in job.iterTroves())
+        count = totalSize = totalCompressed = 0
+        for path in db.logStore.iterUncompressedLogs():
+            if path in activeLogs:
+                continue
+            sizes = logstore.compressLog(path)
+            if sizes:
+                count += 1
+                totalSize += sizes[0]
+                totalCompressed += sizes[1]
+        print "Compressed %d logs from %d to %d bytes" % (count, totalSize,
+                                                          totalCompressed)
+
 class HelpCommand(daemon.DaemonCommand, command.HelpCommand):
     commands = ['help']
 
@@ -80,7 +106,11 @@ class rMakeDaemon(daemon.Daemon):
     user = constants.rmakeUser
     groups = [constants.chrootUser]
     capabilities = 'cap_sys_chroot+ep'
-    commandList = list(daemon.Daemon.commandList) + [ResetCommand, HelpCommand]
+    commandList = list(daemon.Daemon.commandList) + [ResetCommand,
+                                                     CompressLogsCommand,
+                                                     daemon.CacheStatsCommand,
+                                                     daemon.PruneCacheCommand,
+                                                     HelpCommand]
 
     def getConfigFile(self, argv):
         p = plugins.getPluginManager(argv, servercfg.rMakeConfiguration)
@@ -15,15 +15,28 @@
 #
 
 
+
+import errno
+import fcntl
 import os
+import Queue
+import select
+import socket
+import threading
 import time
 import traceback
 
+from rmake import constants
 from rmake.lib import pipereader
+from rmake.lib.apiutils import freeze, thaw
 
 class _RmakeServerPublisher(object):
     """
         Sends job events from Rmake Server ->  Subscribers
+
+        Events are queued here and handed over a pipe to a long-lived
+        delivery process (see _EventDeliveryProcess), which is restarted
+        if it dies.
     """
     def __init__(self, logger, db, forkCommand=os.fork):
         self.db = db
@@ -34,48 +47,64 @@ class _RmakeServerPublisher(object):
         self.recentErrors = []
         self.errorTimes = []
         self._events = {}
+        self._eventTimes = {}              # jobId -> time of oldest event
         self.reader = None
-        # event queuing code - to eventually be moved to a separate 
-        # process
-        # min length of time between emits
-        self._emitEventTimeThreshold = .2
-        # max # of issues to queue before emit (overrides time threshold)
-        self._emitEventSizeThreshold = 10  
-        self._numEvents = 0                # number of queued events
-        self._lastEmit = time.time()       # time of last emit
-        self._emitPid = 0                  # pid for rudimentary locking
+        self.writer = None
+        self._emitPid = 0                  # pid of the delivery process
+        self.stats = {}                    # last stats from delivery process
 
     def addEvent(self, jobId, eventList):
         self._events.setdefault(jobId, []).extend(eventList)
-        self._numEvents += len(eventList)
+        self._eventTimes.setdefault(jobId, time.time())
+
+    def subscriberAdded(self, jobId):
+        """
+            Drop the delivery process's cached subscriber lookups for
+            jobId, so that events sent from now on reach the new subscriber.
+        """
+        if self._emitPid:
+            self.writer.send(('subscribed', jobId))
 
     def emitEvents(self):
         self.harvestErrors()
-        if not self._events or self._emitPid:
-            return
-        if ((time.time() - self._lastEmit) < self._emitEventTimeThreshold
-            and self._numEvents < self._emitEventSizeThreshold):
-            return
-        events = self._events
-        self._events = {}
-        self.reader, writer = pipereader.makeMarshalPipes()
+        if self._events:
+            if not self._emitPid:
+                self._startDeliveryProcess()
+            batch = []
+            for jobId, eventList in self._events.iteritems():
+                eventList = freeze('EventList',
+                            (constants.subscriberApiVersion, eventList))[1]
+                batch.append((jobId, self._eventTimes[jobId], eventList))
+            self._events = {}
+            self._eventTimes = {}
+            self.writer.send(('events', batch))
+        if self.writer:
+            # the pipe is non-blocking, so this only writes what fits
+            while self.writer.handleWriteIfReady(sleep=0):
+                pass
+
+    def _startDeliveryProcess(self):
+        self.reader, childWriter = pipereader.makeMarshalPipes()
+        childReader, self.writer = pipereader.makeMarshalPipes()
         pid = self._fork('emitEvents')
         if pid:
-            writer.close()
-            self._numEvents = 0
-            self._lastEmit = time.time()
+            childReader.close()
+            childWriter.close()
+            fd = self.writer.fileno()
+            fcntl.fcntl(fd, fcntl.F_SETFL,
+                        fcntl.fcntl(fd, fcntl.F_GETFL) | os.O_NONBLOCK)
             self._emitPid = pid
-            #self.debug('_emitEvents forked pid %d' % pid)
             return
         self.reader.close()
+        self.writer.close()
         try:
             try:
-                for jobId, eventList in events.iteritems():
-                    self.db.reopen()
-                    self._emitEvents(jobId, eventList, writer)
+                self.db.reopen()
+                _EventDeliveryProcess(self.logger, self.db, childReader,
+                                      childWriter).run()
                 os._exit(0)
             except Exception, err:
-                self.logger.error('Emit Events failed: %s\n%s', err, 
+                self.logger.error('Emit Events failed: %s\n%s', err,
                                   traceback.format_exc())
                 os._exit(1)
         finally:
@@ -84,18 +113,40 @@ class _RmakeServerPublisher(object):
     def _pidDied(self, pid, status, name=None):
         if pid == self._emitPid:
             self._emitPid = 0
-            error = self.reader.readUntilClosed(timeout=20)
-            for error in self.reader.readUntilClosed(timeout=20):
-                self.handleError(error)
+            if status:
+                self.logger.error('Event delivery process %s died - '
+                                  'restarting', pid)
+            # any events still buffered for the old process are lost.
+            self.writer.close()
+            self.writer = None
+            for message in self.reader.readUntilClosed(timeout=20):
+                self._handleMessage(message)
             self.reader = None
 
     def harvestErrors(self):
         if not self.reader:
             return
-        error = self.reader.handleReadIfReady()
-        while error:
-            self.handleError(error)
-            error = self.reader.handleReadIfReady()
+        while self.reader.fd is not None:
+            try:
+                ready = select.select([self.reader], [], [], 0)[0]
+            except select.error:
+                break
+            if not ready:
+                break
+            message = self.reader.handle_read()
+            if message is not None:
+                self._handleMessage(message)
+
+    def _handleMessage(self, message):
+        kind, data = message
+        if kind == 'error':
+            self.handleError(data)
+        elif kind == 'stats':
+            self.stats = data
+            self.logger.info('Delivered %(delivered)d event batches to '
+                '%(subscribers)d subscribers: latency avg %(latencyAvg).3fs '
+                'max %(latencyMax).3fs, %(errors)d errors, '
+                '%(dropped)d events dropped', data)
 
     def handleError(self, error):
         errorTime, uri, msg = error
@@ -117,33 +168,238 @@ class _RmakeServerPublisher(object):
         self.recentErrors = self.recentErrors[-self.errorLimit:]
         self.errorTimes = self.errorTimes[-self.errorLimit:]
 
-    def _emitEvents(self, jobId, eventList, writer):
+
+class _EventDeliveryProcess(object):
+    """
+        Runs in the delivery process.  Reads batches of events from the
+        server, looks up the subscribers for them and hands them to one
+        _SubscriberQueue thread per subscriber, so a slow subscriber only
+        delays itself.  Errors and delivery stats are sent back to the
+        server.
+    """
+    # how long subscriber lookups are cached.  The server tells us when
+    # a subscriber is added; the timeout covers subscribers removed along
+    # with their jobs.
+    subscriberCacheTime = 2
+    # how often to report delivery stats
+    statsInterval = 60
+
+    def __init__(self, logger, db, reader, writer, timeout=60,
+                 maxQueued=1000):
+        self.logger = logger
+        self.db = db
+        self.reader = reader
+        self.writer = writer
+        self.timeout = timeout
+        self.maxQueued = maxQueued
+        self._subscriberCache = {}
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._results = Queue.Queue()
+        self._parentPid = os.getppid()
+        self._resetStats()
+
+    def _resetStats(self):
+        self._lastStats = time.time()
+        self._delivered = 0
+        self._errors = 0
+        self._dropped = 0
+        self._latencies = []
+
+    def run(self):
+        # don't let a hung subscriber hold its thread forever.
+        socket.setdefaulttimeout(self.timeout)
+        while os.getppid() == self._parentPid:
+            try:
+                ready = select.select([self.reader], [], [], 1)[0]
+            except select.error, err:
+                if err.args[0] != errno.EINTR:
+                    raise
+                ready = False
+            if ready:
+                message = self.reader.handle_read()
+                if self.reader.fd is None:
+                    # server closed its end
+                    break
+                if message is not None:
+                    self._handleMessage(message)
+            self._handleResults()
+            if time.time() - self._lastStats > self.statsInterval:
+                self._sendStats()
+            self.writer.flush()
+
+    def _handleMessage(self, message):
+        kind, data = message
+        if kind == 'subscribed':
+            for key in self._subscriberCache.keys():
+                if key[0] == data:
+                    del self._subscriberCache[key]
+            return
+        if kind != 'events':
+            return
+        for jobId, emitTime, eventList in data:
+            eventList = thaw('EventList',
+                             (constants.subscriberApiVersion, eventList))[1]
+            eventsBySubscriber = self._getEventListBySubscriber(jobId,
+                                                                eventList)
+            for subscriber, subscriberEvents in eventsBySubscriber.values():
+                self._queueEvents(subscriber, jobId, emitTime,
+                                  subscriberEvents)
+
+    def _queueEvents(self, subscriber, jobId, emitTime, eventList):
+        self._lock.acquire()
+        try:
+            queue = self._queues.get(subscriber.subscriberId)
+            if queue is None:
+                queue = _SubscriberQueue(subscriber.subscriberId, self,
+                                         self.maxQueued)
+                self._queues[subscriber.subscriberId] = queue
+                queue.start()
+            if not queue.put((subscriber, jobId, emitTime, eventList)):
+                self._results.put(('dropped', (time.time(), subscriber.uri,
+                                               len(eventList))))
+        finally:
+            self._lock.release()
+
+    def _removeQueue(self, queue):
         """
-            Publish events to all listening subscribers.
+            Called by an idle queue thread.  Returns True if the thread
+            should exit.
         """
-        eventsBySubscriber = self._getEventListBySubscriber(self.db, jobId,
-                                                            eventList)
-        for subscriber, eventList in eventsBySubscriber.iteritems():
+        self._lock.acquire()
+        try:
+            if not queue.isEmpty():
+                return False
+            if self._queues.get(queue.subscriberId) is queue:
+                del self._queues[queue.subscriberId]
+            return True
+        finally:
+            self._lock.release()
+
+    def _handleResults(self):
+        while True:
             try:
-                subscriber._receiveEvents(subscriber.apiVersion, eventList)
-            except Exception, err:
-                writer.send((time.time(), subscriber.uri, str(err)))
-        while writer.hasData():
-            writer.handleWriteIfReady(sleep=10)
+                kind, data = self._results.get_nowait()
+            except Queue.Empty:
+                return
+            if kind == 'delivered':
+                self._delivered += 1
+                self._latencies.append(data)
+            elif kind == 'error':
+                self._errors += 1
+                self.writer.send(('error', data))
+            elif kind == 'dropped':
+                errorTime, uri, count = data
+                self._dropped += count
+                self.writer.send(('error', (errorTime, uri,
+                            'subscriber is not keeping up, events dropped')))
 
-    def _getEventListBySubscriber(self, db, jobId, eventList):
+    def _sendStats(self):
+        latencies = self._latencies or [0]
+        stats = dict(delivered=self._delivered,
+                     subscribers=len(self._queues),
+                     latencyAvg=sum(latencies) / len(latencies),
+                     latencyMax=max(latencies),
+                     errors=self._errors,
+                     dropped=self._dropped)
+        if self._delivered or self._errors or self._dropped:
+            self.writer.send(('stats', stats))
+        self._resetStats()
+        now = time.time()
+        for key, (cacheTime, subscribers) in self._subscriberCache.items():
+            if now - cacheTime > self.subscriberCacheTime:
+                del self._subscriberCache[key]
+
+    def _getEventListBySubscriber(self, jobId, eventList):
         """
             For the given event list, return events sorted by subscriber.
-            @return subscriber -> eventList dictionary.
+            @return subscriberId -> (subscriber, eventList) dictionary.
         """
-        subscribersByEvent = db.getSubscribersForEvents(jobId, eventList)
-        if not subscribersByEvent:
-            return {}
+        now = time.time()
+        subscribersByEvent = {}
+        missing = []
+        for (event, subEvent), data in eventList:
+            cached = self._subscriberCache.get((jobId, event, subEvent))
+            if cached and now - cached[0] < self.subscriberCacheTime:
+                subscribersByEvent[event, subEvent] = cached[1]
+            else:
+                missing.append(((event, subEvent), data))
+        if missing:
+            found = self.db.getSubscribersForEvents(jobId, missing)
+            for (event, subEvent), data in missing:
+                subscribers = found.get((event, subEvent), [])
+                self._subscriberCache[jobId, event, subEvent] = (now,
+                                                                 subscribers)
+                subscribersByEvent[event, subEvent] = subscribers
+
         eventsBySubscriber = {}
         for (event, subEvent), data in eventList:
-            if (event, subEvent) not in subscribersByEvent:
-                continue
             for subscriber in subscribersByEvent[event, subEvent]:
-                eventsBySubscriber.setdefault(subscriber, []).append(
+                eventsBySubscriber.setdefault(subscriber.subscriberId,
+                                              (subscriber, []))[1].append(
                                                 ((event, subEvent), data))
         return eventsBySubscriber
+
+
+class _SubscriberQueue(threading.Thread):
+    """
+        Delivers events to one subscriber in order.  Batches that pile
+        up while a delivery is in progress are sent together.
+    """
+    idleTimeout = 60
+
+    def __init__(self, subscriberId, process, maxQueued):
+        threading.Thread.__init__(self)
+        self.setDaemon(True)
+        self.subscriberId = subscriberId
+        self.process = process
+        self.queue = Queue.Queue(maxQueued)
+
+    def put(self, item):
+        try:
+            self.queue.put_nowait(item)
+        except Queue.Full:
+            return False
+        return True
+
+    def isEmpty(self):
+        return self.queue.empty()
+
+    def run(self):
+        while True:
+            try:
+                items = [ self.queue.get(timeout=self.idleTimeout) ]
+            except Queue.Empty:
+                if self.process._removeQueue(self):
+                    return
+                continue
+            while True:
+                try:
+                    items.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+            for subscriber, emitTime, eventList in _coalesce(items):
+                self._deliver(subscriber, emitTime, eventList)
+
+    def _deliver(self, subscriber, emitTime, eventList):
+        results = self.process._results
+        try:
+            subscriber._receiveEvents(subscriber.apiVersion, eventList)
+        except Exception, err:
+            results.put(('error', (time.time(), subscriber.uri, str(err))))
+        else:
+            results.put(('delivered', time.time() - emitTime))
+
+
+def _coalesce(items):
+    """
+        Merge consecutive batches for the same job into one.
+    """
+    merged = []
+    for subscriber, jobId, emitTime, eventList in items:
+        if merged and merged[-1][0] == jobId:
+            merged[-1][1] = subscriber
+            merged[-1][3].extend(eventList)
+        else:
+            merged.append([jobId, subscriber, emitTime, list(eventList)])
+    return [ (x[1], x[2], x[3]) for x in merged ]
@@ -32,6 +32,7 @@ import time
 import traceback
 import urllib
 import xmlrpclib
+import zlib
 
 from conary.deps import deps
 from conary.lib import util
@@ -42,18 +43,23 @@ from rmake import plugins
 from rmake.build import builder
 from rmake.build import buildcfg
 from rmake.build import buildjob
+from rmake.build import dephandler
 from rmake.build import imagetrove
 from rmake.build import subscriber
 from rmake.server import auth
 from rmake.server import publish
 from rmake.db import database
 from rmake.lib.apiutils import api, api_parameters, api_return, freeze, thaw
-from rmake.lib.apiutils import api_nonforking
+from rmake.lib.apiutils import api_nonforking, api_readonly
 from rmake.lib import apirpc
 from rmake.lib import logger
 from rmake.lib.rpcproxy import ShimAddress
 from rmake.worker import worker
 
+# limits for getTroveBuildLogChunk
+MAX_LOG_CHUNK_SIZE = 4 * 1024 * 1024
+MAX_LOG_WAIT = 60
+
 class ServerLogger(logger.ServerLogger):
     name = 'rmake-server'
 
@@ -102,12 +108,14 @@ class rMakeServer(apirpc.XMLApiServer):
     @api(version=1)
     @api_parameters(1, None, None)
     @api_return(1, None)
+    @api_readonly
     def listJobs(self, callData, activeOnly, jobLimit):
         return self.db.listJobs(activeOnly=activeOnly, jobLimit=jobLimit)
 
     @api(version=1)
     @api_parameters(1, None, None)
     @api_return(1, None)
+    @api_readonly
     def listTrovesByState(self, callData, jobId, state):
         jobId = self.db.convertToJobId(jobId)
         if state == '':
@@ -118,6 +126,7 @@ class rMakeServer(apirpc.XMLApiServer):
     @api(version=1)
     @api_parameters(1, None, 'bool', 'bool')
     @api_return(1, None)
+    @api_readonly
     def getJobs(self, callData, jobIds, withTroves=True, withConfigs=True):
         callData.logger.logRPCDetails('getJobs', jobIds=jobIds,
                                       withTroves=withTroves,
@@ -127,9 +136,20 @@ class rMakeServer(apirpc.XMLApiServer):
                  for x in self.db.getJobs(jobIds, withTroves=withTroves,
                                           withConfigs=withConfigs) ]
 
+    @api(version=1)
+    @api_parameters(1, None)
+    @api_return(1, None)
+    @api_readonly
+    def getJobSummary(self, callData, jobId):
+        jobId = self.db.convertToJobId(jobId)
+        if not self.db.jobExists(jobId):
+            raise errors.JobNotFound(jobId)
+        return self.db.getJobSummary(jobId)
+
     @api(version=1)
     @api_parameters(1, None)
     @api_return(1, 'SanitizedBuildConfiguration')
+    @api_readonly
     def getJobConfig(self, callData, jobId):
         jobId = self.db.convertToJobId(jobId)
         jobCfg = self.db.getJobConfig(jobId)
@@ -138,6 +158,7 @@ class rMakeServer(apirpc.XMLApiServer):
     @api(version=1)
     @api_parameters(1, None, None)
     @api_return(1, None)
+    @api_readonly
     def getJobLogs(self, callData, jobId, mark):
         jobId = self.db.convertToJobId(jobId)
         if not self.db.jobExists(jobId):
@@ -150,26 +171,62 @@ class rMakeServer(apirpc.XMLApiServer):
     @api(version=1)
     @api_parameters(1, None, 'troveContextTuple', 'int')
     @api_return(1, None)
+    @api_readonly
     def getTroveLogs(self, callData, jobId, troveTuple, mark):
         jobId = self.db.convertToJobId(jobId)
         return [ tuple(str(x) for x in data) for data in self.db.getTroveLogs(jobId, troveTuple, mark) ]
 
+    @api(version=1)
+    @api_parameters(1, None, 'int')
+    @api_return(1, None)
+    @api_readonly
+    def getJobLogsSince(self, callData, jobId, logId):
+        jobId = self.db.convertToJobId(jobId)
+        if not self.db.jobExists(jobId):
+            raise errors.JobNotFound(jobId)
+        return [ (data[0],) + tuple(str(x) for x in data[1:])
+                 for data in self.db.getJobLogsSince(jobId, logId) ]
+
     @api(version=1)
     @api_parameters(1, None, 'troveContextTuple', 'int')
     @api_return(1, None)
-    def getTroveBuildLog(self, callData, jobId, troveTuple, mark):
+    @api_readonly
+    def getTroveLogsSince(self, callData, jobId, troveTuple, logId):
         jobId = self.db.convertToJobId(jobId)
-        trove = self.db.getTrove(jobId, *troveTuple)
-        if not self.db.hasTroveBuildLog(trove):
-            return not trove.isFinished(), xmlrpclib.Binary(''), 0
-        f = self.db.openTroveBuildLog(trove)
-        if mark < 0:
-            f.seek(0, 2)
-            end = f.tell()
-            f.seek(max(end + mark, 0))
-        else:
-            f.seek(mark)
-        return not trove.isFinished(), xmlrpclib.Binary(f.read()), f.tell()
+        if not self.db.jobExists(jobId):
+            raise errors.JobNotFound(jobId)
+        return [ (data[0],) + tuple(str(x) for x in data[1:])
+                 for data in self.db.getTroveLogsSince(jobId, troveTuple,
+                                                       logId) ]
+
+    @api(version=1)
+    @api_parameters(1, None, 'troveContextTuple', 'int')
+    @api_return(1, None)
+    @api_readonly
+    def getTroveBuildLog(self, callData, jobId, troveTuple, mark):
+        isBuilding, data, mark = self.db.getTroveBuildLog(jobId, troveTuple,
+                                                          mark)
+        return isBuilding, xmlrpclib.Binary(data), mark
+
+    @api(version=1)
+    @api_parameters(1, None, 'troveContextTuple', 'int', 'int', 'int', 'bool')
+    @api_return(1, None)
+    def getTroveBuildLogChunk(self, callData, jobId, troveTuple, mark,
+                              maxSize, timeout, compress):
+        """
+            Return at most maxSize bytes of the build log, starting at mark.
+            If the trove is still building and no new data is available,
+            wait up to timeout seconds for it.  Runs in a forked process,
+            so waiting doesn't hold up the server.
+        """
+        maxSize = min(maxSize, MAX_LOG_CHUNK_SIZE) or MAX_LOG_CHUNK_SIZE
+        timeout = max(min(timeout, MAX_LOG_WAIT), 0)
+        isBuilding, data, mark = self.db.getTroveBuildLog(jobId, troveTuple,
+                                                          mark, maxSize,
+                                                          timeout)
+        if compress:
+            data = zlib.compress(data, 6)
+        return isBuilding, xmlrpclib.Binary(data), mark
 
     @api(version=1)
     @api_parameters(1, None)
@@ -186,9 +243,13 @@ class rMakeServer(apirpc.XMLApiServer):
     @api(version=1)
     @api_parameters(1, None, 'Subscriber')
     @api_return(1, 'int')
+    @api_nonforking
     def subscribe(self, callData, jobId, subscriber):
+        # not forked, so that the publisher can be told about the new
+        # subscriber before any more events for the job are sent.
         jobId = self.db.convertToJobId(jobId)
         self.db.addSubscriber(jobId, subscriber)
+        self._publisher.subscriberAdded(jobId)
         return subscriber.subscriberId
 
     @api(version=1)
@@ -202,6 +263,7 @@ class rMakeServer(apirpc.XMLApiServer):
     @api(version=1)
     @api_parameters(1, None, 'str')
     @api_return(1, None)
+    @api_readonly
     def listSubscribersByUri(self, callData, jobId, uri):
         jobId = self.db.convertToJobId(jobId)
         subscribers = self.db.listSubscribersByUri(jobId, uri)
@@ -210,6 +272,7 @@ class rMakeServer(apirpc.XMLApiServer):
     @api(version=1)
     @api_parameters(1, None)
     @api_return(1, None)
+    @api_readonly
     def listSubscribers(self, callData, jobId):
         jobId = self.db.convertToJobId(jobId)
         subscribers = self.db.listSubscribers(jobId)
@@ -327,6 +390,27 @@ class rMakeServer(apirpc.XMLApiServer):
         return (self.cfg.reposName, self.cfg.getRepositoryMap(),
                 list(self.cfg.reposUser), proxyUrl)
 
+    @api(version=1)
+    @api_parameters(1)
+    @api_return(1, None)
+    def listChrootCache(self, callData):
+        chrootCache = self.cfg.getChrootCache()
+        if not chrootCache:
+            return []
+        # sizes are sent as strings as they may not fit in an XML-RPC int
+        return [ (fingerprint, str(size), created, lastUsed, hits)
+                 for (fingerprint, size, created, lastUsed, hits)
+                 in chrootCache.listCachedChroots() ]
+
+    @api(version=1)
+    @api_parameters(1)
+    @api_return(1, None)
+    def getResolverCacheStats(self, callData):
+        if not self.cfg.useResolverCache:
+            return {}
+        cache = dephandler.ResolverCache(self.cfg.getResolverCachePath())
+        return cache.getStats()
+
     # --- callbacks from Builders
 
     @api(version=1)
@@ -474,6 +558,10 @@ class rMakeServer(apirpc.XMLApiServer):
                     # all its children with one swell foop.
                     os.setpgrp()
                     self.db.reopen()
+                    if self.cfg.stateWriteDelay:
+                        self.db.enableWriteBehind(
+                                        self.cfg.stateWriteDelay / 1000.0,
+                                        self.cfg.stateWriteBatch)
 
                     buildMgr = self.getBuilder(job)
                     self._subscribeToBuild(buildMgr)
@@ -665,7 +753,8 @@ class rMakeServer(apirpc.XMLApiServer):
             apirpc.XMLApiServer.__init__(self, uri, logger=serverLogger,
                                  forkByDefault = True,
                                  sslCertificate=cfg.getSslCertificatePath(),
-                                 caCertificate=cfg.getCACertificatePath())
+                                 caCertificate=cfg.getCACertificatePath(),
+                                 poolSize=cfg.apiWorkers)
             self._setUpInternalUser()
             self.db = database.Database(cfg.getDbPath(),
                                         cfg.getDbContentsPath())
@@ -79,17 +79,46 @@ class rMakeBuilderConfiguration(daemon.DaemonConfig):
     helperDir         = (CfgPath, "/usr/libexec/rmake")
     slots             = (CfgInt, 1)
     useCache          = (CfgBool, False)
+    cacheDownloadWorkers = (CfgInt, 4,
+            "Number of changesets downloaded at once when filling the "
+            "changeset cache for a chroot.")
+    changesetCacheSize = (CfgInt, 0,
+            "Maximum size of the changeset cache used when useCache is "
+            "set, in megabytes.  The least recently used entries are "
+            "removed past this size.  0 means no limit.")
     useTmpfs          = (CfgBool, False)
     pluginDirs        = (CfgPathList, ['/usr/share/rmake/plugins'])
     usePlugins        = (CfgBool, True)
     usePlugin         = CfgDict(CfgBool)
     chrootLimit       = (CfgInt, 4)
     chrootCache       = CfgChrootCache
+    chrootCacheCompression = (CfgString, 'gzip',
+            "How chroots are stored in the chroot cache: gzip, pigz, zstd, "
+            "hardlink, or auto to use the fastest compressor installed.")
+    chrootCacheBackground = (CfgBool, True,
+            "Write chroot cache archives in the background so that the "
+            "build can start right away.")
+    chrootCacheClosestMatch = (CfgBool, True,
+            "When no cached chroot matches exactly, start from the cached "
+            "chroot with the most troves in common and install the "
+            "differences.")
+    chrootCacheSize   = (CfgInt, 0,
+            "Maximum size of the chroot cache, in megabytes.  The least "
+            "recently used chroots are removed past this size.  0 means "
+            "no limit.")
     chrootCaps        = (CfgBool, False,
             "Set capability masks as directed by chroot contents. "
             "This has the potential to be unsafe.")
     chrootServerPorts = (CfgPortRange, (63000, 64000),
             "Port range to be used for 'rmake chroot' sessions.")
+    resolveSourceCacheSize = (CfgInt, 4,
+            "Number of resolveTroves configurations whose troves are kept "
+            "loaded between resolves.  0 disables.")
+    loadWorkers       = (CfgInt, 1,
+            "Number of processes used to load the recipes for a job.")
+    useLoadCache      = (CfgBool, True,
+            "Reuse the results of loading a recipe when its source, "
+            "flavor, resolveTroves and loaded troves have not changed.")
     hostName          = (CfgString, 'localhost')
     verbose           = False
 
@@ -105,6 +134,9 @@ class rMakeBuilderConfiguration(daemon.DaemonConfig):
     def getCacheDir(self):
         return self.buildDir + '/cscache'
 
+    def getLoadCachePath(self):
+        return self.buildDir + '/loadcache'
+
     def getChrootDir(self):
         return self.buildDir + '/chroots'
 
@@ -126,7 +158,17 @@ class rMakeBuilderConfiguration(daemon.DaemonConfig):
         if not self.chrootCache:
             return None
         elif self.chrootCache[0] == 'local':
-            return chrootcache.LocalChrootCache(self.chrootCache[1])
+            compression = self.chrootCacheCompression
+            if (compression != 'auto'
+                    and compression not in chrootcache.compressionMethods):
+                raise errors.RmakeError('unknown chroot cache compression '
+                                        '"%s" specified' % compression)
+            if (compression != 'auto' and not
+                    chrootcache.compressionMethods[compression]().isAvailable()):
+                raise errors.RmakeError('chroot cache compression "%s" is '
+                                        'not installed' % compression)
+            return chrootcache.LocalChrootCache(self.chrootCache[1],
+                    compression, sizeLimit=self.chrootCacheSize * 1048576)
         else:
             raise errors.RmakeError('unknown chroot cache type of "%s" specified' %self.chrootCache[0])
 
@@ -181,6 +223,25 @@ class rMakeConfiguration(rMakeBuilderConfiguration):
     caCertPath        = CfgPath
     reposUser         = CfgUserInfo
     useResolverCache  = (CfgBool, True)
+    resolverCacheSize = (CfgInt, 64,
+            "Maximum size of the resolver cache, in megabytes.  0 means "
+            "no limit.")
+    resolveBatchSize  = (CfgInt, 1,
+            "Maximum number of troves to resolve in a single resolve "
+            "process.")
+    apiWorkers        = (CfgInt, 0,
+            "Number of pre-forked processes that answer read-only API "
+            "calls such as getJobs.  0 forks a process for each call.")
+
+    compressBuildLogs = (CfgBool, True,
+            "Compress the build logs of a job once it has finished.")
+    stateWriteDelay   = (CfgInt, 200,
+            "Maximum time, in milliseconds, that a build may hold job and "
+            "trove state changes before writing them to the database.  "
+            "0 writes every change immediately.")
+    stateWriteBatch   = (CfgInt, 100,
+            "Maximum number of job and trove state changes written to the "
+            "database in a single transaction.")
 
     dbPath            = dbstore.CfgDriver
 
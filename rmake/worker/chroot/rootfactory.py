@@ -42,7 +42,9 @@ from conary.lib import util, openpgpkey, sha1helper
 from rmake import errors
 from rmake import compat
 from rmake import constants
+from rmake.lib import chrootcache
 from rmake.lib import flavorutil
+from rmake.lib import repocache
 from rmake.lib import rootfactory
 
 def _addModeBits(path, bits):
@@ -135,7 +137,11 @@ class ConaryBasedChroot(rootfactory.BasicChroot):
                 self.logger.info('chroot fingerprint %s '
                          'restore done', strFingerprint)
                 return
+            if (self.serverCfg.chrootCacheClosestMatch
+                    and not os.path.exists(self.cfg.root + self.cfg.dbPath)):
+                self._restoreClosestChroot()
 
+        downloadStats = repocache.DownloadStats()
         def _install(jobList):
             self.cfg.flavor = []
             openpgpkey.getKeyCache().setPublicPath(
@@ -148,7 +154,8 @@ class ConaryBasedChroot(rootfactory.BasicChroot):
             if self.csCache:
                 changeSetList = self.csCache.getChangeSets(client.getRepos(),
                                                            jobList,
-                                                           callback=self.callback)
+                                                           callback=self.callback,
+                                                           stats=downloadStats)
             else:
                 changeSetList = []
 
@@ -195,6 +202,15 @@ class ConaryBasedChroot(rootfactory.BasicChroot):
             finally:
                 self.cfg.root = oldRoot
 
+        if downloadStats.roundTrips:
+            self.logger.info('Downloaded %d changesets (%d KiB) in %.1fs,'
+                             ' %d KiB/s; %d were cached',
+                             downloadStats.roundTrips,
+                             downloadStats.bytes / 1024,
+                             downloadStats.elapsed,
+                             downloadStats.getRate() / 1024,
+                             downloadStats.cached)
+
         self._uninstallRPM()
 
         # directories must be traversable and files readable (RMK-1006)
@@ -208,9 +224,57 @@ class ConaryBasedChroot(rootfactory.BasicChroot):
             strFingerprint = sha1helper.sha1ToString(self.chrootFingerprint)
             self.logger.info('caching chroot with fingerprint %s',
                     strFingerprint)
-            self.chrootCache.store(self.chrootFingerprint, self.cfg.root)
-            self.logger.info('caching chroot %s done',
-                    strFingerprint)
+            if self.serverCfg.chrootCacheBackground:
+                self.chrootCache.storeInBackground(self.chrootFingerprint,
+                        self.cfg.root, self._getTroveKeys())
+                self.logger.info('caching chroot %s in the background',
+                        strFingerprint)
+            else:
+                try:
+                    self.chrootCache.store(self.chrootFingerprint,
+                            self.cfg.root, self._getTroveKeys())
+                except chrootcache.ChrootCacheError, err:
+                    # the chroot itself is fine, so the build can go on
+                    self.logger.warning('caching chroot %s failed: %s',
+                            strFingerprint, err)
+                else:
+                    self.logger.info('caching chroot %s done',
+                            strFingerprint)
+
+    def _restoreClosestChroot(self):
+        """
+            Restore the cached chroot closest to the one being built, so
+            that the migrating install that follows only has to apply the
+            troves that differ.
+        """
+        # the install that follows only migrates the sysroot and the
+        # bootstrap root when there is something to install into them, so
+        # a chroot with cross or bootstrap troves that are not wanted would
+        # keep them.
+        fingerprint = self.chrootCache.findClosestChroot(self._getTroveKeys(),
+                exactPrefixes=('cross:', 'bootstrap:'))
+        if fingerprint is None:
+            return
+        strFingerprint = sha1helper.sha1ToString(fingerprint)
+        self.logger.info('restoring closest cached chroot with '
+                'fingerprint %s as a base', strFingerprint)
+        self.chrootCache.restore(fingerprint, self.cfg.root)
+        self.logger.info('chroot fingerprint %s restore done, '
+                'installing differences', strFingerprint)
+
+    def _getTroveKeys(self):
+        """
+            Returns strings naming every trove installed into the chroot,
+            for matching against the contents of cached chroots.
+        """
+        keys = []
+        for prefix, jobList in (('', self.jobList),
+                                ('cross:', self.crossJobList),
+                                ('bootstrap:', self.bootstrapJobList)):
+            for job in jobList or []:
+                keys.append('%s%s=%s[%s]' % (prefix, job[0],
+                                             job[2][0], job[2][1]))
+        return keys
 
     def _copyInConary(self):
         conaryDir = os.path.dirname(sys.modules['conary'].__file__)
@@ -17,6 +17,7 @@
 
 import errno
 import copy
+import marshal
 import os
 import stat
 import sys
@@ -44,6 +45,9 @@ class ChrootQueue(object):
         self.chroots = {}
         self.toRemove = {}  # chroots that are scheduled for removal
         self.badChroots = {}
+        # chroot path -> (conary db stamp, [(name, label, frozen flavor)])
+        self.contentsIndex = None
+        self.contentsIndexChanged = False
 
     def reset(self):
         self.chroots = {}
@@ -106,11 +110,17 @@ class ChrootQueue(object):
 
     def chrootFinished(self, chrootPath):
         self.chroots.pop(chrootPath, False)
+        if chrootPath and os.path.isdir(chrootPath):
+            self._getChrootContents(chrootPath)
+            self._saveContentsIndex()
 
     def deleteChroot(self, chrootPath):
         self.chroots.pop(chrootPath, False)
         self.toRemove.pop(chrootPath, False)
         self.badChroots.pop(chrootPath, False)
+        if self._getContentsIndex().pop(chrootPath, None):
+            self.contentsIndexChanged = True
+            self._saveContentsIndex()
 
     def markBadChroot(self, chrootPath):
         # we tried to remove this chroot but it failed.
@@ -131,21 +141,90 @@ class ChrootQueue(object):
                 # return oldest directory
                 return sorted(self.listOldChroots(),
                               key=lambda x: os.stat(x)[stat.ST_MTIME])[0]
-        buildReqsByNLF = set([(x[0], x[1].trailingLabel(), x[2]) 
-                             for x in buildReqs])
-        matches = {}
-        for chrootPath in self.listOldChroots():
-            db = database.Database(chrootPath, '/var/lib/conarydb')
-            chrootContents = db.iterAllTroves()
-            trovesByNLF = set([(x[0], x[1].trailingLabel(), x[2]) for x in chrootContents])
-            # matches = 2*matches - extras - so an empty chroot is better than 
-            # a chroot with lots of wrong troves.
-            matches[chrootPath] = 2 * len(trovesByNLF.intersection(buildReqsByNLF)) - len(trovesByNLF.difference(buildReqsByNLF))
+        buildReqsByNLF = set(_getNLF(x) for x in buildReqs)
+        matches = self._scoreChroots(buildReqsByNLF, self.listOldChroots())
         if matches:
             rank, best = sorted((x[1], x[0]) for x in matches.iteritems())[-1]
             if rank >= len(buildReqsByNLF) or not goodRootsOnly:
                 return best
 
+    def _scoreChroots(self, buildReqsByNLF, chrootPaths):
+        """
+            Rank C{chrootPaths} by how well their contents match
+            C{buildReqsByNLF}, using the contents index.
+        """
+        matches = {}
+        for chrootPath in chrootPaths:
+            trovesByNLF = self._getChrootContents(chrootPath)
+            # matches = 2*matches - extras - so an empty chroot is better than 
+            # a chroot with lots of wrong troves.
+            matches[chrootPath] = 2 * len(trovesByNLF.intersection(buildReqsByNLF)) - len(trovesByNLF.difference(buildReqsByNLF))
+        self._saveContentsIndex()
+        return matches
+
+    def _getChrootContents(self, chrootPath):
+        """
+            Returns the set of (name, label, flavor) for the troves installed
+            in C{chrootPath}.  The conary database in the chroot is only
+            read if it has changed since the contents were last indexed.
+        """
+        index = self._getContentsIndex()
+        stamp = self._getDbStamp(chrootPath)
+        if chrootPath in index and index[chrootPath][0] == stamp:
+            return set(index[chrootPath][1])
+        if stamp is None:
+            contents = set()
+        else:
+            db = database.Database(chrootPath, '/var/lib/conarydb')
+            contents = set(_getNLF(x) for x in db.iterAllTroves())
+        index[chrootPath] = (stamp, list(contents))
+        self.contentsIndexChanged = True
+        return contents
+
+    def _getDbStamp(self, chrootPath):
+        try:
+            st = os.stat(chrootPath + '/var/lib/conarydb/conarydb')
+        except OSError, err:
+            if err.errno != errno.ENOENT:
+                raise
+            return None
+        return (st.st_mtime, st.st_size)
+
+    def _getContentsIndexPath(self):
+        return self.root + '/.contents'
+
+    def _getContentsIndex(self):
+        if self.contentsIndex is None:
+            self.contentsIndex = {}
+            try:
+                data = open(self._getContentsIndexPath()).read()
+            except IOError, err:
+                if err.errno != errno.ENOENT:
+                    raise
+            else:
+                try:
+                    self.contentsIndex = marshal.loads(data)
+                except (EOFError, ValueError, TypeError):
+                    # corrupt index, it will be rebuilt as chroots are used
+                    pass
+        return self.contentsIndex
+
+    def _saveContentsIndex(self):
+        if self.contentsIndex is None or not self.contentsIndexChanged:
+            return
+        # forget about chroots that have since been moved or removed
+        for chrootPath in self.contentsIndex.keys():
+            if not os.path.isdir(chrootPath):
+                del self.contentsIndex[chrootPath]
+        util.mkdirChain(self.root)
+        fd, tmpPath = tempfile.mkstemp(dir=self.root, prefix='.contents-')
+        try:
+            os.write(fd, marshal.dumps(self.contentsIndex))
+        finally:
+            os.close(fd)
+        os.rename(tmpPath, self._getContentsIndexPath())
+        self.contentsIndexChanged = False
+
     def requestSlot(self, troveName, buildReqs, reuseChroots):
         if self.slots > 0 and len(self.chroots) >= self.slots:
             return None
@@ -173,6 +252,11 @@ class ChrootQueue(object):
     def useSlot(self, root):
         self.chroots[root] = None
 
+def _getNLF(troveTup):
+    return (troveTup[0], troveTup[1].trailingLabel().asString(),
+            troveTup[2].freeze())
+
+
 class ChrootManager(object):
     def __init__(self, serverCfg, logger=None):
         self.serverCfg = serverCfg
@@ -182,7 +266,9 @@ class ChrootManager(object):
         cacheDir = serverCfg.getCacheDir()
         util.mkdirChain(cacheDir)
         if self.serverCfg.useCache:
-            self.csCache = repocache.RepositoryCache(cacheDir)
+            self.csCache = repocache.RepositoryCache(cacheDir,
+                    downloadWorkers=serverCfg.cacheDownloadWorkers,
+                    sizeLimit=serverCfg.changesetCacheSize * 1048576)
         else:
             self.csCache = None
         self.chrootCache = serverCfg.getChrootCache()
@@ -501,26 +501,81 @@ class ResolveCommand(AttachedCommand):
     name = 'resolve-command'
 
     def __init__(self, cfg, commandId, jobId,  eventHandler, logData,
-                 resolveJob):
+                 resolveJob, sourceCache=None):
         super(ResolveCommand, self).__init__(cfg, commandId, jobId,
             eventHandler, trove=resolveJob.getTrove())
         self.logData = logData
         self.resolveJob = resolveJob
+        self.sourceCache = sourceCache
 
-    def runAttachedCommand(self):
-        self.logger.debug('Resolving')
-        self.trove.troveResolvingBuildReqs(self.cfg.getName(), os.getpid())
-        client = conaryclient.ConaryClient(self.resolveJob.getConfig())
+    def _getResolver(self, buildCfg):
+        client = conaryclient.ConaryClient(buildCfg)
         repos = client.getRepos()
         if self.cfg.useCache:
             repos = repocache.CachingTroveSource(repos,
                                                  self.cfg.getCacheDir())
-        self.resolver = resolver.DependencyResolver(self.logger, repos)
-        resolveResult = self.resolver.resolve(self.resolveJob)
+        return resolver.DependencyResolver(self.logger, repos,
+                                           sourceCache=self.sourceCache)
+
+    def _resolveTrove(self, resolveJob):
+        trove = resolveJob.getTrove()
+        trove.troveResolvingBuildReqs(self.cfg.getName(), os.getpid())
+        resolveResult = self.resolver.resolve(resolveJob)
         self.logger.debug('Resolve finished, sending back result')
-        self.trove.troveResolved(resolveResult)
+        trove.troveResolved(resolveResult)
         self.logger.debug('Result sent')
 
+    def runAttachedCommand(self):
+        self.logger.debug('Resolving')
+        self.resolver = self._getResolver(self.resolveJob.getConfig())
+        self._resolveTrove(self.resolveJob)
+
+
+class BatchResolveCommand(ResolveCommand):
+    """
+    Resolve several troves that share a build configuration in one process,
+    reusing the same resolver and repository connection for all of them.
+    """
+
+    def __init__(self, cfg, commandId, jobId, eventHandler, logDataList,
+                 resolveJobs, sourceCache=None):
+        super(BatchResolveCommand, self).__init__(cfg, commandId, jobId,
+            eventHandler, None, resolveJobs[0], sourceCache)
+        self.resolveJobs = resolveJobs
+        self.logDataList = logDataList
+        self._unresolved = [ x.getTrove() for x in resolveJobs ]
+
+    def setFailure(self, failure):
+        for trove in self._unresolved:
+            trove.troveFailed(failure)
+
+    def runAttachedCommand(self):
+        # the first trove was attached by runCommand.
+        for resolveJob in self.resolveJobs[1:]:
+            trove = resolveJob.getTrove()
+            trove.getPublisher().reset()
+            self.publisher.attach(trove)
+        self.logger.debug('Resolving %s troves' % len(self.resolveJobs))
+        self.resolver = self._getResolver(self.resolveJob.getConfig())
+        for resolveJob, logData in zip(self.resolveJobs, self.logDataList):
+            # send each trove's output to its own build log.
+            troveLog = logfile.LogFile(self.getLogPath())
+            if logData:
+                troveLog.logToPort(*logData)
+            else:
+                troveLog.redirectOutput()
+            try:
+                try:
+                    self._resolveTrove(resolveJob)
+                except Exception, err:
+                    # only this trove fails; the rest of the batch goes on.
+                    self.logger.error(traceback.format_exc())
+                    resolveJob.getTrove().troveFailed(failure.InternalError(
+                                        str(err), traceback.format_exc()))
+                self._unresolved.remove(resolveJob.getTrove())
+            finally:
+                troveLog.close()
+
 
 class LoadCommand(AttachedCommand):
     """
@@ -535,10 +590,14 @@ class LoadCommand(AttachedCommand):
         self.troveList = troveList
         self.reposName = reposName
 
-    def runAttachedCommand(self):
+    def _openRepos(self):
         repos = conaryclient.ConaryClient(self.job.getMainConfig()).getRepos()
         if self.cfg.useCache:
             repos = repocache.CachingTroveSource(repos, self.cfg.getCacheDir())
+        return repos
+
+    def runAttachedCommand(self):
+        repos = self._openRepos()
 
         troves = []
         for troveTup in self.troveList:
@@ -546,8 +605,13 @@ class LoadCommand(AttachedCommand):
             self.publisher.attach(trove)
             troves.append(trove)
 
+        if self.cfg.useLoadCache:
+            loadCachePath = self.cfg.getLoadCachePath()
+        else:
+            loadCachePath = None
         result = recipeutil.getSourceTrovesFromJob(self.job, troves,
-            repos, self.reposName)
+            repos, self.reposName, workers=self.cfg.loadWorkers,
+            loadCachePath=loadCachePath, openRepos=self._openRepos)
         self.job.jobLoaded(result)
 
 
@@ -103,13 +103,73 @@ class ResolveResult(object):
 register(ResolveResult)
 
 
+class ResolveTroveSourceCache(object):
+    """
+        Keeps the troves listed in resolveTroves, along with the trove
+        source built from their contents, for the most recently used
+        configurations.
+
+        Fetching and indexing large groups is the most expensive part of
+        setting up a resolve.  A worker keeps one of these loaded so that
+        the resolve commands it forks start out with the sources already
+        built.
+    """
+    def __init__(self, size=4):
+        self.size = size
+        self._sources = {}
+        self._order = []
+
+    def getKey(self, cfg):
+        if cfg.resolveTrovesOnly:
+            installLabelPath = None
+        else:
+            installLabelPath = tuple(cfg.installLabelPath)
+        return (tuple(tuple(x) for x in cfg.resolveTroveTups),
+                tuple(str(x) for x in cfg.flavor),
+                installLabelPath)
+
+    def hasSources(self, cfg):
+        return self.getKey(cfg) in self._sources
+
+    def getSources(self, cfg, repos):
+        """
+            Returns (troveListList, troveSource) for the resolveTroves in
+            cfg, fetching them from repos if they are not already cached.
+            troveListList contains the resolve troves grouped the way they
+            were listed in the config.
+        """
+        key = self.getKey(cfg)
+        if key in self._sources:
+            self._order.remove(key)
+            self._order.append(key)
+            return self._sources[key]
+
+        allResolveTroveTups = list(itertools.chain(*cfg.resolveTroveTups))
+        allResolveTroves = repos.getTroves(allResolveTroveTups,
+                                           withFiles=False)
+        resolveTrovesByTup = dict((x.getNameVersionFlavor(), x)
+                                  for x in allResolveTroves)
+        troveListList = [ [ resolveTrovesByTup[x] for x in resolveTupList ]
+                          for resolveTupList in cfg.resolveTroveTups ]
+        troveSource = resolvesource.makeTroveListStack(troveListList)
+        if self.size > 0:
+            self._sources[key] = troveListList, troveSource
+            self._order.append(key)
+            while len(self._order) > self.size:
+                del self._sources[self._order.pop(0)]
+        return troveListList, troveSource
+
+
 class DependencyResolver(object):
     """
         Resolves dependencies for one trove.
     """
-    def __init__(self, logger, repos=None):
+    def __init__(self, logger, repos=None, sourceCache=None):
         self.logger = logger
         self.repos = repos
+        if sourceCache is None:
+            sourceCache = ResolveTroveSourceCache(size=0)
+        self.sourceCache = sourceCache
 
     def getSources(self, resolveJob, cross=False):
         cfg = resolveJob.getConfig()
@@ -157,25 +217,15 @@ class DependencyResolver(object):
 
     def getSourcesWithResolveTroves(self, cfg, resolveTroveTups,
                                     builtTroveSource):
-        resolveTroves = []
-        searchSourceTroves = []
-        allResolveTroveTups = list(itertools.chain(*cfg.resolveTroveTups))
-        allResolveTroves = self.repos.getTroves(allResolveTroveTups,
-                                                withFiles=False)
-        resolveTrovesByTup = dict((x.getNameVersionFlavor(), x)
-                                  for x in allResolveTroves)
-
-        for resolveTupList in cfg.resolveTroveTups:
-            resolveTroves = [ resolveTrovesByTup[x]
-                              for x in resolveTupList ]
-            searchSourceTroves.append(resolveTroves)
+        searchSourceTroves, resolveTroveSource = \
+                self.sourceCache.getSources(cfg, self.repos)
         if cfg.resolveTrovesOnly:
             repos = None
         else:
             repos = self.repos
 
         searchSource = resolvesource.DepHandlerSource(builtTroveSource,
-                           searchSourceTroves,
+                           resolveTroveSource,
                            repos,
                            useInstallLabelPath=not cfg.resolveTrovesOnly,
                            expandLabelQueries=True)
@@ -269,12 +319,17 @@ class DependencyResolver(object):
                 resolveSource.close()
                 return resolveResult
 
-        if (searchSource.mainSource
+        builtTroveTups = set(resolveJob.getBuiltTroves()
+                             + resolveJob.getCrossTroves())
+        otherTroveTups = [ (x[0], x[2][0], x[2][1]) for x in
+                           bootstrapJobs | buildReqJobs | crossReqJobs
+                           if (x[0], x[2][0], x[2][1]) not in builtTroveTups ]
+        if not otherTroveTups or (searchSource.mainSource
                 and False not in searchSource.mainSource.hasTroves(
-                    [(x[0], x[2][0], x[2][1]) for x in
-                        bootstrapJobs | buildReqJobs | crossReqJobs])):
-            # All troves came from resolveTroves therefore the result is
-            # cacheable.
+                                                        otherTroveTups)):
+            # All troves came from resolveTroves or from troves built
+            # earlier in this job, both of which are part of the job hash,
+            # therefore the result is cacheable.
             resolveResult.jobHash = resolveJob.getJobHash()
         client.close()
         searchSource.close()
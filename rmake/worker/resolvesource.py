@@ -323,21 +323,21 @@ class DepHandlerSource(TroveSourceMesh):
 
         if isinstance(troveListList, trovesource.SimpleTroveSource):
             troveListList.setFlavorPreferenceList(flavorPrefs)
-            self.stack.addSource(troveListList)
+            stack.addSource(troveListList)
             self.resolveTroveSource = troveListList
+        elif isinstance(troveListList, trovesource.TroveSourceStack):
+            # a stack built earlier by makeTroveListStack and kept around
+            # for reuse.
+            for source in troveListList.sources:
+                source.setFlavorPreferenceList(flavorPrefs)
+            troveListList.setFlavorPreferenceList(flavorPrefs)
+            stack = troveListList
+            self.resolveTroveSource = stack
+            if not useInstallLabelPath:
+                repos = None
         else:
             if troveListList:
-                for troveList in troveListList:
-                    allTroves = [ x.getNameVersionFlavor() for x in troveList ]
-                    childTroves = itertools.chain(*
-                                   (x.iterTroveList(weakRefs=True,
-                                                    strongRefs=True)
-                                    for x in troveList))
-                    allTroves.extend(childTroves)
-                    source = trovesource.SimpleTroveSource(allTroves)
-                    source.searchWithFlavor()
-                    source.setFlavorPreferenceList(flavorPrefs)
-                    stack.addSource(source)
+                stack = makeTroveListStack(troveListList, flavorPrefs)
                 self.resolveTroveSource = stack
             if not useInstallLabelPath:
                 repos = None
@@ -354,6 +354,28 @@ class DepHandlerSource(TroveSourceMesh):
         return inst
 
 
+def makeTroveListStack(troveListList, flavorPrefs=()):
+    """
+        Returns a trove source stack with one source per trove list,
+        containing the troves in the list and everything they include.
+    """
+    stack = trovesource.TroveSourceStack()
+    stack.searchWithFlavor()
+    stack.setFlavorPreferenceList(flavorPrefs)
+    for troveList in troveListList:
+        allTroves = [ x.getNameVersionFlavor() for x in troveList ]
+        childTroves = itertools.chain(*
+                       (x.iterTroveList(weakRefs=True,
+                                        strongRefs=True)
+                        for x in troveList))
+        allTroves.extend(childTroves)
+        source = trovesource.SimpleTroveSource(allTroves)
+        source.searchWithFlavor()
+        source.setFlavorPreferenceList(flavorPrefs)
+        stack.addSource(source)
+    return stack
+
+
 class BuiltTroveSource(trovesource.SimpleTroveSource):
     """
         Trove source that is used for dep resolution and buildreq satisfaction 
@@ -19,17 +19,20 @@
 The worker is in charge of taking build requests and monitoring them
 until they complete.
 """
-import select
-import time
+import os
 import traceback
 
+from conary import conaryclient
+
 from rmake.lib import pipereader
+from rmake.lib import repocache
 from rmake.lib import server
 
 from rmake import errors
 from rmake import failure
 from rmake.worker import command
 from rmake.worker import imagecommand
+from rmake.worker import resolver
 from rmake.worker.chroot import rootmanager
 
 class Worker(server.Server):
@@ -42,6 +45,7 @@ class Worker(server.Server):
     commandClasses = { 'build'    : command.BuildCommand,
                        'load'     : command.LoadCommand,
                        'resolve'  : command.ResolveCommand,
+                       'batchresolve' : command.BatchResolveCommand,
                        'stop'     : command.StopCommand,
                        'session'  : command.SessionCommand,
                        'image'    : imagecommand.ImageCommand }
@@ -64,10 +68,20 @@ class Worker(server.Server):
                                   # for commands waiting to be run
         self.commands = [] # list of command objects currently running
         self.slots = slots
+        self.resolveSourceCache = resolver.ResolveTroveSourceCache(
+                                        self.cfg.resolveSourceCacheSize)
 
     def hasActiveTroves(self):
         return self.commands or self._queuedCommands
 
+    def getOpenSlotCount(self):
+        """
+            Returns the number of slots not taken up by running or queued
+            commands.
+        """
+        return max(0, self.slots - len(self.commands)
+                      - len(self._queuedCommands))
+
     def buildTrove(self, buildCfg, jobId, trove, eventHandler,
                    buildReqs, crossReqs, targetLabel, logData=None,
                    logPath=None, commandId=None, builtTroves=None,
@@ -108,8 +122,47 @@ class Worker(server.Server):
         if not commandId:
             commandId = self.idgen.getResolveCommandId(resolveJob.getTrove())
         jobId = resolveJob.getTrove().jobId
+        self._warmResolveSources(resolveJob.getConfig())
         self.queueCommand(self.commandClasses['resolve'], self.cfg, commandId,
-                          jobId, eventHandler, logData, resolveJob)
+                          jobId, eventHandler, logData, resolveJob,
+                          self.resolveSourceCache)
+
+    def resolveTroves(self, resolveJobs, eventHandler, logDataList,
+                      commandId=None):
+        """
+            Resolves several troves in a single command.  The resolve jobs
+            must all share the same build configuration.
+        """
+        if not commandId:
+            commandId = self.idgen.getResolveCommandId(
+                                                resolveJobs[0].getTrove())
+        jobId = resolveJobs[0].getTrove().jobId
+        self._warmResolveSources(resolveJobs[0].getConfig())
+        self.queueCommand(self.commandClasses['batchresolve'], self.cfg,
+                          commandId, jobId, eventHandler, logDataList,
+                          resolveJobs, self.resolveSourceCache)
+
+    def _warmResolveSources(self, buildCfg):
+        """
+            Loads the resolveTroves for buildCfg into this worker's
+            resolve source cache.  Resolve commands are forked from this
+            process, so they all start with the loaded sources instead of
+            each fetching and indexing the resolveTroves again.
+        """
+        if (not self.resolveSourceCache.size
+            or not buildCfg.resolveTroveTups
+            or self.resolveSourceCache.hasSources(buildCfg)):
+            return
+        try:
+            repos = conaryclient.ConaryClient(buildCfg).getRepos()
+            if self.cfg.useCache:
+                repos = repocache.CachingTroveSource(repos,
+                                                     self.cfg.getCacheDir())
+            self.resolveSourceCache.getSources(buildCfg, repos)
+        except Exception, err:
+            # the resolve command will try again itself and report
+            # the failure against the trove.
+            self.warning('Could not load resolveTroves: %s' % err)
 
     def stopCommand(self, targetCommandId, commandId=None):
         targetCommand = self.getCommandById(targetCommandId)
@@ -208,6 +261,10 @@ class Worker(server.Server):
             Called during serve loop to look for information being
             returned from commands.  Passes any read data to the local
             command instance for parsing.
+
+            Waits at most sleep seconds (or forever if sleep is None) for
+            data to arrive.  If _watchChildren has been called, a command
+            exiting also ends the wait.
         """
         # If a command involves forking, there are two versions of the 
         # command object: one kept in the worker, its sibling forked
@@ -216,9 +273,7 @@ class Worker(server.Server):
         # parsed by the worker-held instance of the command.
         ready = []
         try:
-            ready = select.select(self.commands, [], [], sleep)[0]
-        except select.error, err:
-            pass
+            ready = self._waitForInput(self.commands, sleep)
         except IOError, err:
             # this could happen because a pipe has been closed.  In this 
             # case, we should notice the pid dying shortly anyway and
@@ -211,8 +211,7 @@ class JobLogDisplay(_AbstractDisplay):
             return
         try:
             moreData, data, mark = self.client.getTroveBuildLog(jobId,
-                                                                troveTuple,
-                                                                mark)
+                            troveTuple, mark, maxSize=monitor.LOG_CHUNK_SIZE)
         except:
             return
         if data and data != '\n': 
@@ -85,6 +85,12 @@ class MessageBusAdminClient(object):
         """
         return self.getDispatcher().listAssignedCommands()
 
+    def getOpenSlotCount(self):
+        """
+            Asks the dispatcher how many slots are free across all nodes.
+        """
+        return self.getDispatcher().getOpenSlotCount()
+
     def getNode(self, nodeId):
         nodeClient =  self.nodes.get(nodeId, None)
         if not nodeClient:
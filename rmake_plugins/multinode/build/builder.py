@@ -15,6 +15,9 @@
 #
 
 
+import time
+
+from rmake import constants
 from rmake import failure
 
 from rmake.build import builder
@@ -27,17 +30,23 @@ from rmake.worker import worker
 from rmake.multinode import messages
 from rmake.multinode import nodeclient
 from rmake.multinode import nodetypes
+from rmake.multinode.server import dispatcher
 
 class WorkerClient(server.Server):
     """
         Used by build manager to speak w/ worker + receive updates on 
         troves.
     """
+    # seconds between asking the dispatcher for the number of free slots
+    slotCountInterval = 10
+
     def __init__(self, cfg, job, db):
         server.Server.__init__(self)
+        self.cfg = cfg
         self.client = BuilderNodeClient(cfg, job.jobId, self)
         self.hasUpdate = False
         self.eventHandler = builder.EventHandler(job, self.client)
+        self._openSlotsChecked = 0
 
     def eventsReceived(self, jobId, eventList):
         self.eventHandler._receiveEvents(self.eventHandler.apiVersion, 
@@ -62,6 +71,20 @@ class WorkerClient(server.Server):
         resolveJob.getTrove().disown()
         self.client.resolveTrove(resolveJob, logData)
 
+    def resolveTroves(self, resolveJobs, eventHandler, logDataList):
+        # send each trove separately so the dispatcher can spread them
+        # across nodes.
+        for resolveJob, logData in zip(resolveJobs, logDataList):
+            self.resolve(resolveJob, eventHandler, logData)
+
+    def getOpenSlotCount(self):
+        # the answer to this request comes in while the build loop polls
+        # the bus, so until then the last count is used.
+        if time.time() - self._openSlotsChecked >= self.slotCountInterval:
+            self._openSlotsChecked = time.time()
+            self.client.requestOpenSlotCount()
+        return self.client.openSlots
+
     def loadTroves(self, job, loadTroves, eventHandler, reposName):
         job.disown()
         self.client.loadTroves(job, loadTroves, reposName)
@@ -92,10 +115,14 @@ class WorkerClient(server.Server):
             return True
         return False
 
-    def handleRequestIfReady(self):
-        self.client.poll()
+    def handleRequestIfReady(self, sleep=0.1):
+        self.client.poll(timeout=sleep)
         self.client._collectChildren()
 
+    def _watchChildren(self):
+        # results arrive over the message bus, not from child processes.
+        pass
+
 
 class BuilderNodeClient(nodeclient.NodeClient):
 
@@ -105,6 +132,8 @@ class BuilderNodeClient(nodeclient.NodeClient):
         self.jobId = jobId
         self._commands = {}
         self.idgen = worker.CommandIdGen()
+        self._dispatcherId = None
+        self.openSlots = 0
 
         node = nodetypes.BuildManager()
         nodeclient.NodeClient.__init__(self, cfg.getMessageBusHost(),
@@ -136,6 +165,44 @@ class BuilderNodeClient(nodeclient.NodeClient):
                 del self._commands[commandId]
                 #self.bus.unsubscribe('/commandstatus?commandId=%s' % commandId)
 
+    def requestOpenSlotCount(self):
+        """
+            Ask the dispatcher how many slots are free, without waiting
+            for the answer.  openSlots is updated when it arrives.
+        """
+        if not self.bus.isRegistered():
+            return
+        if self._dispatcherId is None:
+            # ask the message bus which session is the dispatcher first
+            self._callRemoteMethod('', 'listSessions', self._gotSessions)
+        else:
+            self._callRemoteMethod(self._dispatcherId, 'getOpenSlotCount',
+                                   self._gotOpenSlotCount)
+
+    def _callRemoteMethod(self, sessionId, methodName, callback):
+        callData = dict(apiMajorVersion=constants.apiMajorVersion,
+                        apiMinorVersion=constants.apiMinorVersion,
+                        methodVersion=1)
+        self.bus.callRemoteMethod(sessionId, methodName, (callData,),
+                                  callback=callback)
+
+    def _gotSessions(self, m):
+        if m.isError():
+            return
+        for sessionId, sessionClass in m.getReturnValue().items():
+            if sessionClass == dispatcher.DispatcherNodeClient.sessionClass:
+                self._dispatcherId = sessionId
+                self.requestOpenSlotCount()
+                return
+
+    def _gotOpenSlotCount(self, m):
+        if m.isError():
+            # the dispatcher may have been restarted; look it up again
+            # next time.
+            self._dispatcherId = None
+            return
+        self.openSlots = m.getReturnValue()
+
     def stopTroveLogger(self, trove):
         if not hasattr(trove, 'logPid'):
             return
@@ -109,6 +109,17 @@ class QueryTest(rmakehelp.RmakeHelper):
          Start: TIME
          Status: Could not satisfy build requirements: foo:run=[]
 
+'''.split())
+        # details alone come from the job summary
+        rv, txt = self.captureOutput(query.displayJobInfo, client, job.jobId,
+                                     displayDetails=True)
+        txt = re.sub('Started: .*Build Time:.*', 'Started:  TIME', txt)
+        assert(txt.split() == '''\
+1      State:    Failed
+       Status:   Failed while building: troves failed
+       Started:  TIME
+       To Build: 0                    Building: 0
+       Built:    0                    Failed:   1
 '''.split())
         rv, txt = self.captureOutput(query.displayJobInfo, client, job.jobId,
                                      displayTroves=True)
@@ -16,6 +16,7 @@
 
 
 import os
+import time
 
 from rmake_test import rmakehelp
 
@@ -54,3 +55,80 @@ class Databasetest(rmakehelp.RmakeHelper):
         assert(s.uri == 'dbc@rpath.com')
         assert(s['toName'] == 'Blah')
         assert(not db.subscriberStore.getMatches(1, [[('TROVE_UPDATED', ''), 'foo']]))
+
+    def testGetTroveBuildLog(self):
+        class FakeTrove(object):
+            def __init__(self, logPath):
+                self.logPath = logPath
+                self.finished = False
+            def isFinished(self):
+                return self.finished
+        logPath = self.workDir + '/build.log'
+        open(logPath, 'w').write('0123456789')
+        trove = FakeTrove(logPath)
+        db = self.openRmakeDatabase()
+        self.mock(db, 'convertToJobId', lambda jobId: jobId)
+        self.mock(db, 'getTrove', lambda *args: trove)
+        troveTup = self.makeTroveTuple('foo:source')
+
+        self.failUnlessEqual(db.getTroveBuildLog(1, troveTup, 0),
+                             (True, '0123456789', 10))
+        self.failUnlessEqual(db.getTroveBuildLog(1, troveTup, 2, maxSize=4),
+                             (True, '2345', 6))
+        self.failUnlessEqual(db.getTroveBuildLog(1, troveTup, -3),
+                             (True, '789', 10))
+
+        # wait for data to be appended
+        def sleep(seconds):
+            open(logPath, 'a').write('abc')
+        self.mock(time, 'sleep', sleep)
+        self.failUnlessEqual(db.getTroveBuildLog(1, troveTup, 10, timeout=5),
+                             (True, 'abc', 13))
+
+        # a finished trove has more data until it's been read to the end
+        trove.finished = True
+        self.failUnlessEqual(db.getTroveBuildLog(1, troveTup, 0, maxSize=10,
+                                                 timeout=5),
+                             (True, '0123456789', 10))
+        self.failUnlessEqual(db.getTroveBuildLog(1, troveTup, 10, maxSize=10,
+                                                 timeout=5),
+                             (False, 'abc', 13))
+
+    def testWriteBehind(self):
+        trvTup = self.makeTroveTuple('foo:source')
+        job = self.newJob(trvTup)
+        db = self.openRmakeDatabase()
+        otherDb = self.openRmakeDatabase()
+        db.enableWriteBehind(maxDelay=3600, maxWrites=5)
+        trove = db.getTrove(job.jobId, *trvTup)
+
+        trove.pid = 1234
+        db.updateTroveLog(trove, 'one')
+        trove.pid = 1235
+        db.updateTroveLog(trove, 'two')
+        db.updateTroveLog(trove, 'three')
+        # nothing is written until the batch is full, and the trove
+        # itself is only written once.
+        self.failUnlessEqual(otherDb.getTrove(job.jobId, *trvTup).pid, 0)
+        self.failUnlessEqual(db.getStateWriteStats()['pending'], 4)
+        db.updateTroveLog(trove, 'four')
+        self.failUnlessEqual(otherDb.getTrove(job.jobId, *trvTup).pid, 1235)
+        messages = [ x[1] for x in otherDb.getTroveLogs(job.jobId, trvTup) ]
+        self.failUnlessEqual(messages[-4:], ['one', 'two', 'three', 'four'])
+        stats = db.getStateWriteStats()
+        self.failUnlessEqual((stats['commits'], stats['writes'],
+                              stats['coalesced'], stats['pending']),
+                             (1, 5, 3, 0))
+
+        trove.pid = 1236
+        db.updateTrove(trove)
+        db.flushStateWrites()
+        newTrove = otherDb.getTrove(job.jobId, *trvTup)
+        self.failUnlessEqual(newTrove.pid, 1236)
+        self.failUnlessEqual(newTrove.settings, trove.settings)
+
+        # a forked child leaves pending writes to its parent
+        db.updateTrove(trove)
+        db.reopen()
+        self.failIf(db.isWriteBehindEnabled())
+        self.failUnlessEqual(db.getStateWriteStats()['pending'], 0)
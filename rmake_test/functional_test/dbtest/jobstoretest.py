@@ -56,6 +56,34 @@ class JobStoreTest(rmakehelp.RmakeHelper):
         assert(set(results[buildtrove.TROVE_STATE_INIT]) == set([d, e]))
         assert(len(results) == 1)
 
+    def testGetJobSummary(self):
+        db = self.openRmakeDatabase()
+        atrv = self.Component('a:source')[0]
+        btrv = self.Component('b:source')[0]
+        ctrv = self.Component('c:source')[0]
+        job = self.newJob(atrv, btrv, ctrv)
+        a, b, c = buildTroves = self.makeBuildTroves(job)
+        db.subscribeToJob(job)
+        job.setBuildTroves(buildTroves)
+        b.troveFailed('foo')
+        c.troveBuilding()
+
+        summary = db.getJobSummary(job.jobId)
+        self.failUnlessEqual(dict(summary['troveCounts']),
+                             {buildtrove.TROVE_STATE_INIT     : 1,
+                              buildtrove.TROVE_STATE_FAILED   : 1,
+                              buildtrove.TROVE_STATE_BUILDING : 1})
+        self.failUnlessEqual(summary['names'],
+                             ['a:source', 'b:source', 'c:source'])
+        self.failUnlessEqual(summary['contexts'], ['', '', ''])
+        self.failUnlessEqual(summary['states'],
+                             [buildtrove.TROVE_STATE_INIT,
+                              buildtrove.TROVE_STATE_FAILED,
+                              buildtrove.TROVE_STATE_BUILDING])
+        self.failUnlessEqual(summary['starts'][0], 0)
+        self.failUnless(summary['starts'][2])
+        self.failUnlessEqual(len(summary['finishes']), 3)
+
     def testGetJobsAndTroves(self):
         db = self.openRmakeDatabase()
         atrv = self.Component('a:source')[0]
@@ -15,6 +15,7 @@
 #
 
 
+import re
 import shutil
 
 from conary import dbstore
@@ -46,3 +47,97 @@ class SchemaTest(rmakehelp.RmakeHelper):
         dbPath = self.workDir + '/jobs.db'
         shutil.copyfile(resources.get_archive('jobs.db.v5'))
         db = database.Database(('sqlite', dbPath), self.workDir + '/contents')
+
+    def _getQueryPlans(self, db, fn, *args):
+        """
+            Run fn and return the query plan of each SELECT it made, as
+            a list of (sql, [plan details]).
+        """
+        queries = []
+        realCursor = db.cursor
+        class RecordingCursor(object):
+            def __init__(self, cu):
+                self._cu = cu
+            def execute(self, sql, *args, **kw):
+                queries.append((sql, args))
+                return self._cu.execute(sql, *args, **kw)
+            def __iter__(self):
+                return iter(self._cu)
+            def __getattr__(self, key):
+                return getattr(self._cu, key)
+        self.mock(db, 'cursor', lambda: RecordingCursor(realCursor()))
+        fn(*args)
+        plans = []
+        for sql, args in queries:
+            if not sql.strip().upper().startswith('SELECT'):
+                continue
+            cu = realCursor()
+            cu.execute('EXPLAIN QUERY PLAN ' + sql, *args)
+            plans.append((sql, [ x[-1] for x in cu ]))
+        return plans
+
+    def testHotQueriesUseIndexes(self):
+        trvTup = self.makeTroveTuple('foo:source')
+        job = self.newJob(trvTup)
+        db = self.openRmakeDatabase()
+        db.addNode('_local_', 'localhost.localdomain', 4, [], [])
+        trove = db.getTrove(job.jobId, *trvTup)
+        db.updateTroveLog(trove, 'building')
+
+        # seed enough rows that the planner would rather not scan
+        cu = db.cursor()
+        db.db.transaction()
+        for jobId in range(job.jobId + 1, job.jobId + 1001):
+            cu.execute('INSERT INTO Jobs (jobId, state) VALUES (?, 0)', jobId)
+            troveId = jobId + 100000
+            cu.execute('INSERT INTO BuildTroves (troveId, jobId, troveName,'
+                       ' version, flavor, state) VALUES (?, ?, ?, ?, ?, 0)',
+                       troveId, jobId, 'bar:source', 'v', 'f')
+            cu.execute('INSERT INTO Chroots (nodeName, path, troveId, active)'
+                       ' VALUES (?, ?, ?, 0)', '_local_', '/tmp/%s' % jobId,
+                       troveId)
+            for idx in range(20):
+                cu.execute('INSERT INTO StateLogs (jobId, troveId, message)'
+                           ' VALUES (?, ?, ?)', jobId, troveId, 'msg')
+                cu.execute('INSERT INTO StateLogs (jobId, message)'
+                           ' VALUES (?, ?)', jobId, 'msg')
+        cu.execute('ANALYZE')
+        db.commit()
+
+        hotCalls = [
+            (db.jobStore.getJobLogsSince, job.jobId, 0),
+            (db.jobStore.getTroveLogsSince, job.jobId, trvTup, 0),
+            (db.jobStore.getTroveLogs, job.jobId, trvTup, 0),
+            (db.jobStore.isJobBuilding,),
+            (db.nodeStore.getEmptySlots,),
+            ]
+        # node lists are a handful of rows, scanning them is fine.
+        smallTables = set(['Nodes'])
+        for call in hotCalls:
+            for sql, plan in self._getQueryPlans(db, *call):
+                for detail in plan:
+                    m = re.match('SCAN (?:TABLE )?(\w+)', detail)
+                    if m and 'INDEX' not in detail:
+                        self.failUnless(m.group(1) in smallTables,
+                                        '%s scans a table:\n%s' % (sql, plan))
+                    self.failIf('TEMP B-TREE FOR ORDER BY' in detail,
+                                '%s sorts its results:\n%s' % (sql, plan))
+
+        logs = db.jobStore.getTroveLogsSince(job.jobId, trvTup, 0)
+        self.failUnlessEqual(logs[-1][2], 'building')
+        self.failIf(db.jobStore.getTroveLogsSince(job.jobId, trvTup,
+                                                  logs[-1][0]))
+
+    def testMigrateIndexes(self):
+        db = self.openRmakeDatabase()
+        db.db.createIndex('StateLogs', 'StateLogsJobTroveId', 'jobId,troveId')
+        db.db.dropIndex('StateLogs', 'StateLogsJobTroveLogIdx')
+        db.db.dropIndex('Jobs', 'JobsStateIdx')
+        db.db.setVersion(12)
+        db.commit()
+        db = self.openRmakeDatabase()
+        self.failUnlessEqual(db.schemaVersion, schema.SCHEMA_VERSION)
+        db.db.loadSchema()
+        self.failUnlessEqual(sorted(db.db.tables['StateLogs']),
+                             ['StateLogsJobTroveLogIdx'])
+        self.failUnless('JobsStateIdx' in db.db.tables['Jobs'])
@@ -28,4 +28,17 @@ class ErrorsTest(rmakehelp.RmakeHelper):
             assert(str(err) == 'JobNotFound: Could not find job with jobId 1')
         else:
             assert(False)
+        try:
+            client.client.getJobLogsSince(1, 0)
+        except errors.JobNotFound, err:
+            assert(str(err) == 'JobNotFound: Could not find job with jobId 1')
+        else:
+            assert(False)
+        trvTup = self.makeTroveTuple('foo:source')
+        try:
+            client.client.getTroveLogsSince(1, trvTup, 0)
+        except errors.JobNotFound, err:
+            assert(str(err) == 'JobNotFound: Could not find job with jobId 1')
+        else:
+            assert(False)
         client.client.uri.server._close()
@@ -17,8 +17,10 @@
 
 import os
 import signal
+import socket
 import sys
 import time
+import xmlrpclib
 
 
 #test
@@ -33,6 +35,7 @@ from rmake import errors
 from rmake.lib import apirpc
 from rmake.lib import apiutils
 from rmake.lib.apiutils import api, api_parameters, api_return, api_forking, api_nonforking
+from rmake.lib.apiutils import api_readonly
 from rmake.lib.rpcproxy import ShimAddress
 
 class TestServer(apirpc.XMLApiServer):
@@ -66,6 +69,24 @@ class TestServer(apirpc.XMLApiServer):
     def getPidNoForking(self, callData):
         return os.getpid()
 
+    @api_readonly
+    @api(version=1)
+    @api_parameters(1, 'int')
+    @api_return(1, None)
+    def getPidReadOnly(self, callData, val):
+        if val < 0:
+            raise errors.RmakeError('Cannot accept %s' % val)
+        if val == 0:
+            os._exit(1)
+        return os.getpid(), val
+
+    @api_readonly
+    @api(version=1)
+    @api_parameters(1, 'int')
+    @api_return(1, None)
+    def getDataReadOnly(self, callData, size):
+        return 'x' * size
+
     @api(version=1)
     @api_parameters(1)
     @api_return(1, None)
@@ -115,6 +136,9 @@ class TestClient(object):
     def getPidForking(self):
         return self.proxy.getPidForking()
 
+    def getPidReadOnly(self, val):
+        return self.proxy.getPidReadOnly(val)
+
     def delayed(self, val):
         return self.proxy.delayed(val)
 
@@ -278,3 +302,77 @@ class ApiRPCTest(rmakehelp.RmakeHelper):
         finally:
             os.kill(serverPid, 9)
             self.waitThenKill(serverPid)
+
+    def testApiWorkerPool(self):
+        port = testsuite.findPorts(1)[0]
+        uri = 'http://localhost:%s/conary/' % port
+        server = TestServer(uri, forkByDefault=True, poolSize=2)
+
+        serverPid = os.fork()
+        if not serverPid:
+            try:
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        try:
+            client = TestClient(uri)
+            assert(client.getPid() not in (serverPid, os.getpid()))
+            workers = set()
+            for val in range(1, 11):
+                pid, rv = client.getPidReadOnly(val)
+                self.assertEqual(rv, val)
+                workers.add(pid)
+            # calls one after another are all answered by the same
+            # long-lived worker
+            self.assertEqual(len(workers), 1)
+            assert(serverPid not in workers)
+            self.assertRaises(errors.RmakeError, client.getPidReadOnly, -1)
+
+            # calls made while every worker is busy wait for one
+            pids = []
+            for val in range(1, 6):
+                pid = os.fork()
+                if not pid:
+                    try:
+                        assert(client.getPidReadOnly(val)[1] == val)
+                        os._exit(0)
+                    finally:
+                        os._exit(1)
+                pids.append(pid)
+            for pid in pids:
+                pid, status = self.waitThenKill(pid)
+                assert(not status)
+
+            # a worker that dies is replaced
+            self.assertRaises(apirpc.ApiError, client.getPidReadOnly, 0)
+            pid, rv = client.getPidReadOnly(1)
+            self.assertEqual(rv, 1)
+
+            # a client that doesn't read its response doesn't hold up
+            # other calls
+            size = 8 * 1024 * 1024
+            callData = dict(apiMajorVersion=TestServer._apiMajorVersion,
+                            apiMinorVersion=TestServer._apiMinorVersion,
+                            methodVersion=1)
+            body = xmlrpclib.dumps((callData, size), 'getDataReadOnly')
+            slow = socket.socket()
+            slow.connect(('localhost', port))
+            slow.sendall('POST /conary/ HTTP/1.0\r\n'
+                         'Content-Type: text/xml\r\n'
+                         'Content-Length: %d\r\n\r\n%s' % (len(body), body))
+            time.sleep(1)
+            pid, rv = client.getPidReadOnly(2)
+            self.assertEqual(rv, 2)
+            response = ''
+            while True:
+                data = slow.recv(65536)
+                if not data:
+                    break
+                response += data
+            slow.close()
+            headers, body = response.split('\r\n\r\n', 1)
+            assert(headers.startswith('HTTP/1.0 200'))
+            self.assertEqual(xmlrpclib.loads(body)[0][0], [True, 'x' * size])
+        finally:
+            os.kill(serverPid, 9)
+            self.waitThenKill(serverPid)
@@ -15,6 +15,8 @@
 #
 
 
+import os
+
 #test
 from conary_test import rephelp
 
@@ -36,3 +38,19 @@ class ProcUtilTest(rephelp.RepositoryHelper):
         assert(xx == m)
         xx.update()
         assert(xx != m)
+
+    def testForkWorkers(self):
+        def work(n):
+            for x in range(n, 6, 2):
+                if x == 3:
+                    os._exit(3)
+                yield x, os.getpid()
+        exited = {}
+        def onExit(n, status):
+            exited[n] = os.WEXITSTATUS(status)
+        results = list(procutil.forkWorkers(2, work, onExit))
+        self.assertEqual(sorted((n, x) for n, (x, pid) in results),
+                         [(0, 0), (0, 2), (0, 4), (1, 1)])
+        # the work is done in the forked processes
+        assert(os.getpid() not in [ pid for n, (x, pid) in results ])
+        self.assertEqual(exited, {0: 0, 1: 3})
@@ -17,11 +17,13 @@
 
 import os
 import sys
+import time
 
 
 from rmake_test import rmakehelp
 
 from conary import conaryclient
+from conary import dbstore
 from conary.deps import deps
 from conary.lib import util
 
@@ -83,6 +85,35 @@ class RepositoryCacheTest(rmakehelp.RmakeHelper):
         client.applyUpdate(updJob, replaceFiles=False)
         assert(os.path.exists(self.rootDir + '/foobar'))
 
+    def testDownloadWorkers(self):
+        troves = [ self.addComponent('foo%d:runtime' % x, '1', '',
+                                     [('/foo%d' % x, 'foo%d\n' % x)])
+                   for x in range(5) ]
+        jobList = [ (x.getName(), (None, None),
+                     (x.getVersion(), x.getFlavor()), False)
+                    for x in troves ]
+        cacheDir = self.workDir + '/cache'
+        util.mkdirChain(cacheDir)
+        repos = self.openRepository()
+        store = repocache.RepositoryCache(cacheDir, downloadWorkers=3)
+        stats = repocache.DownloadStats()
+        csList = store.getChangeSets(repos, jobList, stats=stats)
+        self.assertEquals(stats.roundTrips, 5)
+        self.assertEquals(stats.cached, 0)
+        assert(stats.bytes > 0)
+        for cs, trv in zip(csList, troves):
+            self.assertEquals([ x.getName() for x in cs.iterNewTroveList() ],
+                              [trv.getName()])
+
+        # everything comes from the cache the second time
+        stats = repocache.DownloadStats()
+        csList = store.getChangeSets(None, jobList, stats=stats)
+        self.assertEquals(stats.roundTrips, 0)
+        self.assertEquals(stats.cached, 5)
+        for cs, trv in zip(csList, troves):
+            self.assertEquals([ x.getName() for x in cs.iterNewTroveList() ],
+                              [trv.getName()])
+
     def testGetFileContents(self):
         fooRun = self.addComponent('foo:runtime', '1',
                                     [('/foo', 'hello world!\n')])
@@ -108,6 +139,11 @@ class RepositoryCacheTest(rmakehelp.RmakeHelper):
         store = repocache.RepositoryCache(cacheDir)
         assert(os.path.exists(store.getFileContentsPaths(repos, fileList)[0]))
 
+    def _countCached(self, cacheDir):
+        # the cache index is kept in the cache directory, next to the
+        # datastore's directories
+        return len([ x for x in os.listdir(cacheDir) if x != 'index.db' ])
+
     def testReadOnly(self):
         fooRun = self.addComponent('foo:runtime', '1',
                                     [('/foo', 'hello world!\n'),
@@ -125,10 +161,10 @@ class RepositoryCacheTest(rmakehelp.RmakeHelper):
         store = repocache.RepositoryCache(cacheDir, readOnly=True)
         assert(store.getFileContents(repos, [barFile])[0].get().read() 
                 == 'goodbye world!\n')
-        assert(len(os.listdir(cacheDir)) == 1) # for /foo
+        assert(self._countCached(cacheDir) == 1) # for /foo
 
         store.getTroves(repos, [fooRun.getNameVersionFlavor()])
-        assert(len(os.listdir(cacheDir)) == 1) # nothing added
+        assert(self._countCached(cacheDir) == 1) # nothing added
 
         # now try adding that missing file.  Make sure we get /foo from
         # the cache by removing it from the repository.
@@ -138,10 +174,69 @@ class RepositoryCacheTest(rmakehelp.RmakeHelper):
         store = repocache.RepositoryCache(cacheDir, readOnly=False)
         assert(store.getFileContents(repos, [barFile])[0].get().read()
                 == 'goodbye world!\n')
-        assert(len(os.listdir(cacheDir)) == 2) # /bar is now added
+        assert(self._countCached(cacheDir) == 2) # /bar is now added
 
         store.getTroves(repos, [fooRun.getNameVersionFlavor()])
-        assert(len(os.listdir(cacheDir)) == 3) # fooRun now added
+        assert(self._countCached(cacheDir) == 3) # fooRun now added
+
+    def testIndexAndPrune(self):
+        fooRun = self.addComponent('foo:runtime', '1',
+                                    [('/foo', 'hello world!\n'),
+                                     ('/bar', 'goodbye world!\n')])
+        fileDict = dict((x[1], (x[2], x[3])) for x in fooRun.iterFileList())
+        fooFile = fileDict['/foo']
+        barFile = fileDict['/bar']
+        repos = self.openRepository()
+        cacheDir = self.workDir + '/cache'
+        util.mkdirChain(cacheDir)
+        store = repocache.RepositoryCache(cacheDir)
+        store.getFileContents(repos, [fooFile])
+        store.getFileContents(repos, [fooFile, barFile])
+        stats = store.getStats()
+        self.assertEquals(stats['entries'], 2)
+        self.assertEquals(stats['misses'], 2)
+        self.assertEquals(stats['hits'], 1)
+        fooSize = store.index.listEntries()[0][1]
+        self.assertEquals(stats['bytesSaved'], fooSize)
+
+        # entries cached before the index existed are picked up, with
+        # their modification time as the time of last use.
+        fooPath = store.store.hashToPath(str(store.hashFile(*fooFile)))
+        os.utime(fooPath, (0, 0))
+        os.remove(cacheDir + '/index.db')
+        store = repocache.RepositoryCache(cacheDir)
+        self.assertEquals(store.getStats()['entries'], 0)
+        store.syncIndex()
+        self.assertEquals(store.getStats()['entries'], 2)
+
+        # the least recently used entry goes, but recently used ones are
+        # kept even past the size limit.
+        self.assertEquals(store.prune(1), (1, fooSize))
+        stats = store.getStats()
+        self.assertEquals(stats['entries'], 1)
+        self.assertEquals(stats['evicted'], 1)
+        assert(not os.path.exists(fooPath))
+        self.assertEquals(
+                store.getFileContents(repos, [barFile])[0].get().read(),
+                'goodbye world!\n')
+
+    def testIndexUpdateDoesNotWait(self):
+        index = repocache.CacheIndex(self.workDir + '/cache/index.db')
+        index.update(added=[('a' * 40, 10, 0)])
+        # another process writing to the index
+        db = dbstore.connect(index.path, driver='sqlite')
+        db.transaction()
+        db.cursor().execute("UPDATE CacheStats SET value = 1"
+                            " WHERE name = 'evicted'")
+        start = time.time()
+        index.update(added=[('b' * 40, 10, 0)], hits=['a' * 40])
+        assert(time.time() - start < 5)
+        db.rollback()
+        self.assertEquals(index.getStats()['entries'], 1)
+        self.assertEquals(index.getStats()['hits'], 0)
+        index.update(added=[('b' * 40, 10, 0)], hits=['a' * 40])
+        self.assertEquals(index.getStats()['entries'], 2)
+        self.assertEquals(index.getStats()['hits'], 1)
 
     def testResolveByGroups(self):
         cacheDir = self.workDir + '/cache'
@@ -0,0 +1,209 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Message bus load harness.
+
+Starts a message bus in a child process and simulates a dispatcher, N
+worker nodes sending status updates and M jobs sending event lists, all
+over real sockets.  Reports how long the dispatcher took to receive
+everything.
+
+Run directly to load a local bus:
+
+    python busload.py --nodes 200 --jobs 50 --messages 100
+
+or to time subscription routing alone, without sockets:
+
+    python busload.py --routing --jobs 500 --messages 100000
+"""
+import optparse
+import os
+import signal
+import sys
+import tempfile
+import time
+import traceback
+
+from conary.lib import util
+
+from rmake.messagebus import busclient
+from rmake.messagebus import messages
+from rmake.multinode.server import messagebus
+
+
+class LoadMessage(messages.Message):
+    messageType = 'LOADTEST'
+
+    def set(self, sender, count, events=()):
+        self.headers.sender = sender
+        self.headers.count = count
+        self.payload.events = list(events)
+
+
+def _startBus(workDir):
+    readFd, writeFd = os.pipe()
+    pid = os.fork()
+    if pid:
+        os.close(writeFd)
+        port = int(os.read(readFd, 20))
+        os.close(readFd)
+        return pid, port
+    try:
+        try:
+            os.close(readFd)
+            bus = messagebus.MessageBus('', 0, workDir + '/messagebus.log')
+            bus.getLogger().disableConsole()
+            os.write(writeFd, str(bus.getPort()))
+            os.close(writeFd)
+            bus.serve_forever()
+        except:
+            traceback.print_exc()
+    finally:
+        os._exit(1)
+
+def _makeClient(port, workDir, sessionClass):
+    client = busclient.MessageBusClient('localhost', port, None,
+                                    sessionClass=sessionClass,
+                                    logPath=workDir + '/client.log',
+                                    connectionTimeout=10)
+    client.logger.setQuietMode()
+    client.connect()
+    return client
+
+def _pollAll(clients):
+    for client in clients:
+        client.poll(0, 1)
+
+def runLoad(nodes=10, jobs=5, count=20, workDir=None, timeout=300):
+    """
+        Send count messages from each of nodes nodes and jobs jobs to a
+        single dispatcher session.  Returns a dict of timings.
+    """
+    cleanWorkDir = workDir is None
+    if cleanWorkDir:
+        workDir = tempfile.mkdtemp(prefix='busload-')
+    busPid, port = _startBus(workDir)
+    try:
+        dispatcher = _makeClient(port, workDir, 'DISPATCHER')
+        nodeClients = [ _makeClient(port, workDir, 'WORKER')
+                        for x in range(nodes) ]
+        jobClients = [ _makeClient(port, workDir, 'BUILDER')
+                       for x in range(jobs) ]
+        senders = nodeClients + jobClients
+        allClients = [dispatcher] + senders
+
+        start = time.time()
+        while [ x for x in allClients if not x.isRegistered() ]:
+            _pollAll(allClients)
+        dispatcher.subscribe('/loadtest/status')
+        dispatcher.subscribe('/loadtest/events')
+        dispatcher.flush()
+        for client in allClients:
+            client.popMessages()
+        connectTime = time.time() - start
+
+        # roughly the shape of a frozen EventList from a job
+        events = [ ((('TROVE_STATE_UPDATED', 1),
+                    ('job-%d' % x, ('foo:source', '/localhost@rpl:1/1.0-1',
+                                    ''), 'building'))) for x in range(20) ]
+        start = time.time()
+        for i in range(count):
+            for client in nodeClients:
+                m = LoadMessage()
+                m.set(client.getSessionId(), i)
+                client.sendMessage('/loadtest/status', m)
+            for client in jobClients:
+                m = LoadMessage()
+                m.set(client.getSessionId(), i, events)
+                client.sendMessage('/loadtest/events', m)
+        expected = (nodes + jobs) * count
+        received = 0
+        while received < expected:
+            if time.time() - start > timeout:
+                raise RuntimeError('Only %s of %s messages received'
+                                   % (received, expected))
+            _pollAll(allClients)
+            received += len(dispatcher.popMessages())
+        elapsed = time.time() - start
+    finally:
+        os.kill(busPid, signal.SIGKILL)
+        os.waitpid(busPid, 0)
+        if cleanWorkDir:
+            util.rmtree(workDir)
+    return dict(sessions=len(allClients), messages=expected,
+                connectTime=connectTime, elapsed=elapsed,
+                rate=expected / max(elapsed, 1e-6))
+
+class _FakeSession(object):
+    def __init__(self, sessionId):
+        self.sessionId = sessionId
+
+def benchmarkRouting(jobs=500, count=100000):
+    """
+        Route count event messages through a SubscriptionManager holding
+        one /event?jobId=N subscription per job, plus a dispatcher
+        listening to every event.  Returns a dict of timings.
+    """
+    subscribers = messagebus.SubscriptionManager()
+    subscribers.addSubscriber('/event', _FakeSession('DISPATCHER'))
+    for jobId in range(jobs):
+        subscribers.addSubscriber('/event?jobId=%d' % jobId,
+                                  _FakeSession('BUILDER-%d' % jobId))
+    eventMessages = []
+    for jobId in range(jobs):
+        m = LoadMessage()
+        m.set('BUILDER-%d' % jobId, 0)
+        m.headers.jobId = str(jobId)
+        m.direct('/event')
+        eventMessages.append(m)
+    start = time.time()
+    delivered = 0
+    for i in xrange(count):
+        for session in subscribers.iterSubscribers(
+                                        eventMessages[i % jobs]):
+            delivered += 1
+    elapsed = time.time() - start
+    if delivered != count * 2:
+        raise RuntimeError('%s messages delivered, expected %s'
+                           % (delivered, count * 2))
+    return dict(subscriptions=jobs + 1, messages=count, elapsed=elapsed,
+                rate=count / max(elapsed, 1e-6))
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('-n', '--nodes', type='int', default=100)
+    parser.add_option('-j', '--jobs', type='int', default=20)
+    parser.add_option('-m', '--messages', type='int', default=50,
+            help="Messages sent by each node and job")
+    parser.add_option('--routing', action='store_true',
+            help="Only time subscription routing, with --jobs"
+                 " subscriptions and --messages events")
+    options, args = parser.parse_args(argv)
+    if options.routing:
+        stats = benchmarkRouting(options.jobs, options.messages)
+        print ('%(messages)d events routed across %(subscriptions)d '
+               'subscriptions in %(elapsed).2fs (%(rate).0f/s)' % stats)
+        return 0
+    stats = runLoad(options.nodes, options.jobs, options.messages)
+    print ('%(sessions)d sessions connected in %(connectTime).2fs, '
+           '%(messages)d messages delivered in %(elapsed).2fs '
+           '(%(rate).0f/s)' % stats)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -330,3 +330,34 @@ class EnvelopeTest(rmakehelp.RmakeHelper):
         assert(outStream1.read() == data)
         outStream2.seek(0)
         assert(outStream2.read() == data)
+
+    def testLargeMessageChunked(self):
+        payload = ''.join(chr(x % 256) for x in range(100000))
+        m = envelope.Envelope()
+        m.setContentType('application/binary-stuff')
+        m.write(payload)
+        data = m.freeze()
+
+        # partial writes, as from a non-blocking socket
+        outStream = StringIO.StringIO()
+        def writeSome(data):
+            data = str(data)[:7919]
+            outStream.write(data)
+            return len(data)
+        writer = m.getWriter()
+        while not writer(writeSome):
+            pass
+        self.failUnlessEqual(outStream.getvalue(), data)
+
+        # read the payload straight into the envelope's buffer
+        inStream = StringIO.StringIO(data)
+        def readInto(buf, nbytes):
+            d = inStream.read(min(nbytes, 7919))
+            buf[:len(d)] = d
+            return len(d)
+        m2 = envelope.Envelope()
+        while not m2.thawFromStream(inStream.read, readInto=readInto):
+            pass
+        self.failUnlessEqual(m2.getContentType(), 'application/binary-stuff')
+        self.failUnlessEqual(m2.readPayload(), payload)
+        self.failUnlessEqual(m2.freeze(), data)
@@ -153,3 +153,85 @@ class MessageBusTest(rmakehelp.RmakeHelper):
         assert(isinstance(m, messages.NodeStatus))
         assert(m.getStatus() == 'RECONNECTED')
         assert(m.getStatusId() == client.getSessionId())
+
+    def testSendQueueLimit(self):
+        messageBusLog = self.workDir + '/messagebus.log'
+        clientLog = self.workDir + '/client-log'
+        mgr = messagebus.MessageBus('', 0, logPath=messageBusLog, maxQueue=5)
+        mgr._logger.disableConsole()
+        port = mgr.getPort()
+        client = busclient.MessageBusClient('localhost', port, None, logPath=clientLog)
+        client.logger.disableConsole()
+        client.connect()
+        client2 = busclient.MessageBusClient('localhost', port, None, logPath=clientLog)
+        client2.logger.disableConsole()
+        client2.connect()
+        p = Poller(mgr, client, client2)
+        while (p.writable() or not client.isRegistered()
+               or not client2.isRegistered()):
+            p.poll()
+        client2.popMessages()
+        client2.subscribe('/internal/nodes')
+        while p.poll():
+            pass
+        session = mgr.getSession(client.getSessionId())
+        # client never reads, so messages pile up on the bus until it gives
+        # up on the session.
+        for i in range(6):
+            m = messages.NodeStatus()
+            m.set('foo', 'CONNECTED')
+            session.sendMessage(m)
+        assert(mgr.getSession(client.getSessionId()) is None)
+        p = Poller(mgr, client2)
+        while not client2.hasMessages():
+            p.poll()
+        m = client2.popMessages()[0]
+        assert(m.getStatus() == 'DISCONNECTED')
+        assert(m.getStatusId() == client.getSessionId())
+
+    def testLoad(self):
+        from rmake_test.functional_test.pluginstest.messagebustest import busload
+        stats = busload.runLoad(nodes=10, jobs=5, count=10,
+                                workDir=self.workDir + '/busload')
+        assert(stats['messages'] == 150)
+
+    def testSubscriptionManager(self):
+        class Session(object):
+            def __init__(self, sessionId):
+                self.sessionId = sessionId
+        class MyMessage(messages.Message):
+            messageType = 'MINE'
+
+            def set(self, **params):
+                self.updateHeaders(params)
+        def _route(destination, targetId=None, **headers):
+            m = MyMessage()
+            m.set(**headers)
+            m.direct(destination, targetId)
+            return [ x.sessionId for x in subscribers.iterSubscribers(m) ]
+
+        a, b, c = Session('a'), Session('b'), Session('c')
+        subscribers = messagebus.SubscriptionManager()
+        subscribers.addSubscriber('/event?jobId=1', a)
+        subscribers.addSubscriber('/event', b)
+        subscribers.addSubscriber('/event?jobId=2', c)
+        subscribers.addSubscriber('/event?jobId=1;node=x', c)
+        subscribers.addSubscriber('/event?node=x', b)
+        self.failUnlessEqual(_route('/event', jobId='1'), ['a', 'b'])
+        self.failUnlessEqual(_route('/event', jobId='2', node='x'),
+                             ['b', 'c', 'b'])
+        self.failUnlessEqual(_route('/event', jobId='1', node='x'),
+                             ['a', 'b', 'c', 'b'])
+        self.failUnlessEqual(_route('/event', 'c', jobId='1', node='x'),
+                             ['c'])
+        self.failUnlessEqual(_route('/event'), ['b'])
+        self.failUnlessEqual(_route('/other', jobId='1'), [])
+
+        subscribers.deleteSubscriber(b)
+        self.failUnlessEqual(_route('/event', jobId='1', node='x'),
+                             ['a', 'c'])
+        subscribers.deleteSubscriber(a)
+        subscribers.deleteSubscriber(c)
+        self.failUnlessEqual(_route('/event', jobId='1', node='x'), [])
+        assert(not subscribers._channels)
+        assert(not subscribers._sessions)
@@ -15,6 +15,8 @@
 #
 
 
+import marshal
+
 from rmake_test import rmakehelp
 
 
@@ -37,3 +39,69 @@ class MessagesTest(rmakehelp.RmakeHelper):
         m2.loadPayloadFromString(payloadStream.read(payloadSize))
         assert(m2.payload.a == 3)
         assert(m2.payload.b == 4)
+
+    def testPayloadEncodings(self):
+        class MyMessage(messages.Message):
+            def set(self, **args):
+                self.payload.__dict__.update(args)
+
+        def _roundTrip(m):
+            headers, payloadStream, payloadSize = m.freeze()
+            return messages.thawMessage(headers, payloadStream, payloadSize)
+
+        m = MyMessage()
+        m.set(a=(1, ('foo', None)), b={'c': (2, 3)})
+        m.setPayloadEncoding(messages.PAYLOAD_MARSHAL)
+        m2 = _roundTrip(m)
+        self.failUnlessEqual(m.getPayloadEncoding(), 'marshal')
+        self.failUnlessEqual(m2.getPayloadEncoding(), 'marshal')
+        # tuples come back as lists, just like XML-RPC
+        self.failUnlessEqual(m2.payload.a, [1, ['foo', None]])
+        self.failUnlessEqual(m2.payload.b, {'c': [2, 3]})
+
+        # large payloads are compressed
+        m = MyMessage()
+        m.set(a='x' * (messages.COMPRESS_THRESHOLD * 2))
+        m.setPayloadEncoding(messages.PAYLOAD_MARSHAL)
+        m2 = _roundTrip(m)
+        self.failUnlessEqual(m2.getPayloadEncoding(), 'marshal+zlib')
+        assert(m2.getPayloadStreamSize() < messages.COMPRESS_THRESHOLD)
+        self.failUnlessEqual(m2.payload.a, m.payload.a)
+
+        # passing a marshalled message on to an XML-RPC session
+        m3 = _roundTrip(messages.recodeMessage(m2, messages.PAYLOAD_XMLRPC))
+        self.failUnlessEqual(m3.getPayloadEncoding(), '')
+        self.failUnlessEqual(m3.payload.a, m.payload.a)
+        assert(messages.recodeMessage(m3, messages.PAYLOAD_MARSHAL) is m3)
+
+    def testMarshalPayloadChecked(self):
+        payload = {'a': [1, 2 ** 70, 1.5, u'x', None, True],
+                   'b': {'c': (intern('d'), intern('d'))}}
+        self.failUnlessEqual(messages.decodePayload(marshal.dumps(payload),
+                                                    'marshal'),
+                             {'a': [1, 2 ** 70, 1.5, u'x', None, True],
+                              'b': {'c': ['d', 'd']}})
+        # anything XML-RPC could not have sent is refused
+        for bad in (compile('1', 'x', 'eval'), set([1]), 1j):
+            frz = marshal.dumps({'a': bad})
+            self.failUnlessRaises(RuntimeError, messages.decodePayload, frz,
+                                  'marshal')
+        frz = marshal.dumps({'a': 'foo'})
+        for bad in (frz[:-3], frz + 'N', '(\x02\x00\x00\x00N'):
+            self.failUnlessRaises(RuntimeError, messages.decodePayload, bad,
+                                  'marshal')
+
+    def testNegotiatePayloadEncoding(self):
+        negotiate = messages.negotiatePayloadEncoding
+        self.failUnlessEqual(negotiate('marshal,xmlrpc'), 'marshal')
+        self.failUnlessEqual(negotiate('msgpack, marshal'), 'marshal')
+        self.failUnlessEqual(negotiate('msgpack'), 'xmlrpc')
+        # old clients don't offer anything
+        self.failUnlessEqual(negotiate(''), 'xmlrpc')
+
+        m = messages.ConnectionRequest()
+        m.set('user', 'pass', 'WORKER')
+        self.failUnlessEqual(m.getPayloadEncodings(), 'marshal,xmlrpc')
+        m = messages.ConnectedResponse()
+        m.set('WORKER-foo')
+        self.failUnlessEqual(m.getSessionPayloadEncoding(), 'xmlrpc')
@@ -266,6 +266,26 @@ class DispatcherTest(rmakehelp.RmakeHelper):
         assert(not server._nodes.getNodeForFlavors([
                                             parseFlavor('foo is:ppc')]))
 
+    def testFlavorCache(self):
+        server, sessionClient = self._setupMockDispatcher()
+        flavors = [parseFlavor('bar is:x86_64')]
+        node = self.makeRegisterNodeMessage().getNode()
+        server.nodeRegistered('session1', node)
+        assert(not server._nodes.getNodeForFlavors(flavors))
+        node2 = self.makeRegisterNodeMessage(
+                        buildFlavors=['is:x86 x86_64']).getNode()
+        server.nodeRegistered('session2', node2)
+        self.assertEquals(server._nodes.getNodeForFlavors(flavors), node2)
+        server.nodeDisconnected('session2')
+        assert(not server._nodes.getNodeForFlavors(flavors))
+
+    def testScheduleSimulation(self):
+        from rmake_test.functional_test.pluginstest.multinodetest \
+                import schedbench
+        stats = schedbench.runSchedule(commands=200, nodes=10, slots=2)
+        # 20 slots, 80 of the commands can only go to the 5 x86_64 nodes
+        assert(stats['passes'] >= 10)
+
     def testDispatcherServerFull(self):
         # this should be a functional test where we look at everything
         # from the command being sent in to the events being sent out
@@ -0,0 +1,135 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Dispatcher scheduling simulation.
+
+Queues a number of build commands with a mix of flavors against a set of
+x86 and x86_64 worker nodes, then runs assignment passes the way the
+dispatcher does, completing every assigned command between passes, until
+the queue is empty.
+
+    python schedbench.py --commands 10000 --nodes 200
+"""
+import optparse
+import sys
+import time
+
+from conary.deps import deps
+
+from rmake.multinode import nodetypes
+from rmake.multinode.server import dispatcher
+
+
+class _NodeDb(object):
+    def addNode(self, *args):
+        pass
+
+    def removeNode(self, *args):
+        pass
+
+class _Logger(object):
+    def info(self, *args):
+        pass
+    warning = info
+
+class _NodeInfo(object):
+    def __init__(self, loadavg):
+        self.loadavg = (loadavg, loadavg, loadavg)
+
+    def getLoadAverage(self, minutes):
+        return self.loadavg[0]
+
+class _Command(object):
+    def __init__(self, commandId, jobId, flavors, chroot):
+        self.commandId = commandId
+        self.jobId = jobId
+        self.flavors = flavors
+        self.chroot = chroot
+
+    def getCommandId(self):
+        return self.commandId
+
+    def getJobId(self):
+        return self.jobId
+
+    def getRequiredFlavors(self):
+        return self.flavors
+
+    def requiresChroot(self):
+        return self.chroot
+
+
+def makeNodeList(nodes=200, slots=4):
+    nodeList = dispatcher.NodeList(_NodeDb(), _Logger())
+    x86 = [deps.parseFlavor('is: x86')]
+    x86_64 = [deps.parseFlavor('is: x86 x86_64')]
+    for idx in range(nodes):
+        buildFlavors = (idx % 2) and x86_64 or x86
+        node = nodetypes.WorkerNode('node%d' % idx, 'node%d' % idx, slots,
+                                    ['build'], buildFlavors, 100,
+                                    _NodeInfo(idx % 5), [], slots)
+        nodeList.add('WORKER-node%d' % idx, node)
+    return nodeList
+
+def makeCommands(count=10000, buildReqs=20):
+    flavorSets = [ [deps.parseFlavor(x)] * buildReqs for x in
+                   ('is: x86', 'ssl is: x86', '~!bootstrap is: x86',
+                    'is: x86_64', 'ssl is: x86_64') ]
+    commands = []
+    for idx in range(count):
+        commands.append(_Command('CMD-%d' % idx, idx / 50,
+                                 flavorSets[idx % len(flavorSets)],
+                                 not idx % 10))
+    return commands
+
+def runSchedule(commands=10000, nodes=200, slots=4):
+    """
+        Schedule commands commands on nodes nodes with slots slots each.
+        Returns a dict of timings.
+    """
+    nodeList = makeNodeList(nodes, slots)
+    queue = makeCommands(commands)
+    passes = 0
+    start = time.time()
+    while queue:
+        assignments = nodeList.assignCommands(queue)
+        passes += 1
+        if not assignments:
+            raise RuntimeError('%s commands could not be assigned'
+                               % len(queue))
+        assigned = set(x[0].getCommandId() for x in assignments)
+        queue = [ x for x in queue if x.getCommandId() not in assigned ]
+        for command, node in assignments:
+            nodeList.removeCommand(command.getCommandId())
+    elapsed = time.time() - start
+    return dict(commands=commands, nodes=nodes, passes=passes,
+                elapsed=elapsed)
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('-c', '--commands', type='int', default=10000)
+    parser.add_option('-n', '--nodes', type='int', default=200)
+    parser.add_option('-s', '--slots', type='int', default=4)
+    options, args = parser.parse_args(argv)
+    stats = runSchedule(options.commands, options.nodes, options.slots)
+    print ('%(commands)d commands scheduled on %(nodes)d nodes in '
+           '%(passes)d passes, %(elapsed).2fs' % stats)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
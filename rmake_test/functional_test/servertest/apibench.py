@@ -0,0 +1,235 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+"""
+Read-only API call benchmark.
+
+Starts a server that answers getJobs and getTroveBuildLog the way
+rMakeServer does - from a sqlite database that is reopened in every forked
+process, and from a build log on disk - then has a number of client
+processes call one of them as fast as they can.  Reports calls per second,
+with a process forked for each call and with a pool of API workers.
+
+    python apibench.py --clients 50 --duration 10 --workers 8
+"""
+import optparse
+import os
+import signal
+import socket
+import sqlite3
+import sys
+import tempfile
+import time
+import traceback
+import xmlrpclib
+
+from conary.lib import util
+
+from rmake.lib import apirpc
+from rmake.lib.apiutils import api, api_parameters, api_return, api_readonly
+
+
+class BenchServer(apirpc.XMLApiServer):
+    def __init__(self, uri, workDir, poolSize=0):
+        self.workDir = workDir
+        self.db = None
+        apirpc.XMLApiServer.__init__(self, uri, forkByDefault=True,
+                                     poolSize=poolSize)
+        self.db = self._openDb()
+
+    def _openDb(self):
+        db = sqlite3.connect(self.workDir + '/jobs.db')
+        db.execute("CREATE TABLE IF NOT EXISTS Jobs"
+                   " (jobId INTEGER PRIMARY KEY, state INTEGER, status TEXT)")
+        db.execute("CREATE TABLE IF NOT EXISTS BuildTroves"
+                   " (jobId INTEGER, troveName TEXT, state INTEGER,"
+                   " status TEXT)")
+        return db
+
+    def _fork(self, name):
+        # like rMakeServer, children drop the listening socket and open
+        # their own database connection.
+        pid = apirpc.XMLApiServer._fork(self, name)
+        if pid:
+            return pid
+        self._close()
+        self.db = self._openDb()
+        return pid
+
+    def _close(self):
+        apirpc.XMLApiServer._close(self)
+        if self.db is not None:
+            self.db.close()
+            self.db = None
+
+    @api(version=1)
+    @api_parameters(1, None)
+    @api_return(1, None)
+    @api_readonly
+    def getJobs(self, callData, jobIds):
+        jobs = []
+        for jobId in jobIds:
+            job = self.db.execute("SELECT jobId, state, status FROM Jobs"
+                                  " WHERE jobId = ?", (jobId,)).fetchone()
+            troves = self.db.execute("SELECT troveName, state, status"
+                                     " FROM BuildTroves WHERE jobId = ?",
+                                     (jobId,)).fetchall()
+            jobs.append((list(job), [ list(x) for x in troves ]))
+        return jobs
+
+    @api(version=1)
+    @api_parameters(1, None, 'int')
+    @api_return(1, None)
+    @api_readonly
+    def getTroveBuildLog(self, callData, jobId, mark):
+        f = open(self.workDir + '/build.log')
+        f.seek(mark)
+        data = f.read()
+        return False, xmlrpclib.Binary(data), mark + len(data)
+
+
+def _populate(workDir, jobs=20, troves=50, logSize=65536):
+    db = sqlite3.connect(workDir + '/jobs.db')
+    db.execute("CREATE TABLE Jobs"
+               " (jobId INTEGER PRIMARY KEY, state INTEGER, status TEXT)")
+    db.execute("CREATE TABLE BuildTroves"
+               " (jobId INTEGER, troveName TEXT, state INTEGER,"
+               " status TEXT)")
+    for jobId in range(1, jobs + 1):
+        db.execute("INSERT INTO Jobs VALUES (?, 99, 'Built')", (jobId,))
+        for idx in range(troves):
+            db.execute("INSERT INTO BuildTroves VALUES"
+                       " (?, ?, 3, 'Trove Built')",
+                       (jobId, 'trove%d:source' % idx))
+    db.commit()
+    db.close()
+    line = '+ make -j4 all\n'
+    f = open(workDir + '/build.log', 'w')
+    f.write(line * (logSize / len(line)))
+    f.close()
+
+def _findPort():
+    s = socket.socket()
+    s.bind(('', 0))
+    port = s.getsockname()[1]
+    s.close()
+    return port
+
+def _startServer(workDir, poolSize):
+    uri = 'http://localhost:%d/' % _findPort()
+    server = BenchServer(uri, workDir, poolSize)
+    pid = os.fork()
+    if not pid:
+        try:
+            try:
+                server.getLogger().disableConsole()
+                server.serve_forever()
+            except:
+                traceback.print_exc()
+        finally:
+            os._exit(1)
+    server.server.server_close()
+    return pid, uri
+
+def _runClient(uri, method, duration, writeFd):
+    proxy = apirpc.XMLApiProxy(BenchServer, uri)
+    calls = 0
+    end = time.time() + duration
+    while time.time() < end:
+        if method == 'getJobs':
+            proxy.getJobs([calls % 20 + 1])
+        else:
+            proxy.getTroveBuildLog(1, 0)
+        calls += 1
+    os.write(writeFd, '%d\n' % calls)
+
+def runBenchmark(method='getJobs', clients=50, duration=10, poolSize=0,
+                 workDir=None):
+    """
+        Call method from clients client processes for duration seconds
+        against a server with poolSize API workers.  Returns a dict of
+        results.
+    """
+    cleanWorkDir = workDir is None
+    if cleanWorkDir:
+        workDir = tempfile.mkdtemp(prefix='apibench-')
+        _populate(workDir)
+    serverPid, uri = _startServer(workDir, poolSize)
+    readFd, writeFd = os.pipe()
+    pids = []
+    try:
+        # wait for the server, and for the pool to start
+        proxy = apirpc.XMLApiProxy(BenchServer, uri)
+        for x in range(100):
+            try:
+                proxy.getJobs([1])
+                break
+            except socket.error:
+                time.sleep(.1)
+        for idx in range(clients):
+            pid = os.fork()
+            if not pid:
+                try:
+                    try:
+                        os.close(readFd)
+                        _runClient(uri, method, duration, writeFd)
+                        os._exit(0)
+                    except:
+                        traceback.print_exc()
+                finally:
+                    os._exit(1)
+            pids.append(pid)
+        os.close(writeFd)
+        failed = 0
+        for pid in pids:
+            if os.waitpid(pid, 0)[1]:
+                failed += 1
+        output = ''
+        while True:
+            data = os.read(readFd, 4096)
+            if not data:
+                break
+            output += data
+        calls = sum(int(x) for x in output.split())
+    finally:
+        os.close(readFd)
+        os.kill(serverPid, signal.SIGTERM)
+        os.waitpid(serverPid, 0)
+        if cleanWorkDir:
+            util.rmtree(workDir)
+    return dict(method=method, clients=clients, workers=poolSize,
+                calls=calls, failed=failed, rate=calls / float(duration))
+
+def main(argv):
+    parser = optparse.OptionParser()
+    parser.add_option('-c', '--clients', type='int', default=50)
+    parser.add_option('-d', '--duration', type='int', default=10,
+            help="Seconds each client makes calls for")
+    parser.add_option('-w', '--workers', type='int', default=8,
+            help="API workers to compare with forking")
+    options, args = parser.parse_args(argv)
+    for method in ('getJobs', 'getTroveBuildLog'):
+        for poolSize in (0, options.workers):
+            stats = runBenchmark(method, options.clients, options.duration,
+                                 poolSize)
+            print ('%(method)-17s %(clients)d clients, %(workers)2d workers:'
+                   ' %(rate)7.1f calls/s (%(failed)d clients failed)'
+                   % stats)
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -99,6 +99,7 @@ class ChrootTest(rmakehelp.RmakeHelper):
             raise testsuite.SkipTestException('conary too old for chroot cache functionality')
         chrootCache = self.workDir + '/chrootcache'
         self.rmakeCfg.configLine('chrootcache local %s/chrootcache' %self.workDir)
+        self.rmakeCfg.chrootCacheBackground = False
         src = self.addComponent('foo:source', '1')
         buildTrove = self.newBuildTrove(1, *src.getNameVersionFlavor())
         self.rmakeCfg.chrootLimit = 1
@@ -110,7 +111,10 @@ class ChrootTest(rmakehelp.RmakeHelper):
         # pre-test to make errors with the new hash in them
         expectedHash = 'db8d1e90e0de24619ee548fb54f2d64f36e5e0c9'
         expectedPath = '%s/%s.tar.gz' % (chrootCache, expectedHash)
-        actualHash = os.listdir(chrootCache)[0].split('.')[0]
+        # the cache directory also holds the cache's index
+        archives = [ x for x in os.listdir(chrootCache)
+                     if x.endswith('.tar.gz') ]
+        actualHash = archives[0].split('.')[0]
         self.failUnlessEqual(actualHash, expectedHash)
         # make sure the chroot was cached
         self.failUnless(os.path.exists(expectedPath))
@@ -162,6 +162,44 @@ class ChrootManagerTest(rmakehelp.RmakeHelper):
         self.assertEquals(queue2.requestSlot('trvName', buildReqs, True)[0],
                           None)
 
+    def testGetBestOldChrootIndexed(self):
+        # Once a chroot is indexed, its database is not opened again
+        # until it changes - even by a new queue.
+        root = self.cfg.root
+        make = self.makeTroveTuple
+        root0 = root + '/foo'
+        root1 = root + '/foo-1'
+        db0 = self.openDatabase(root0)
+        db1 = self.openDatabase(root1)
+        self.addDbComponent(db0, 'foo:runtime', ':1', 'is:x86')
+        self.addDbComponent(db1, 'bar:runtime', ':1', 'is:x86')
+        queue = rootmanager.ChrootQueue(root, 2)
+        queue.chrootFinished(root0)
+        queue.chrootFinished(root1)
+        self.failUnless(os.path.exists(root + '/.contents'))
+
+        opened = []
+        realDatabase = rootmanager.database.Database
+        def Database(*args, **kw):
+            opened.append(args[0])
+            return realDatabase(*args, **kw)
+        self.mock(rootmanager.database, 'Database', Database)
+
+        queue = rootmanager.ChrootQueue(root, 2)
+        buildReqs = [make('bar:runtime', ':1/2-1-1', 'is:x86')]
+        self.assertEquals(queue._getBestOldChroot(buildReqs, True), root1)
+        self.assertEquals(opened, [])
+
+        self.addDbComponent(db0, 'bar:runtime', ':1', 'is:x86')
+        os.utime(root0 + '/var/lib/conarydb/conarydb', (0, 0))
+        buildReqs.append(make('foo:runtime', ':1/2-1-1', 'is:x86'))
+        self.assertEquals(queue._getBestOldChroot(buildReqs, True), root0)
+        self.assertEquals(opened, [root0])
+
+        queue.deleteChroot(root0)
+        util.rmtree(root0)
+        self.assertEquals(queue._getContentsIndex().keys(), [root1])
+
     def testFakeChroot(self):
         groupRecipe = """
 class SimpleGroup(GroupRecipe):
@@ -80,7 +80,9 @@ class BuilderTest(rmakehelp.RmakeHelper):
                                          builderObj.logger,
                                          expectReg, [specTrv], logDir,
                                          dumbMode=False,
-                                         resolverCachePath=rscache)
+                                         resolverCachePath=rscache,
+                                         resolverCacheSize=
+                                self.rmakeCfg.resolverCacheSize * 1048576)
 
     def testBuild(self):
         trv = imagetrove.ImageTrove(1, *self.makeTroveTuple('group-foo'))
@@ -15,6 +15,10 @@
 #
 
 
+import os
+import sqlite3
+import time
+
 from testutils import mock
 
 from rmake_test import rmakehelp
@@ -22,6 +26,7 @@ from rmake_test import rmakehelp
 from rmake.build import buildtrove
 from rmake.build import dephandler
 from rmake.build import imagetrove
+from rmake.worker import resolver
 
 class DephandlerTest(rmakehelp.RmakeHelper):
     def testHasSpecialTroves(self):
@@ -44,3 +49,97 @@ class DephandlerTest(rmakehelp.RmakeHelper):
         assert(dh.hasSpecialTroves())
         assert(dh.popSpecialTrove() == it)
         assert(dh.specialTroves)
+
+    def testLeafCycles(self):
+        def leaves(g):
+            return sorted(sorted(x) for x in g.getLeafCycles())
+        g = dephandler.DependencyGraph()
+        g.addEdge('a', 'b')
+        g.addEdge('b', 'c')
+        assert(leaves(g) == [['c']])
+        # adding an edge that closes a cycle merges the components
+        g.addEdge('c', 'b')
+        assert(leaves(g) == [['b', 'c']])
+        g.addEdge('d', 'a')
+        g.addNode('e')
+        assert(leaves(g) == [['b', 'c'], ['e']])
+        # removing a node from a cycle splits it
+        g.delete('c')
+        assert(leaves(g) == [['b'], ['e']])
+        g.delete('b')
+        assert(leaves(g) == [['a'], ['e']])
+        g.deleteEdges('d')
+        assert(leaves(g) == [['a'], ['d'], ['e']])
+
+    def testGetNextResolveJobs(self):
+        dh = mock.MockInstance(dephandler.DependencyHandler)
+        dh._mock.enableMethod('getNextResolveJobs')
+        dh.getNextResolveJob._mock.setReturns(['job1', 'job2', None])
+        self.assertEquals(dh.getNextResolveJobs(5), ['job1', 'job2'])
+        dh.getNextResolveJob._mock.setReturns(['job3', 'job4'])
+        self.assertEquals(dh.getNextResolveJobs(1), ['job3'])
+
+    def testSetResolveLimit(self):
+        dh = mock.MockInstance(dephandler.DependencyHandler)
+        dh._mock.enableMethod('setResolveLimit')
+        dh.setResolveLimit(0)
+        self.assertEquals(dh._resolveLimit, dephandler.DEFAULT_RESOLVE_LIMIT)
+        dh.setResolveLimit(150)
+        self.assertEquals(dh._resolveLimit, 150)
+
+    def testResolverCache(self):
+        def makeResult(hash):
+            result = resolver.ResolveResult()
+            result.troveResolved([], [], [])
+            result.jobHash = hash
+            return result
+        cache = dephandler.ResolverCache(self.workDir + '/resolvercache')
+        assert(cache.get('abc') is None)
+        cache.put(makeResult('abc'))
+        result = cache.get('abc')
+        assert(result.success)
+        self.assertEquals(result.jobHash, 'abc')
+        stats = cache.getStats()
+        self.assertEquals((stats['hits'], stats['misses'], stats['entries']),
+                          (1, 1, 1))
+
+        # with room for only one result, the least recently used one goes.
+        cache.maxSize = stats['size']
+        cache.put(makeResult('def'))
+        assert(cache.get('abc') is None)
+        assert(cache.get('def'))
+        self.assertEquals(cache.getStats()['entries'], 1)
+
+        # lookups don't wait long for a busy database
+        lockDb = sqlite3.connect(self.workDir + '/resolvercache/cache.db',
+                                 isolation_level=None)
+        lockDb.execute('BEGIN IMMEDIATE')
+        try:
+            start = time.time()
+            assert(cache.get('def'))
+            assert(time.time() - start < 10)
+        finally:
+            lockDb.rollback()
+            lockDb.close()
+        self.assertEquals(cache.getStats()['hits'], 2)
+
+        # getting the stats of a cache that was never used creates nothing
+        cache = dephandler.ResolverCache(self.workDir + '/unused')
+        self.assertEquals(cache.getStats(),
+                          dict(hits=0, misses=0, entries=0, size=0))
+        assert(not os.path.exists(self.workDir + '/unused'))
+
+    def testJobHashWithBuiltTroves(self):
+        bt = buildtrove.BuildTrove(1, *self.makeTroveTuple('foo:source'))
+        bt.setConfig(self.buildCfg)
+        built = self.makeTroveTuple('bar:runtime')
+        built2 = self.makeTroveTuple('baz:runtime')
+        hash = dephandler.ResolveJob(bt, self.buildCfg).getJobHash()
+        builtHash = dephandler.ResolveJob(bt, self.buildCfg,
+                                          [built]).getJobHash()
+        assert(builtHash)
+        assert(builtHash != hash)
+        self.assertEquals(builtHash,
+            dephandler.ResolveJob(bt, self.buildCfg, [built]).getJobHash())
+        assert(builtHash != dephandler.ResolveJob(bt, self.buildCfg,
+                                          [built, built2]).getJobHash())
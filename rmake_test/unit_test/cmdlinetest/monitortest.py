@@ -0,0 +1,50 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from StringIO import StringIO
+
+from rmake_test import rmakehelp
+
+from rmake.cmdline import monitor
+
+
+class FakeClient(object):
+    def __init__(self, log):
+        self.log = log
+        self.isBuilding = True
+
+    def getTroveBuildLog(self, jobId, troveTuple, mark=0, maxSize=None,
+                         timeout=0):
+        data = self.log[mark:mark + maxSize]
+        return self.isBuilding, data, mark + len(data)
+
+
+class JobLogDisplayTest(rmakehelp.RmakeHelper):
+
+    def testTailLongLog(self):
+        log = 'x' * (monitor.LOG_CHUNK_SIZE * 3 + 10)
+        client = FakeClient(log)
+        out = StringIO()
+        display = monitor.JobLogDisplay(client, out=out)
+        trvTup = self.makeTroveTuple('foo:source')
+        display._tailBuildLog(1, trvTup)
+        out.truncate(0)
+        # the whole log is written, even once the trove is done building
+        client.isBuilding = False
+        display._serveLoopHook()
+        self.assertEqual(out.getvalue(), log)
+        self.assertEqual(display.buildingTroves, {})
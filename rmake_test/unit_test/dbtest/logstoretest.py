@@ -0,0 +1,81 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+
+import os
+
+from rmake_test import rmakehelp
+
+from rmake.db import logstore
+
+class LogStoreTest(rmakehelp.RmakeHelper):
+    def _makeLog(self, size):
+        path = self.workDir + '/log'
+        data = ''.join('line %d\n' % x for x in xrange(size))
+        open(path, 'w').write(data)
+        return path, data
+
+    def testCompressLog(self):
+        path, data = self._makeLog(10000)
+        uncompressed, compressed = logstore.compressLog(path, blockSize=1000)
+        self.failUnlessEqual(uncompressed, len(data))
+        self.failUnless(compressed < uncompressed)
+        self.failIf(os.path.exists(path))
+        self.failUnless(logstore.logExists(path))
+        # nothing left to compress
+        self.failUnlessEqual(logstore.compressLog(path), None)
+
+        f = logstore.openLog(path)
+        self.failUnless(isinstance(f, logstore.CompressedLogFile))
+        self.failUnlessEqual(f.read(), data)
+        self.failUnlessEqual(f.tell(), len(data))
+        self.failUnlessEqual(f.read(), '')
+        # reads that cross block boundaries
+        f.seek(990)
+        self.failUnlessEqual(f.read(2020), data[990:3010])
+        f.seek(5, 1)
+        self.failUnlessEqual(f.read(10), data[3015:3025])
+        # tail from the end
+        f.seek(-100, 2)
+        self.failUnlessEqual(f.read(), data[-100:])
+        f.seek(len(data) + 10)
+        self.failUnlessEqual(f.read(), '')
+        f.close()
+
+    def testCompressEmptyLog(self):
+        path, data = self._makeLog(0)
+        self.failUnlessEqual(logstore.compressLog(path), (0, 31))
+        f = logstore.openLog(path)
+        f.seek(0, 2)
+        self.failUnlessEqual(f.tell(), 0)
+        self.failUnlessEqual(f.read(), '')
+
+    def testLogStore(self):
+        store = logstore.LogStore(self.workDir + '/logs')
+        trove = self.newBuildTrove(1, *self.makeTroveTuple('foo:source'))
+        path = store.getTrovePath(trove)
+        self.failIf(store.hasTroveLog(trove))
+        os.makedirs(os.path.dirname(path))
+        open(path, 'w').write('log data\n')
+        self.failUnlessEqual(list(store.iterUncompressedLogs()), [path])
+        store.compressTroveLog(trove)
+        self.failUnlessEqual(list(store.iterUncompressedLogs()), [])
+        self.failUnless(store.hasTroveLog(trove))
+        self.failUnlessEqual(store.openTroveLog(trove).read(), 'log data\n')
+        store.deleteLogs([(1, trove.getName(), trove.getVersion(),
+                           trove.getFlavor())])
+        self.failIf(store.hasTroveLog(trove))
@@ -20,10 +20,11 @@ from testutils import mock
 from rmake_test import rmakehelp
 from rmake.lib import chrootcache
 from conary.lib import util
-import subprocess
+import fcntl
 import re
 import os
 import tempfile
+import time
 
 class LocalChrootCacheTest(rmakehelp.RmakeHelper):
     def setUp(self):
@@ -31,40 +32,72 @@ class LocalChrootCacheTest(rmakehelp.RmakeHelper):
         self.cacheDir = self.workDir + '/chrootcache'
         self.chrootCache = chrootcache.LocalChrootCache(self.cacheDir)
 
-    def _mkdirChain(self, *args, **kw):
-        self.failUnless(len(args) == 1)
-        self.failUnless(args[0].endswith('/work/chrootcache'))
-
     def testStore(self):
-        def call(*args, **kw):
-            expected = 'tar cSpf - -C /some/dir . | gzip -1 - > %s/6861736868617368686173686861736868617368.ABC123.tar.gz' %self.cacheDir
-            self.failUnlessEqual(args, (expected,))
-            self.failUnless(kw == dict(shell=True))
+        path = ('%s/6861736868617368686173686861736868617368.ABC123.tar.gz'
+                % self.cacheDir)
+        def runPipeline(first, second, stdout=None):
+            self.failUnlessEqual(first,
+                                 ['tar', 'cSpf', '-', '-C', '/some/dir', '.'])
+            self.failUnlessEqual(second, ['gzip', '-1', '-'])
+            self.failUnlessEqual(stdout.name, path)
 
         def mkstemp(*args, **kw):
-            return (
-                os.open('/dev/null', os.O_WRONLY),
-                '%s/6861736868617368686173686861736868617368.ABC123.tar.gz' %
-                    self.cacheDir)
+            return (os.open('/dev/null', os.O_WRONLY), path)
 
         def rename(*args, **kw):
             pass
 
-        mock.replaceFunctionOnce(subprocess, 'call', call)
-        mock.replaceFunctionOnce(util, 'mkdirChain', self._mkdirChain)
+        mock.replaceFunctionOnce(chrootcache, '_runPipeline', runPipeline)
         mock.replaceFunctionOnce(tempfile, 'mkstemp', mkstemp)
         mock.replaceFunctionOnce(os, 'rename', rename)
         self.chrootCache.store('hash' * 5, '/some/dir')
 
     def testRestore(self):
-        def call(*args, **kw):
-            expected = 'zcat %s/6861736868617368686173686861736868617368.tar.gz | tar xSpf - -C /some/dir' %self.cacheDir
-            self.failUnlessEqual(args, (expected,))
-            self.failUnless(kw == dict(shell=True))
+        expected = '%s/6861736868617368686173686861736868617368.tar.gz' %self.cacheDir
+        util.mkdirChain(self.cacheDir)
+        open(expected, 'w').close()
+        def runPipeline(first, second, stdout=None):
+            self.failUnlessEqual(first, ['zcat', expected])
+            self.failUnlessEqual(second, ['tar', 'xSpf', '-', '-C', '/some/dir'])
+            self.failUnlessEqual(stdout, None)
 
-        mock.replaceFunctionOnce(subprocess, 'call', call)
+        mock.replaceFunctionOnce(chrootcache, '_runPipeline', runPipeline)
         self.chrootCache.restore('hash' * 5, '/some/dir')
 
+    def testStoreFailure(self):
+        root = self.workDir + '/root'
+        util.mkdirChain(root + '/etc')
+        open(root + '/etc/passwd', 'w').write('root\n')
+        # a compressor that fails must not leave an archive in the cache
+        self.mock(chrootcache.TarArchive, 'compressCommand', 'false')
+        self.assertRaises(chrootcache.ChrootCacheError,
+                          self.chrootCache.store, 'hash' * 5, root)
+        self.failIf(self.chrootCache.hasChroot('hash' * 5))
+        self.failIf([ x for x in os.listdir(self.cacheDir)
+                      if x.startswith('6861736868617368') ])
+
+        self.mock(chrootcache.TarArchive, 'compressCommand',
+                  'no-such-compressor')
+        self.assertRaises(chrootcache.ChrootCacheError,
+                          self.chrootCache.store, 'hash' * 5, root)
+        self.failIf(self.chrootCache.hasChroot('hash' * 5))
+
+        chrootCache = chrootcache.LocalChrootCache(self.cacheDir, 'hardlink')
+        self.assertRaises(chrootcache.ChrootCacheError,
+                          chrootCache.store, 'hash' * 5, root + '/missing')
+        self.failIf(chrootCache.hasChroot('hash' * 5))
+
+    def testRestoreFailure(self):
+        root = self.workDir + '/root'
+        util.mkdirChain(root)
+        self.assertRaises(chrootcache.ChrootCacheError,
+                          self.chrootCache.restore, 'hash' * 5, root)
+        path = self.chrootCache._fingerPrintToPath('hash' * 5)
+        util.mkdirChain(self.cacheDir)
+        open(path, 'w').write('not an archive')
+        self.assertRaises(chrootcache.ChrootCacheError,
+                          self.chrootCache.restore, 'hash' * 5, root)
+
     def testHasChroot(self):
         def isfile(*args, **kw):
             self.failUnless(kw == {})
@@ -88,6 +121,193 @@ class LocalChrootCacheTest(rmakehelp.RmakeHelper):
         path = self.chrootCache._fingerPrintToPath('hash' * 5)
         self.failUnlessEqual(path, self.cacheDir + '/6861736868617368686173686861736868617368.tar.gz')
 
+    def testZstd(self):
+        chrootCache = chrootcache.LocalChrootCache(self.cacheDir, 'zstd')
+        path = chrootCache._fingerPrintToPath('hash' * 5)
+        self.failUnlessEqual(path, self.cacheDir + '/6861736868617368686173686861736868617368.tar.zst')
+        util.mkdirChain(self.cacheDir)
+        open(path, 'w').close()
+
+        def runPipeline(first, second, stdout=None):
+            self.failUnlessEqual(first, ['zstd', '-dcq', path])
+            self.failUnlessEqual(second, ['tar', 'xSpf', '-', '-C', '/some/dir'])
+        mock.replaceFunctionOnce(chrootcache, '_runPipeline', runPipeline)
+        chrootCache.restore('hash' * 5, '/some/dir')
+
+    def testAutoCompression(self):
+        def checkPath(binary):
+            if binary == 'pigz':
+                return '/usr/bin/pigz'
+            return None
+        self.mock(util, 'checkPath', checkPath)
+        chrootCache = chrootcache.LocalChrootCache(self.cacheDir, 'auto')
+        self.failUnless(isinstance(chrootCache.method,
+                                   chrootcache.PigzArchive))
+
+    def testHardlinkTree(self):
+        root = self.workDir + '/root'
+        util.mkdirChain(root + '/etc')
+        open(root + '/etc/passwd', 'w').write('root\n')
+        chrootCache = chrootcache.LocalChrootCache(self.cacheDir, 'hardlink')
+        chrootCache.store('hash' * 5, root)
+        self.failUnless(chrootCache.hasChroot('hash' * 5))
+        path = chrootCache._fingerPrintToPath('hash' * 5)
+        # the cache must not change with the chroot
+        self.failIfEqual(os.stat(path + '/etc/passwd').st_ino,
+                         os.stat(root + '/etc/passwd').st_ino)
+        open(root + '/etc/passwd', 'a').write('rmake\n')
+        self.failUnlessEqual(open(path + '/etc/passwd').read(), 'root\n')
+
+        newRoot = self.workDir + '/newroot'
+        util.mkdirChain(newRoot)
+        chrootCache.restore('hash' * 5, newRoot)
+        self.failUnlessEqual(open(newRoot + '/etc/passwd').read(), 'root\n')
+        self.failIfEqual(os.stat(path + '/etc/passwd').st_ino,
+                         os.stat(newRoot + '/etc/passwd').st_ino)
+        chrootCache.remove('hash' * 5)
+        self.failIf(chrootCache.hasChroot('hash' * 5))
+
+    def testStoreInBackground(self):
+        root = self.workDir + '/root'
+        util.mkdirChain(root + '/etc')
+        open(root + '/etc/passwd', 'w').write('root\n')
+        chrootCache = chrootcache.LocalChrootCache(self.cacheDir, 'hardlink')
+        chrootCache.storeInBackground('hash' * 5, root)
+        # the build goes on changing files in the chroot
+        open(root + '/etc/passwd', 'a').write('rmake\n')
+        path = chrootCache._fingerPrintToPath('hash' * 5)
+        for x in range(100):
+            if os.path.exists(path):
+                break
+            time.sleep(.1)
+        self.failUnlessEqual(open(path + '/etc/passwd').read(), 'root\n')
+        self.failIfEqual(os.stat(path + '/etc/passwd').st_ino,
+                         os.stat(root + '/etc/passwd').st_ino)
+
+    def testIndexAndEviction(self):
+        def makeRoot(name):
+            root = '%s/%s' % (self.workDir, name)
+            util.mkdirChain(root)
+            open(root + '/file', 'w').write('x' * 1000)
+            return root
+        times = [100, 200, 300, 400]
+        self.mock(time, 'time', lambda: times[0])
+        chrootCache = chrootcache.LocalChrootCache(self.cacheDir, 'hardlink',
+                                                   sizeLimit=2500)
+        chrootCache.store('a' * 20, makeRoot('a'))
+        times.pop(0)
+        chrootCache.store('b' * 20, makeRoot('b'))
+        times.pop(0)
+        chrootCache.restore('a' * 20, makeRoot('restored'))
+        self.failUnlessEqual(chrootCache.listCachedChroots(),
+            [('62' * 20, 1000, 200, 200, 0),
+             ('61' * 20, 1000, 100, 300, 1)])
+
+        # b was used least recently, so it's removed to make room for c.
+        times.pop(0)
+        chrootCache.store('c' * 20, makeRoot('c'))
+        self.failIf(chrootCache.hasChroot('b' * 20))
+        self.failUnlessEqual([ x[0] for x in chrootCache.listCachedChroots() ],
+                             ['61' * 20, '63' * 20])
+
+        chrootCache.remove('a' * 20)
+        self.failUnlessEqual([ x[0] for x in chrootCache.listCachedChroots() ],
+                             ['63' * 20])
+
+    def testIndexUnindexedChroots(self):
+        util.mkdirChain(self.cacheDir)
+        path = self.chrootCache._fingerPrintToPath('hash' * 5)
+        open(path, 'w').write('data')
+        os.utime(path, (100, 100))
+        self.failUnlessEqual(self.chrootCache.listCachedChroots(),
+            [('6861736868617368686173686861736868617368', 4, 100, 100, 0)])
+        # listing does not change the cache
+        self.failIf(os.path.exists(self.chrootCache._getIndexPath()))
+        os.unlink(path)
+        self.failUnlessEqual(self.chrootCache.listCachedChroots(), [])
+
+    def testOtherCompressionMethods(self):
+        # chroots stored before chrootCacheCompression was changed are
+        # still listed and pruned
+        util.mkdirChain(self.cacheDir + '/' + '61' * 20 + '.tree')
+        open(self.cacheDir + '/' + '61' * 20 + '.tree/file', 'w').write(
+                                                                'x' * 1000)
+        open(self.cacheDir + '/' + '62' * 20 + '.tar.zst', 'w').write(
+                                                                'x' * 1000)
+        for x in ('61', '62'):
+            os.utime(self.cacheDir + '/' + x * 20 + '.' +
+                     (x == '61' and 'tree' or 'tar.zst'), (100, 100))
+        self.failUnlessEqual([ x[0] for x in
+                               self.chrootCache.listCachedChroots() ],
+                             ['61' * 20, '62' * 20])
+        self.failIf(self.chrootCache.hasChroot('a' * 20))
+
+        root = self.workDir + '/root'
+        util.mkdirChain(root)
+        open(root + '/file', 'w').write('x' * 1000)
+        chrootCache = chrootcache.LocalChrootCache(self.cacheDir, 'hardlink',
+                                                   sizeLimit=1500)
+        chrootCache.store('c' * 20, root)
+        self.failUnlessEqual(sorted(os.listdir(self.cacheDir)),
+                             ['63' * 20 + '.tree', 'index.db'])
+
+    def testPruneSkipsRestoringChroots(self):
+        def makeRoot(name):
+            root = '%s/%s' % (self.workDir, name)
+            util.mkdirChain(root)
+            open(root + '/file', 'w').write('x' * 1000)
+            return root
+        times = [100, 200, 300]
+        self.mock(time, 'time', lambda: times[0])
+        chrootCache = chrootcache.LocalChrootCache(self.cacheDir, 'hardlink',
+                                                   sizeLimit=2500)
+        chrootCache.store('a' * 20, makeRoot('a'))
+        times.pop(0)
+        chrootCache.store('b' * 20, makeRoot('b'))
+        times.pop(0)
+        # a is being restored, so b is removed in its place
+        fd = os.open(chrootCache._fingerPrintToPath('a' * 20), os.O_RDONLY)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_SH)
+            chrootCache.store('c' * 20, makeRoot('c'))
+        finally:
+            os.close(fd)
+        self.failUnless(chrootCache.hasChroot('a' * 20))
+        self.failIf(chrootCache.hasChroot('b' * 20))
+        self.failUnlessEqual([ x[0] for x in chrootCache.listCachedChroots() ],
+                             ['61' * 20, '63' * 20])
+
+    def testFindClosestChroot(self):
+        root = '%s/root' % self.workDir
+        util.mkdirChain(root)
+        open(root + '/file', 'w').write('data')
+        chrootCache = chrootcache.LocalChrootCache(self.cacheDir, 'hardlink')
+        chrootCache.store('a' * 20, root, ['foo=1[]', 'bar=1[]'])
+        chrootCache.store('b' * 20, root,
+                          ['foo=1[]', 'bar=1[]', 'baz=1[]', 'extra=1[]'])
+        chrootCache.store('c' * 20, root)
+        # a and b have as many troves in common, but a has fewer to remove
+        self.failUnlessEqual(chrootCache.findClosestChroot(
+                             ['foo=1[]', 'bar=1[]', 'baz=2[]']), 'a' * 20)
+        self.failUnlessEqual(chrootCache.findClosestChroot(
+                             ['foo=1[]', 'bar=1[]', 'baz=1[]', 'extra=1[]',
+                              'new=1[]']), 'b' * 20)
+        # nothing with half of the troves needed
+        self.failUnlessEqual(chrootCache.findClosestChroot(
+                             ['foo=2[]', 'bar=2[]', 'baz=1[]']), None)
+        chrootCache.remove('a' * 20)
+        self.failUnlessEqual(chrootCache.findClosestChroot(
+                             ['foo=1[]', 'bar=1[]', 'baz=2[]']), 'b' * 20)
+
+        # unwanted troves with an exact prefix rule a chroot out
+        chrootCache.store('d' * 20, root,
+                          ['foo=1[]', 'bar=1[]', 'cross:gcc=1[]'])
+        self.failUnlessEqual(chrootCache.findClosestChroot(
+                             ['foo=1[]', 'bar=1[]'], ('cross:',)), 'b' * 20)
+        self.failUnlessEqual(chrootCache.findClosestChroot(
+                             ['foo=1[]', 'bar=1[]', 'cross:gcc=1[]'],
+                             ('cross:',)), 'd' * 20)
+
 
 class ChrootCacheInterfaceTest(rmakehelp.RmakeHelper):
     def testChrootCacheInterface(self):
@@ -95,3 +315,5 @@ class ChrootCacheInterfaceTest(rmakehelp.RmakeHelper):
         self.failUnlessRaises(NotImplementedError, intf.store, 'foo', 'dir')
         self.failUnlessRaises(NotImplementedError, intf.restore, 'foo', 'dir')
         self.failUnlessRaises(NotImplementedError, intf.hasChroot, 'foo')
+        self.failUnlessRaises(NotImplementedError, intf.listCachedChroots)
+        self.failUnlessEqual(intf.findClosestChroot(['foo=1[]']), None)
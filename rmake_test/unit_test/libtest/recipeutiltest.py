@@ -17,8 +17,12 @@
 
 from testutils import mock
 
+from conary.deps import deps
+
 from rmake_test import rmakehelp
 
+from rmake import failure
+from rmake.build import buildtrove
 from rmake.build import imagetrove
 from rmake.lib import recipeutil
 from rmake.lib import repocache
@@ -38,3 +42,96 @@ class RecipeUtilTest(rmakehelp.RmakeHelper):
         self.failUnlessEqual(rc, {trv1Tup: 'result'})
         args, kw = recipeutil.loadSourceTroves._mock.popCall()
         assert(args[3] == [trv1])
+
+    def testLoadSourceTrovesInWorkers(self):
+        job = self.newJob()
+        troves = []
+        for name in ('e', 'b', 'd', 'a', 'c'):
+            trv = self.newBuildTrove(1, *self.makeTroveTuple(name + ':source'))
+            trv.setConfig(self.buildCfg)
+            job.addBuildTrove(trv)
+            troves.append(trv)
+        self.mock(recipeutil, 'getRecipes',
+                  lambda repos, tups: [ x[0] for x in tups ])
+        def _loadSourceTrove(job_, repos, buildFlavor, buildTrove, trove,
+                             **kw):
+            # each recipe is loaded in a child process, with sources of
+            # its own
+            self.assertEqual(trove, buildTrove.getName())
+            self.assertEqual(repos, 'childRepos')
+            self.assertEqual(kw['loadInstalledSource'], 'childSource')
+            if trove == 'c:source':
+                return None, failure.LoadFailed('bad recipe')
+            result = buildtrove.LoadTroveResult()
+            result.packages = set([trove.split(':')[0]])
+            return result, None
+        self.mock(recipeutil, '_loadSourceTrove', _loadSourceTrove)
+        logged = []
+        self.mock(job, 'log', logged.append)
+
+        rc = recipeutil.loadSourceTroves(job, None, None, troves, workers=3,
+                openSources=lambda: ('childRepos', 'childSource'))
+        self.assertEqual(sorted((x[0], y.packages) for x, y in rc.items()),
+                         [('a:source', set(['a'])), ('b:source', set(['b'])),
+                          ('d:source', set(['d'])), ('e:source', set(['e']))])
+        self.assertEqual(logged, ['Downloading 5 recipes...',
+                                  'Loading 1 out of 5: a:source',
+                                  'Loading 2 out of 5: b:source',
+                                  'Loading 3 out of 5: c:source',
+                                  'Loading 4 out of 5: d:source',
+                                  'Loading 5 out of 5: e:source'])
+        trv = [ x for x in troves if x.getName() == 'c:source' ][0]
+        assert(trv.isFailed())
+        self.assertEqual(str(trv.getFailureReason()),
+                         'Failed while loading recipe: bad recipe')
+
+    def testLoadResultCache(self):
+        repos = mock.MockObject()
+        cache = recipeutil.LoadResultCache(self.workDir + '/loadcache', repos)
+        superTup = self.makeTroveTuple('super:source')
+        result = buildtrove.LoadTroveResult()
+        result.packages = set(['foo'])
+        result.loadedTroves = [superTup]
+        cache.put('abc', result)
+
+        repos.getTroveLatestByLabel._mock.setDefaultReturn(
+            {'super:source': {superTup[1]: [superTup[2]]}})
+        rc = cache.getResults(['abc', 'def'])
+        self.assertEqual(rc.keys(), ['abc'])
+        self.assertEqual(rc['abc'].packages, set(['foo']))
+        self.assertEqual(rc['abc'].loadedTroves, [superTup])
+
+        # a newer superclass on the label makes the result stale
+        newTup = self.makeTroveTuple('super:source', '2')
+        repos.getTroveLatestByLabel._mock.setDefaultReturn(
+            {'super:source': {newTup[1]: [newTup[2]]}})
+        self.assertEqual(cache.getResults(['abc']), {})
+
+    def testGetLoadHash(self):
+        trv = self.newBuildTrove(1, *self.makeTroveTuple('foo:source'))
+        trv.setConfig(self.buildCfg)
+        flavor = deps.parseFlavor('is: x86')
+        hash = recipeutil.getLoadHash(self.buildCfg, trv, flavor)
+        self.assertEqual(hash,
+                         recipeutil.getLoadHash(self.buildCfg, trv, flavor))
+        self.failIfEqual(hash, recipeutil.getLoadHash(self.buildCfg, trv,
+                                        deps.parseFlavor('is: x86_64')))
+        trv2 = self.newBuildTrove(1, *self.makeTroveTuple('foo:source', '2'))
+        self.failIfEqual(hash, recipeutil.getLoadHash(self.buildCfg, trv2,
+                                                      flavor))
+        # recipe setup() sees the trove config's macros
+        self.buildCfg.configLine('macros foo bar')
+        macroHash = recipeutil.getLoadHash(self.buildCfg, trv, flavor)
+        self.failIfEqual(hash, macroHash)
+        self.buildCfg.configLine('macros foo baz')
+        bazHash = recipeutil.getLoadHash(self.buildCfg, trv, flavor)
+        self.failIfEqual(macroHash, bazHash)
+        # loadInstalled can find the other troves built in the job
+        barTup = self.makeTroveTuple('bar')
+        jobHash = recipeutil.getLoadHash(self.buildCfg, trv, flavor,
+                                         buildTroveTups=[barTup])
+        self.failIfEqual(bazHash, jobHash)
+        self.assertEqual(jobHash, recipeutil.getLoadHash(self.buildCfg, trv,
+                                        flavor, buildTroveTups=[barTup]))
+        self.failIfEqual(jobHash, recipeutil.getLoadHash(self.buildCfg, trv,
+                flavor, buildTroveTups=[barTup, self.makeTroveTuple('baz')]))
@@ -0,0 +1,77 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import xmlrpclib
+
+from rmake_test import rmakehelp
+
+from rmake.lib import apirpc
+from rmake.lib import apiutils
+from rmake.server import client
+
+
+class OldServerProxy(object):
+    """
+        Answers like a server from before the log paging and chunked build
+        log calls.
+    """
+    def __init__(self):
+        self.calls = []
+        self.logs = [ ('1', 'log %d' % x, '') for x in range(3) ]
+        self.buildLog = 'line 1\nline 2\n'
+
+    def __getattr__(self, name):
+        def call(*args):
+            self.calls.append(name)
+            if not hasattr(OldServerProxy, '_' + name):
+                err = apirpc.NoSuchMethodError(name)
+                raise apiutils.thaw('Exception',
+                                    apiutils.freeze('Exception', err))
+            return getattr(self, '_' + name)(*args)
+        return call
+
+    def _getJobLogs(self, jobId, mark):
+        return self.logs[mark:]
+
+    def _getTroveLogs(self, jobId, troveTuple, mark):
+        return self.logs[mark:]
+
+    def _getTroveBuildLog(self, jobId, troveTuple, mark):
+        return False, xmlrpclib.Binary(self.buildLog[mark:]), len(self.buildLog)
+
+
+class ClientTest(rmakehelp.RmakeHelper):
+
+    def testOldServer(self):
+        rmakeClient = client.rMakeClient('unix:///nonexistent')
+        proxy = rmakeClient.proxy = OldServerProxy()
+        logs = rmakeClient.getJobLogsSince(1, 0)
+        self.assertEqual([ x[0] for x in logs ], [1, 2, 3])
+        self.assertEqual(logs[0][1:], ('1', 'log 0', ''))
+        self.assertEqual(rmakeClient.getJobLogsSince(1, 2),
+                         [(3, '1', 'log 2', '')])
+        self.assertEqual(rmakeClient.getJobLogsSince(1, 3), [])
+        trvTup = self.makeTroveTuple('foo:source')
+        self.assertEqual(len(rmakeClient.getTroveLogsSince(1, trvTup, 1)), 2)
+        # the missing method is only tried once
+        self.assertEqual(proxy.calls.count('getJobLogsSince'), 1)
+
+        self.assertEqual(rmakeClient.getTroveBuildLog(1, trvTup, 7,
+                                                      maxSize=1024),
+                         (False, 'line 2\n', 14))
+        self.assertEqual(rmakeClient.getTroveBuildLog(1, trvTup, -3),
+                         (False, ' 2\n', 14))
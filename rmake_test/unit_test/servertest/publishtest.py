@@ -0,0 +1,148 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+import time
+
+from testutils import mock
+from rmake_test import rmakehelp
+
+from rmake.build import subscriber as build_subscriber # registers EventList
+from rmake.lib import apiutils
+from rmake.server import publish
+
+
+class FakeSubscriber(object):
+    apiVersion = 1
+
+    def __init__(self, subscriberId, error=None):
+        self.subscriberId = subscriberId
+        self.uri = 'xmlrpc://sub%s' % subscriberId
+        self.error = error
+        self.received = []
+
+    def _receiveEvents(self, apiVer, eventList):
+        if self.error:
+            raise RuntimeError(self.error)
+        self.received.append(eventList)
+
+
+class FakeDb(object):
+    def __init__(self, subscribers):
+        self.subscribers = subscribers
+        self.calls = 0
+
+    def getSubscribersForEvents(self, jobId, eventList):
+        self.calls += 1
+        return dict((x[0], self.subscribers) for x in eventList)
+
+
+class FakeWriter(object):
+    def __init__(self):
+        self.sent = []
+
+    def send(self, data):
+        self.sent.append(data)
+
+
+class PublishTest(rmakehelp.RmakeHelper):
+
+    def _sendEvents(self, process, jobId, eventList):
+        eventList = apiutils.freeze('EventList', (1, eventList))[1]
+        process._handleMessage(('events', [(jobId, time.time(), eventList)]))
+
+    def _waitForResults(self, process, count):
+        for i in range(500):
+            process._handleResults()
+            if process._delivered + process._errors >= count:
+                return
+            time.sleep(.01)
+        self.fail('events were not delivered')
+
+    def testDeliverEvents(self):
+        good = FakeSubscriber(1)
+        bad = FakeSubscriber(2, error='connection refused')
+        db = FakeDb([good, bad])
+        writer = FakeWriter()
+        process = publish._EventDeliveryProcess(mock.MockObject(), db, None,
+                                                writer)
+        event1 = (('JOB_STATE_UPDATED', 1), [1, 1, 'Loading'])
+        event2 = (('JOB_LOG_UPDATED', ''), [1, 1, 'log'])
+        self._sendEvents(process, 1, [event1])
+        self._sendEvents(process, 1, [event1, event2])
+        # two deliveries for each subscriber, unless batches were merged
+        # while the first one was being delivered.
+        self._waitForResults(process, 2)
+        while sum(len(x) for x in good.received) < 3:
+            self._waitForResults(process, process._delivered + 1)
+        self.failUnlessEqual([ x for y in good.received for x in y ],
+                             [event1, event1, event2])
+        # subscriber lookups are cached
+        self.failUnlessEqual(db.calls, 2)
+        errors = [ x[1] for x in writer.sent if x[0] == 'error' ]
+        self.failUnless(errors)
+        self.failUnlessEqual(errors[0][1:],
+                             ('xmlrpc://sub2', 'connection refused'))
+
+        delivered = process._delivered
+        process._sendStats()
+        kind, stats = writer.sent[-1]
+        self.failUnlessEqual(kind, 'stats')
+        self.failUnlessEqual(stats['delivered'], delivered)
+        self.failUnlessEqual(stats['subscribers'], 2)
+
+    def testSubscriberAdded(self):
+        db = FakeDb([])
+        process = publish._EventDeliveryProcess(mock.MockObject(), db, None,
+                                                FakeWriter())
+        event = (('JOB_STATE_UPDATED', 1), [1, 1, 'Loading'])
+        self._sendEvents(process, 1, [event])
+        self._sendEvents(process, 2, [event])
+        self.failUnlessEqual(db.calls, 2)
+        # a subscriber is added to job 1 right after its first event
+        sub = FakeSubscriber(1)
+        db.subscribers = [sub]
+        process._handleMessage(('subscribed', 1))
+        self._sendEvents(process, 1, [event])
+        self._waitForResults(process, 1)
+        self.failUnlessEqual(sub.received, [[event]])
+        self.failUnlessEqual(db.calls, 3)
+        # lookups for other jobs stay cached
+        self._sendEvents(process, 2, [event])
+        self.failUnlessEqual(db.calls, 3)
+
+    def testCoalesce(self):
+        sub = FakeSubscriber(1)
+        items = [(sub, 1, 10, ['a']), (sub, 1, 11, ['b']),
+                 (sub, 2, 12, ['c']), (sub, 1, 13, ['d'])]
+        self.failUnlessEqual(publish._coalesce(items),
+                             [(sub, 10, ['a', 'b']), (sub, 12, ['c']),
+                              (sub, 13, ['d'])])
+
+    def testPublisherErrors(self):
+        class Logger(object):
+            def __init__(self):
+                self.errors = []
+            def error(self, *args):
+                self.errors.append(args)
+        logger = Logger()
+        publisher = publish._RmakeServerPublisher(logger, None)
+        publisher._handleMessage(('error', (time.time(), 'uri', 'failed')))
+        publisher._handleMessage(('error', (time.time(), 'uri', 'failed')))
+        self.failUnlessEqual(publisher.recentErrors, [('uri', 'failed')])
+        # repeated errors are only logged once
+        self.failUnlessEqual(logger.errors,
+                             [('Subscriber %s failed: %s', 'uri', 'failed')])
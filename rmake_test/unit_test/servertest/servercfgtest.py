@@ -23,7 +23,7 @@ from rmake_test import rmakehelp
 from rmake.server import servercfg
 from rmake.lib import chrootcache
 from rmake import errors, constants
-from conary.lib import cfgtypes
+from conary.lib import cfgtypes, util
 
 class CfgChrootCacheTest(rmakehelp.RmakeHelper):
     def testCfgChrootCache(self):
@@ -78,6 +78,18 @@ class rMakeBuilderConfigurationTest(rmakehelp.RmakeHelper):
             self.failUnlessEqual(str(e), 'unknown chroot cache type of "unknown" specified')
         self.failUnlessEqual(c._getChrootCacheDir(), None)
 
+    def testChrootCacheCompressionNotInstalled(self):
+        c = servercfg.rMakeBuilderConfiguration()
+        c.configLine('chrootcache local /path/to/cache')
+        c.configLine('chrootCacheCompression zstd')
+        self.mock(util, 'checkPath', lambda binary: None)
+        try:
+            c.getChrootCache()
+            self.fail('exception expected was not raised')
+        except errors.RmakeError, e:
+            self.failUnlessEqual(str(e),
+                    'chroot cache compression "zstd" is not installed')
+
     def testLocalRepoMap(self):
         """
         Test that single-node servers are configured to use 'localhost' for
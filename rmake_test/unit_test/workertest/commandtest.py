@@ -19,9 +19,12 @@ from rmake_test import rmakehelp
 from testutils import mock
 
 from conary import conaryclient
+from rmake import failure
 from rmake.build import buildjob, buildtrove
+from rmake.lib import logfile
 from rmake.lib import recipeutil
 from rmake.worker import command
+from rmake.worker import resolver
 
 
 class CommandTest(rmakehelp.RmakeHelper):
@@ -42,10 +45,15 @@ class CommandTest(rmakehelp.RmakeHelper):
         results = [result1, result2]
         resultSet = dict(zip(tups, results))
 
-        def getSourceTrovesFromJob(job_, troves_, repos, reposName):
+        def getSourceTrovesFromJob(job_, troves_, repos, reposName,
+                                   workers=1, loadCachePath=None,
+                                   openRepos=None):
             self.assertEqual(job_, job)
             self.assertEqual(troves_, troves)
             self.assertEqual(reposName, self.rmakeCfg.reposName)
+            self.assertEqual(workers, self.rmakeCfg.loadWorkers)
+            self.assertEqual(loadCachePath, self.rmakeCfg.getLoadCachePath())
+            self.assertEqual(openRepos, cmd._openRepos)
             return resultSet
         self.mock(recipeutil, 'getSourceTrovesFromJob', getSourceTrovesFromJob)
         mock.mock(conaryclient, 'ConaryClient')
@@ -60,3 +68,52 @@ class CommandTest(rmakehelp.RmakeHelper):
         cmd.publisher.attach._mock.assertCalled(trv2)
         self.assertEqual(trv1.packages, set(['foo', 'baz']))
         self.assertEqual(trv2.buildRequirements, set(['initscripts:runtime']))
+
+    def testBatchResolveCommand(self):
+        troves = [ buildtrove.BuildTrove(1, *self.getNVF('%s:source' % x))
+                   for x in ('foo', 'bar', 'baz') ]
+        resolveJobs = []
+        for trove in troves:
+            resolveJob = mock.MockObject()
+            resolveJob.getTrove._mock.setDefaultReturn(trove)
+            resolveJobs.append(resolveJob)
+
+        fooResult = resolver.ResolveResult()
+        fooResult.success = True
+        barResult = resolver.ResolveResult()
+        barResult.missingDeps = ['trove: missing:runtime']
+        results = {'foo:source' : fooResult, 'bar:source' : barResult}
+        class Resolver(object):
+            def resolve(self, resolveJob):
+                trove = resolveJob.getTrove()
+                if trove.getName() not in results:
+                    raise RuntimeError('resolve of %s failed' % trove.getName())
+                return results[trove.getName()]
+
+        resolved = []
+        for trove in troves:
+            def troveResolved(result, trove=trove):
+                resolved.append((trove, result))
+            self.mock(trove, 'troveResolved', troveResolved)
+        mock.mock(logfile, 'LogFile')
+
+        cmd = command.BatchResolveCommand(self.rmakeCfg, 'cmd', 1, None,
+                                          [None] * 3, resolveJobs)
+        self.mock(cmd, '_getResolver', lambda buildCfg: Resolver())
+        cmd.publisher = mock.MockObject()
+        cmd.logger = mock.MockObject()
+        cmd.runAttachedCommand()
+
+        # every trove gets its own result, and the failure of one does not
+        # fail the others.
+        cmd.publisher.attach._mock.assertCalled(troves[1])
+        cmd.publisher.attach._mock.assertCalled(troves[2])
+        self.assertEqual(resolved, [(troves[0], fooResult),
+                                    (troves[1], barResult)])
+        assert(not troves[0].isFailed())
+        assert(not troves[1].isFailed())
+        assert(troves[2].isFailed())
+        reason = troves[2].getFailureReason()
+        assert(isinstance(reason, failure.InternalError))
+        assert('resolve of baz:source failed' in str(reason))
+        self.assertEqual(cmd._unresolved, [])
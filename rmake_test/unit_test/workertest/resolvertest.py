@@ -0,0 +1,63 @@
+#
+# Copyright (c) SAS Institute Inc.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+#
+
+
+from rmake_test import rmakehelp
+
+from rmake.worker import resolver
+from rmake.worker import resolvesource
+
+
+class ResolverTest(rmakehelp.RmakeHelper):
+    def testResolveTroveSourceCache(self):
+        fetched = []
+        class FakeTrove(object):
+            def __init__(self, tup):
+                self.tup = tup
+            def getNameVersionFlavor(self):
+                return self.tup
+        class FakeRepos(object):
+            def getTroves(self, troveTups, withFiles=True):
+                fetched.append(troveTups)
+                return [ FakeTrove(x) for x in troveTups ]
+        self.mock(resolvesource, 'makeTroveListStack',
+                  lambda troveListList: 'stack')
+
+        foo = self.makeTroveTuple('group-foo')
+        bar = self.makeTroveTuple('group-bar')
+        self.buildCfg.resolveTroveTups = [[foo], [bar]]
+        repos = FakeRepos()
+        cache = resolver.ResolveTroveSourceCache(size=1)
+        troveListList, source = cache.getSources(self.buildCfg, repos)
+        self.assertEqual([[x.tup for x in y] for y in troveListList],
+                         [[foo], [bar]])
+        self.assertEqual(source, 'stack')
+        self.failUnless(cache.hasSources(self.buildCfg))
+        cache.getSources(self.buildCfg, repos)
+        self.assertEqual(fetched, [[foo, bar]])
+
+        # a different set of resolveTroves pushes out the old one.
+        self.buildCfg.resolveTroveTups = [[foo]]
+        self.failIf(cache.hasSources(self.buildCfg))
+        cache.getSources(self.buildCfg, repos)
+        self.assertEqual(fetched, [[foo, bar], [foo]])
+        self.buildCfg.resolveTroveTups = [[foo], [bar]]
+        self.failIf(cache.hasSources(self.buildCfg))
+
+        # with size 0 nothing is kept.
+        cache = resolver.ResolveTroveSourceCache(size=0)
+        cache.getSources(self.buildCfg, repos)
+        self.failIf(cache.hasSources(self.buildCfg))
@@ -15,6 +15,9 @@
 #
 
 
+import os
+import time
+
 from rmake_test import rmakehelp
 from testutils import mock
 
@@ -75,3 +78,26 @@ class WorkerTest(rmakehelp.RmakeHelper):
         del w.runCommand._mock.calls[:]
         wlog.warning._mock.assertCalled('Command %s has no job or trove '
                 'assigned -- cannot fail job.', 'PANTS-4')
+
+    def testOpenSlotCount(self):
+        w = worker.Worker(self.rmakeCfg, log, slots=3)
+        self.assertEquals(w.getOpenSlotCount(), 3)
+        w.queueCommand(command.ResolveCommand, self.rmakeCfg, 'RESOLVE-1')
+        w.commands.append(mock.MockObject())
+        self.assertEquals(w.getOpenSlotCount(), 1)
+        w.commands.extend([mock.MockObject(), mock.MockObject()])
+        self.assertEquals(w.getOpenSlotCount(), 0)
+
+    def testHandleRequestWakesOnChildExit(self):
+        w = worker.Worker(self.rmakeCfg, mock.MockObject())
+        w._watchChildren()
+        try:
+            pid = os.fork()
+            if not pid:
+                os._exit(0)
+            start = time.time()
+            w.handleRequestIfReady(30)
+            self.failUnless(time.time() - start < 10)
+            os.waitpid(pid, 0)
+        finally:
+            w._resetSignalHandlers()